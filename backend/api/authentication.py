@@ -0,0 +1,126 @@
+"""
+Stateless JWT-аутентификация: request.user собирается из claims access-токена, без SELECT пользователя.
+Модель CustomUser загружается лениво — только когда view действительно нужен полный объект
+(присвоение в FK added_by/archived_by, поля, которых нет в токене). isinstance(user, CustomUser) сохраняется,
+поэтому такие места работают без изменений.
+
+Права (группы, is_superuser) проверяются не по claims токена, а через api.roles (кэш, сбрасывается
+при изменении ролей) — понижение роли действует сразу, а не через ACCESS_TOKEN_LIFETIME.
+Отключённые (is_active=False) и удалённые пользователи отсекаются по кэшированному множеству активных id.
+Режим выключается настройкой JWT_STATELESS_AUTH=0 (обычная JWTAuthentication с запросом пользователя).
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.functional import LazyObject, empty
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_api_settings
+
+from .roles import get_user_roles, roles_ttl
+
+ACTIVE_USERS_KEY = 'api:auth:active'
+
+
+def active_user_ids():
+    """frozenset id активных пользователей (кэш на ROLES_CACHE_TTL; в своём процессе сбрасывается сигналами)."""
+    ids = cache.get(ACTIVE_USERS_KEY)
+    if ids is None:
+        ids = frozenset(get_user_model().objects.filter(is_active=True).values_list('id', flat=True))
+        cache.set(ACTIVE_USERS_KEY, ids, roles_ttl())
+    return ids
+
+
+def invalidate_active_users():
+    cache.delete(ACTIVE_USERS_KEY)
+
+
+def is_denied(user_id):
+    """
+    Пользователь отключён или удалён. Источник — таблица пользователей, а не память процесса: отключение или
+    удаление в другом процессе действует не позже чем через ROLES_CACHE_TTL. id, которого нет среди активных
+    (пользователь создан в другом процессе или уже отключён), уточняется одним запросом по первичному ключу.
+    """
+    if user_id in active_user_ids():
+        return False
+    return not get_user_model().objects.filter(pk=user_id, is_active=True).exists()
+
+
+def _claim(name):
+    def getter(self):
+        if name in self._token:
+            return self._token[name]
+        # Токен выпущен до появления claim — берём из модели.
+        return getattr(self._load(), name)
+
+    return property(getter)
+
+
+class ClaimsUser(LazyObject):
+    """
+    Пользователь из claims токена. id, профиль и права — без запроса к базе;
+    любой другой атрибут (и isinstance/FK) загружает CustomUser одним запросом на запрос.
+    """
+
+    def __init__(self, token):
+        super().__init__()
+        self.__dict__['_token'] = token
+
+    def _setup(self):
+        user_id = self._token[jwt_api_settings.USER_ID_CLAIM]
+        try:
+            self._wrapped = get_user_model().objects.get(**{jwt_api_settings.USER_ID_FIELD: user_id})
+        except get_user_model().DoesNotExist:
+            raise AuthenticationFailed('Пользователь не найден', code='user_not_found')
+
+    def _load(self):
+        if self._wrapped is empty:
+            self._setup()
+        return self._wrapped
+
+    @property
+    def id(self):
+        return self._token[jwt_api_settings.USER_ID_CLAIM]
+
+    pk = id
+
+    is_authenticated = True
+    is_anonymous = False
+    # Отключённые пользователи отсекаются deny-list'ом при аутентификации.
+    is_active = True
+
+    # Поля профиля, которые MyTokenObtainPairSerializer.get_token кладёт в токен.
+    username = _claim('username')
+    first_name = _claim('first_name')
+    last_name = _claim('last_name')
+    email = _claim('email')
+    phone = _claim('phone')
+    position = _claim('position')
+
+    @property
+    def is_superuser(self):
+        return get_user_roles(self.id).is_superuser
+
+    @property
+    def token_groups(self):
+        """Группы на момент выпуска токена (для отображения; права — через api.roles)."""
+        return list(self._token.get('groups', ()))
+
+    def __bool__(self):
+        # LazyObject проксирует bool() в модель; `if not request.user` не должен её загружать.
+        return True
+
+    def __repr__(self):
+        return f'<ClaimsUser id={self.id}>'
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication без запроса пользователя: ClaimsUser + deny-list отключённых/удалённых."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[jwt_api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Токен не содержит идентификатор пользователя')
+        if is_denied(user_id):
+            raise AuthenticationFailed('Пользователь отключён', code='user_inactive')
+        return ClaimsUser(validated_token)
@@ -0,0 +1,119 @@
+"""
+Печатные формы приходов/расходов (HTML) на сервере — вместо сборки в браузере из полного ответа с маркировками.
+Строки документа — товар, ИКПУ, число маркировок, цена, сумма: один GROUP BY по маркировкам на пачку документов,
+сами маркировки не читаются. Пачка документов рендерится за один проход (шапки одним запросом, строки — одним).
+
+Кэш: ключ — (вид, id, updated_at). Архивный документ заморожен (правило архива), его форма кэшируется
+бессрочно в кэше DOCUMENT_CACHE_ALIAS; неархивные формы рендерятся каждый раз — их маркировки и цены
+товаров могут меняться без изменения updated_at документа.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count
+from django.template.loader import render_to_string
+
+from warehouse.models import Income, Outcome, ProductMarking
+
+# вид → (модель, поле компании, FK маркировки → документ, заголовок)
+DOCUMENT_KINDS = {
+    'income': (Income, 'from_company', 'income', 'Приход'),
+    'outcome': (Outcome, 'to_company', 'outcome', 'Расход'),
+}
+DOCUMENT_CHUNK_SIZE = 500
+MAX_BATCH_DOCUMENTS = 500
+
+
+def document_cache():
+    return caches[getattr(settings, 'DOCUMENT_CACHE_ALIAS', 'default')]
+
+
+def document_cache_key(kind, document):
+    return f'doc:{kind}:{document.id}:{document.updated_at.timestamp() if document.updated_at else 0}'
+
+
+def format_amount(value):
+    """1234567.5 → '1 234 567,5' (как toLocaleString('ru-RU') в прежней форме)."""
+    if value is None:
+        return 'N/A'
+    text = f'{value:,.2f}'.rstrip('0').rstrip('.')
+    return text.replace(',', ' ').replace('.', ',')
+
+
+def document_lines(kind, document_ids):
+    """{id документа: [строки по товарам]} — один GROUP BY на чанк id."""
+    field = f'{DOCUMENT_KINDS[kind][2]}_id'
+    lines = {}
+    for start in range(0, len(document_ids), DOCUMENT_CHUNK_SIZE):
+        rows = (
+            ProductMarking.objects.filter(**{f'{field}__in': document_ids[start:start + DOCUMENT_CHUNK_SIZE]})
+            .values(field, 'product_id', 'product__name', 'product__kpi', 'product__price')
+            .annotate(count=Count('id'))
+            .order_by(field, 'product__name', 'product_id')
+        )
+        for row in rows:
+            lines.setdefault(row[field], []).append(row)
+    return lines
+
+
+def _render_body(kind, document, rows):
+    _, company_field, _, heading = DOCUMENT_KINDS[kind]
+    lines = [
+        {
+            'name': row['product__name'],
+            'kpi': row['product__kpi'],
+            'count': row['count'],
+            'price': format_amount(row['product__price']),
+            'amount': format_amount(row['product__price'] * row['count'] if row['product__price'] else None),
+        }
+        for row in rows
+    ]
+    return render_to_string('api/document_body.html', {
+        'heading': f'{heading} № {document.contract_number}',
+        'document': document,
+        'company': getattr(document, company_field),
+        'lines': lines,
+        'items': format_amount(sum(row['count'] for row in rows)),
+        'total': format_amount(document.total),
+    })
+
+
+def render_bodies(kind, documents):
+    """HTML-фрагменты документов в порядке documents: архивные — из кэша, недостающие — одним проходом."""
+    cache = document_cache()
+    keys = {document.id: document_cache_key(kind, document) for document in documents if document.is_archive}
+    cached = cache.get_many(keys.values()) if keys else {}
+    bodies = {
+        document.id: cached[keys[document.id]]
+        for document in documents
+        if document.id in keys and keys[document.id] in cached
+    }
+    missing = [document for document in documents if document.id not in bodies]
+    if missing:
+        lines = document_lines(kind, [document.id for document in missing])
+        rendered = {document.id: _render_body(kind, document, lines.get(document.id, [])) for document in missing}
+        bodies.update(rendered)
+        to_cache = {keys[doc_id]: body for doc_id, body in rendered.items() if doc_id in keys}
+        if to_cache:
+            cache.set_many(to_cache, timeout=None)
+    return [bodies[document.id] for document in documents]
+
+
+def render_documents_page(kind, documents):
+    """Одна HTML-страница для печати; каждый документ — с новой страницы."""
+    title = DOCUMENT_KINDS[kind][3] if len(documents) != 1 else f'{DOCUMENT_KINDS[kind][3]} № {documents[0].contract_number}'
+    return render_to_string('api/document.html', {
+        'title': title,
+        'documents': render_bodies(kind, documents),
+    })
+
+
+def load_documents(kind, ids):
+    """Документы с компанией по списку id, в порядке ids; второй элемент — id, которых нет."""
+    model, company_field, _, _ = DOCUMENT_KINDS[kind]
+    found = {}
+    for start in range(0, len(ids), DOCUMENT_CHUNK_SIZE):
+        found.update(
+            (document.id, document)
+            for document in model.objects.select_related(company_field).filter(id__in=ids[start:start + DOCUMENT_CHUNK_SIZE])
+        )
+    return [found[doc_id] for doc_id in ids if doc_id in found], [doc_id for doc_id in ids if doc_id not in found]
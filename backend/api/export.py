@@ -0,0 +1,211 @@
+"""
+Потоковая выгрузка документов с маркировками (CSV / XLSX) для бухгалтерии.
+Строка = маркировка документа (документ без маркировок — одна строка с пустыми полями маркировки).
+Данные читаются одним запросом: values_list с LEFT JOIN на маркировки, queryset.iterator(chunk_size) —
+без моделей и сериалайзеров; ответ отдаётся частями по мере чтения, память не растёт с размером выгрузки.
+XLSX пишется без сторонних библиотек: zip (deflate) в поток, листы с inline-строками, по
+XLSX_MAX_ROWS строк на лист (предел Excel).
+"""
+import csv
+import io
+import re
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+EXPORT_CHUNK_SIZE = 2000
+# Строк в одном куске ответа (CSV) / между сбросами zip-буфера (XLSX).
+FLUSH_ROWS = 500
+XLSX_MAX_ROWS = 1_048_576
+
+CSV_CONTENT_TYPE = 'text/csv; charset=utf-8'
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _marking_columns(relation):
+    return [
+        ('Товар', f'{relation}__product__name'),
+        ('KPI', f'{relation}__product__kpi'),
+        ('Цена', f'{relation}__product__price'),
+        ('Маркировка', f'{relation}__marking'),
+    ]
+
+
+def _document_columns(company_field):
+    return [
+        ('ID', 'id'),
+        ('Номер договора', 'contract_number'),
+        ('Дата договора', 'contract_date'),
+        ('Номер счёта', 'invoice_number'),
+        ('Дата счёта', 'invoice_date'),
+        ('Компания', f'{company_field}__name'),
+        ('ИНН', f'{company_field}__inn'),
+        ('Ед. изм.', 'unit_of_measure'),
+        ('Сумма', 'total'),
+        ('Архив', 'is_archive'),
+    ]
+
+
+# (колонки, связь документ → маркировки)
+INCOME_EXPORT = (_document_columns('from_company') + _marking_columns('income'), 'income')
+OUTCOME_EXPORT = (_document_columns('to_company') + _marking_columns('product_markings'), 'product_markings')
+
+
+def export_rows(queryset, columns, marking_relation, chunk_size=EXPORT_CHUNK_SIZE):
+    """Кортежи значений в порядке columns; сортировка queryset сохраняется, маркировки документа — по id."""
+    ordering = list(queryset.query.order_by) or ['-created_at', '-id']
+    return (
+        queryset.order_by(*ordering, f'{marking_relation}__id')
+        .values_list(*(lookup for _, lookup in columns))
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'да' if value else 'нет'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def csv_stream(headers, rows):
+    """Куски CSV: BOM (чтобы Excel открыл UTF-8 с кириллицей), заголовок, строки пачками по FLUSH_ROWS."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    count = 0
+    for row in rows:
+        writer.writerow([_text(value) for value in row])
+        count += 1
+        if count % FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _ZipSink:
+    """Приёмник для zipfile без seek/tell: zipfile пишет в режиме потока, мы забираем накопленные байты."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# Управляющие символы недопустимы в XML (в маркировках DataMatrix есть GS, \x1d) — экранируем как _xHHHH_ (ECMA-376).
+_XML_ILLEGAL = re.compile(r'_(?=x[0-9A-Fa-f]{4}_)|[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xml_text(value):
+    return escape(_XML_ILLEGAL.sub(lambda m: '_x005F_' if m.group() == '_' else f'_x{ord(m.group()):04X}_', value))
+
+
+def _xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c t="n"><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{_xml_text(str(_text(value)))}</t></is></c>'
+
+
+def _xlsx_row(values):
+    return '<row>' + ''.join(_xlsx_cell(value) for value in values) + '</row>'
+
+
+_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+_SHEET_TAIL = '</sheetData></worksheet>'
+
+
+def _xlsx_package_files(sheet_count):
+    """Служебные части книги; пишутся в конце, когда известно число листов."""
+    sheets = range(1, sheet_count + 1)
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        + ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in sheets
+        )
+        + '</Types>'
+    )
+    root_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'
+    )
+    workbook = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+        + ''.join(f'<sheet name="Лист{i}" sheetId="{i}" r:id="rId{i}"/>' for i in sheets)
+        + '</sheets></workbook>'
+    )
+    workbook_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + ''.join(
+            f'<Relationship Id="rId{i}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            f'Target="worksheets/sheet{i}.xml"/>'
+            for i in sheets
+        )
+        + '</Relationships>'
+    )
+    return [
+        ('[Content_Types].xml', content_types),
+        ('_rels/.rels', root_rels),
+        ('xl/workbook.xml', workbook),
+        ('xl/_rels/workbook.xml.rels', workbook_rels),
+    ]
+
+
+def xlsx_stream(headers, rows, max_rows=XLSX_MAX_ROWS):
+    """Куски XLSX-файла. Заголовок повторяется на каждом листе; лист — не больше max_rows строк."""
+    sink = _ZipSink()
+    header_row = _xlsx_row(headers)
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        sheet_count = 0
+        rows = iter(rows)
+        pending = next(rows, None)
+        while sheet_count == 0 or pending is not None:
+            sheet_count += 1
+            # Размер листа заранее неизвестен — zip64, чтобы большой лист не упёрся в предел 4 ГБ.
+            with archive.open(f'xl/worksheets/sheet{sheet_count}.xml', 'w', force_zip64=True) as sheet:
+                sheet.write((_SHEET_HEAD + header_row).encode('utf-8'))
+                written = 1
+                while pending is not None and written < max_rows:
+                    sheet.write(_xlsx_row(pending).encode('utf-8'))
+                    written += 1
+                    pending = next(rows, None)
+                    if written % FLUSH_ROWS == 0:
+                        yield sink.drain()
+                sheet.write(_SHEET_TAIL.encode('utf-8'))
+            yield sink.drain()
+        for name, content in _xlsx_package_files(sheet_count):
+            archive.writestr(name, content)
+    yield sink.drain()
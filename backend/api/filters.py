@@ -1,10 +1,33 @@
 """
 Фильтры и сортировка для Income/Outcome/ProductMarking (даты, поиск по номеру/маркировке, ordering).
+Условия пишем так, чтобы их покрывали индексы: год — диапазоном дат, флаг архива — через IN,
+маркировка — через индекс поиска warehouse.search (FTS5 trigram / pg_trgm).
 """
+from datetime import date
+
 import django_filters
 from django.db.models import Q
 
 from warehouse.models import Income, Outcome, ProductMarking
+from warehouse.search import marking_search_q, markings_matching
+
+
+def filter_flag(queryset, name, value):
+    """
+    Булево поле как `field IN (1)`: для filter(is_archive=True) Django на SQLite пишет `WHERE "is_archive"`,
+    и такое условие не может быть префиксом составного индекса (is_archive, -created_at, -id).
+    """
+    if value is None:
+        return queryset
+    return queryset.filter(**{f'{name}__in': [value]})
+
+
+def filter_year(queryset, name, value):
+    """Год как диапазон [1 января; 1 января следующего) — по индексу, в отличие от __year (strftime на SQLite)."""
+    if value is None:
+        return queryset
+    year = int(value)
+    return queryset.filter(**{f'{name}__gte': date(year, 1, 1), f'{name}__lt': date(year + 1, 1, 1)})
 
 
 class IncomeFilter(django_filters.FilterSet):
@@ -14,7 +37,8 @@ class IncomeFilter(django_filters.FilterSet):
     invoice_date_to = django_filters.DateFilter(field_name='invoice_date', lookup_expr='lte', label='Дата счёта до')
     search = django_filters.CharFilter(method='filter_search', label='Поиск (номер, компания)')
     marking = django_filters.CharFilter(method='filter_marking', label='Маркировка')
-    is_archive = django_filters.BooleanFilter(field_name='is_archive', label='Архив')
+    year = django_filters.NumberFilter(field_name='contract_date', method=filter_year, label='Год договора')
+    is_archive = django_filters.BooleanFilter(field_name='is_archive', method=filter_flag, label='Архив')
     ordering = django_filters.OrderingFilter(
         fields=(
             ('contract_date', 'contract_date'),
@@ -36,7 +60,7 @@ class IncomeFilter(django_filters.FilterSet):
 
     class Meta:
         model = Income
-        fields = ['date_from', 'date_to', 'invoice_date_from', 'invoice_date_to', 'search', 'marking', 'is_archive', 'ordering']
+        fields = ['date_from', 'date_to', 'year', 'invoice_date_from', 'invoice_date_to', 'search', 'marking', 'is_archive', 'ordering']
 
     def filter_search(self, queryset, name, value):
         if not value or not value.strip():
@@ -52,7 +76,8 @@ class IncomeFilter(django_filters.FilterSet):
     def filter_marking(self, queryset, name, value):
         if not value or not value.strip():
             return queryset
-        return queryset.filter(income__marking__icontains=value.strip()).distinct()
+        # Полусоединение id IN (SELECT income_id ...) вместо JOIN по маркировкам + DISTINCT.
+        return queryset.filter(id__in=markings_matching(value.strip()).values('income_id'))
 
 
 class OutcomeFilter(django_filters.FilterSet):
@@ -62,7 +87,8 @@ class OutcomeFilter(django_filters.FilterSet):
     invoice_date_to = django_filters.DateFilter(field_name='invoice_date', lookup_expr='lte', label='Дата счёта до')
     search = django_filters.CharFilter(method='filter_search', label='Поиск (номер, компания)')
     marking = django_filters.CharFilter(method='filter_marking', label='Маркировка')
-    is_archive = django_filters.BooleanFilter(field_name='is_archive', label='Архив')
+    year = django_filters.NumberFilter(field_name='contract_date', method=filter_year, label='Год договора')
+    is_archive = django_filters.BooleanFilter(field_name='is_archive', method=filter_flag, label='Архив')
     ordering = django_filters.OrderingFilter(
         fields=(
             ('contract_date', 'contract_date'),
@@ -84,7 +110,7 @@ class OutcomeFilter(django_filters.FilterSet):
 
     class Meta:
         model = Outcome
-        fields = ['date_from', 'date_to', 'invoice_date_from', 'invoice_date_to', 'search', 'marking', 'is_archive', 'ordering']
+        fields = ['date_from', 'date_to', 'year', 'invoice_date_from', 'invoice_date_to', 'search', 'marking', 'is_archive', 'ordering']
 
     def filter_search(self, queryset, name, value):
         if not value or not value.strip():
@@ -100,11 +126,11 @@ class OutcomeFilter(django_filters.FilterSet):
     def filter_marking(self, queryset, name, value):
         if not value or not value.strip():
             return queryset
-        return queryset.filter(product_markings__marking__icontains=value.strip()).distinct()
+        return queryset.filter(id__in=markings_matching(value.strip()).values('outcome_id'))
 
 
 class ProductMarkingFilter(django_filters.FilterSet):
-    search = django_filters.CharFilter(field_name='marking', lookup_expr='icontains', label='Маркировка')
+    search = django_filters.CharFilter(method='filter_search', label='Маркировка')
     ordering = django_filters.OrderingFilter(
         fields=(
             ('marking', 'marking'),
@@ -117,3 +143,8 @@ class ProductMarkingFilter(django_filters.FilterSet):
     class Meta:
         model = ProductMarking
         fields = ['search', 'ordering']
+
+    def filter_search(self, queryset, name, value):
+        if not value or not value.strip():
+            return queryset
+        return queryset.filter(marking_search_q(value.strip()))
@@ -0,0 +1,42 @@
+"""
+Обработчики фоновых задач API (warehouse.jobs). Регистрируются при старте приложения (ApiConfig.ready).
+Задача повторяет синхронный POST: тот же сериалайзер, те же правила валидации.
+"""
+from types import SimpleNamespace
+
+from rest_framework.exceptions import ValidationError
+
+from warehouse.jobs import JobFailed, register
+from .serializers import IncomeSerializer, OutcomeSerializer
+
+
+def markings_count(validated_data):
+    """Сколько маркировок запишет задача: products[].markings прихода или product_markings расхода."""
+    return (
+        sum(len(product.get('markings', [])) for product in validated_data.get('products', ()))
+        + len(validated_data.get('product_markings', ()))
+    )
+
+
+def _save_with_serializer(job, serializer_class):
+    """
+    Запись идёт в транзакции run_job вместе с итогом задачи, поэтому промежуточный прогресс отсюда не пишется:
+    до COMMIT его не видно. Объём (progress_total) задаётся при постановке в очередь, progress_done — при итоге.
+    """
+    serializer = serializer_class(data=job.payload, context={'request': SimpleNamespace(user=job.created_by)})
+    try:
+        serializer.is_valid(raise_exception=True)
+        instance = serializer.save()
+    except ValidationError as exc:
+        raise JobFailed('Ошибка валидации', details=exc.detail) from exc
+    return {'id': instance.id}
+
+
+@register('income_create')
+def income_create(job):
+    return _save_with_serializer(job, IncomeSerializer)
+
+
+@register('outcome_create')
+def outcome_create(job):
+    return _save_with_serializer(job, OutcomeSerializer)
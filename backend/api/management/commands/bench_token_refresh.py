@@ -0,0 +1,67 @@
+"""
+Замер ротации refresh-токенов: прежний конвейер (повторный разбор токена, загрузка пользователя и групп,
+OutstandingToken + BlacklistedToken на каждую ротацию) против текущего MyTokenRefreshSerializer.
+Работает на временном пользователе внутри транзакции, которая откатывается, — данные не остаются.
+Запуск: python manage.py bench_token_refresh [--count 500]
+"""
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.roles import invalidate_user_roles
+from api.views import MyTokenObtainPairSerializer, MyTokenRefreshSerializer
+
+
+class LegacyTokenRefreshSerializer(TokenRefreshSerializer):
+    """MyTokenRefreshSerializer до переработки — для сравнения."""
+
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        user_id = refresh.payload.get(jwt_api_settings.USER_ID_CLAIM)
+        data = super().validate(attrs)
+        user = get_user_model().objects.filter(**{jwt_api_settings.USER_ID_FIELD: user_id}).first()
+        data['groups'] = [g.name for g in user.groups.all()] if user else []
+        data['is_superuser'] = user.is_superuser if user else False
+        return data
+
+
+class Command(BaseCommand):
+    help = "Сравнивает скорость ротации refresh-токенов: прежний и текущий конвейер"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=500, help="Сколько ротаций подряд на каждый конвейер")
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        with transaction.atomic():
+            user = get_user_model().objects.create_user(username=f"bench-refresh-{time.time_ns()}")
+            group = Group.objects.filter(name="operator").first()
+            if group:
+                user.groups.add(group)
+            for name, serializer_class, token_class in (
+                ("прежний", LegacyTokenRefreshSerializer, RefreshToken),
+                ("текущий", MyTokenRefreshSerializer, MyTokenObtainPairSerializer.token_class),
+            ):
+                invalidate_user_roles(user)
+                self._run(name, serializer_class, str(token_class.for_user(user)), count)
+            transaction.set_rollback(True)
+        invalidate_user_roles(user)
+
+    def _run(self, name, serializer_class, token, count):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for _ in range(count):
+                serializer = serializer_class(data={"refresh": token})
+                serializer.is_valid(raise_exception=True)
+                token = serializer.validated_data["refresh"]
+            elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{name}: {count / elapsed:.0f} ротаций/с, запросов на ротацию: {len(queries) / count:.1f}"
+        )
@@ -0,0 +1,25 @@
+"""
+Удаление истёкших отозванных refresh-токенов (warehouse.RevokedToken) и записей token_blacklist.
+В отличие от flushexpiredtokens (один DELETE на всю таблицу) удаляет пачками по первичному ключу —
+каждая пачка отдельной короткой транзакцией, без долгой блокировки таблиц при работающем приложении.
+Запуск (например, раз в сутки из cron): python manage.py prune_tokens [--batch-size 1000] [--pause 0.1]
+"""
+from django.core.management.base import BaseCommand
+
+from api.tokens import PRUNE_BATCH_SIZE, prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = "Удаляет истёкшие отозванные и выпущенные refresh-токены пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=PRUNE_BATCH_SIZE, help="Строк в одном DELETE")
+        parser.add_argument("--pause", type=float, default=0, help="Пауза между пачками, секунд")
+
+    def handle(self, *args, **options):
+        deleted = prune_expired_tokens(batch_size=options["batch_size"], pause=options["pause"])
+        self.stdout.write(
+            f"Удалено: отозванных {deleted['revoked']}, в чёрном списке {deleted['blacklisted']}, "
+            f"выпущенных {deleted['outstanding']}"
+        )
+        self.stdout.write(self.style.SUCCESS("Готово"))
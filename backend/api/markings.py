@@ -0,0 +1,345 @@
+"""
+Массовая работа с маркировками: проверка конфликтов чанками IN-запросов и вставка через bulk_create.
+Используется при создании/редактировании прихода вместо exists()+create() на каждую маркировку
+и потоковым импортом выгрузок сканеров (CSV/NDJSON).
+"""
+import csv
+import json
+from collections import Counter, namedtuple
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import ValidationError
+
+from warehouse.bloom import marking_filter
+from warehouse.digest import find_by_digest
+from warehouse.models import Product, ProductMarking
+from warehouse.products import product_key, resolve_products
+from warehouse.rollups import INCOME, touch_documents
+from warehouse.stock import add_stock, adjust_stock
+
+# Размер чанка для IN (...) и bulk_create: с запасом ниже лимита параметров SQLite (999 в старых сборках).
+MARKING_CHUNK_SIZE = 500
+
+# Сколько конфликтных маркировок перечислять текстом (полные списки — в exists/duplicates).
+CONFLICT_MESSAGES_LIMIT = 10
+
+# Сколько конфликтных маркировок / номеров строк перечислять в ответе импорта (дальше — только счётчики).
+IMPORT_CONFLICTS_LIMIT = 100
+
+# Лёгкая ссылка на маркировку (без загрузки модели): для списания в расход.
+MarkingRef = namedtuple('MarkingRef', ('id', 'marking', 'outcome_id', 'product_id'))
+
+
+def chunked(iterable, size=MARKING_CHUNK_SIZE):
+    """Разбивает iterable на списки длиной не больше size."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def collect_markings(products_data):
+    """Все значения marking из payload прихода (products[].markings[].marking) в порядке следования."""
+    return [
+        marking_data.get('marking')
+        for product_data in products_data
+        for marking_data in product_data.get('markings', [])
+    ]
+
+
+def find_existing_markings(values, exclude_income=None):
+    """
+    Какие из values уже есть в базе. Один IN-запрос по marking_hash на чанк, строки сверяются после.
+    exclude_income — не считать маркировки этого прихода (при редактировании).
+    """
+    qs = ProductMarking.objects.all()
+    if exclude_income is not None:
+        qs = qs.exclude(income=exclude_income)
+    return {marking for marking, in find_by_digest(qs, values)}
+
+
+def find_marking_conflicts(values, exclude_income=None, known=frozenset()):
+    """
+    Конфликты набора маркировок (те же правила, что в check_markings_batch):
+    exists — уже есть в базе; duplicates — повторились внутри payload; empty — пустые значения.
+    known — маркировки, про которые уже известно, что они принадлежат документу (в базу за ними не ходим).
+    Списки в порядке первого появления в payload.
+    """
+    empty = sum(1 for v in values if v is None or not str(v).strip())
+    present = [v for v in values if v is not None and str(v).strip()]
+    counts = Counter(present)
+    duplicates = [m for m, c in counts.items() if c > 1]
+    existing = find_existing_markings(
+        (m for m in counts if m not in known), exclude_income=exclude_income
+    )
+    exists = [m for m in counts if m in existing]
+    return {'exists': exists, 'duplicates': duplicates, 'empty': empty}
+
+
+def raise_for_conflicts(conflicts):
+    """Одна ValidationError со всеми конфликтными маркировками (а не только с первой)."""
+    exists, duplicates, empty = conflicts['exists'], conflicts['duplicates'], conflicts['empty']
+    if not (exists or duplicates or empty):
+        return
+    messages = [f'Маркировка "{m}" уже существует.' for m in exists]
+    messages += [f'Маркировка "{m}" повторяется в документе.' for m in duplicates]
+    if empty:
+        messages.append(f'Пустых маркировок: {empty}.')
+    raise ValidationError({
+        'products': messages[:CONFLICT_MESSAGES_LIMIT],
+        'exists': exists,
+        'duplicates': duplicates,
+        'empty': empty,
+    })
+
+
+def bulk_create_markings(income, entries, exclude_income=None, stock_deltas=None):
+    """
+    Вставка маркировок прихода пачками. entries — список (product, markings_data).
+    Конфликт, появившийся между проверкой и вставкой (параллельный запрос), ловим через
+    IntegrityError и отдаём тем же структурированным ответом.
+    stock_deltas — уже накопленные изменения остатка {product_id: delta} (например, удалённые при
+    редактировании маркировки): применяются вместе с вставленными одним adjust_stock.
+    """
+    objs = (
+        ProductMarking(product=product, income=income, **marking_data)
+        for product, markings_data in entries
+        for marking_data in markings_data
+    )
+    created = 0
+    deltas = Counter(stock_deltas or {})
+    try:
+        with transaction.atomic():
+            for chunk in chunked(objs):
+                ProductMarking.objects.bulk_create(chunk)
+                deltas.update(obj.product_id for obj in chunk)
+                created += len(chunk)
+            adjust_stock(deltas)
+    except IntegrityError:
+        values = [m.get('marking') for _, markings_data in entries for m in markings_data]
+        raise_for_conflicts(find_marking_conflicts(values, exclude_income=exclude_income))
+        raise
+    touch_documents(INCOME, [income.id])
+    return created
+
+
+# --- Проверка маркировок (check_markings_batch) ---
+
+MarkingCheck = namedtuple('MarkingCheck', ('position', 'marking', 'exists', 'repeat'))
+
+
+def check_markings(values, chunk_size=MARKING_CHUNK_SIZE):
+    """
+    Проверка потока маркировок чанками: один запрос по marking_hash на чанк, сколько бы кодов ни прислали.
+    Генерирует MarkingCheck по каждой позиции: marking=None для пустой строки, exists — есть в базе,
+    repeat — значение уже встречалось раньше в этом потоке. В памяти — только множество уже увиденных кодов.
+    """
+    seen = set()
+    existing = set()
+    for chunk in chunked(enumerate(values), chunk_size):
+        chunk = [(position, str(v).strip() if v is not None else '') for position, v in chunk]
+        fresh = {m for _, m in chunk if m and m not in seen}
+        # Фильтр Блума отсекает точно новые коды без запроса; в базу — только «возможно есть».
+        _, maybe = marking_filter.partition(fresh)
+        found = {marking for marking, in find_by_digest(ProductMarking.objects.all(), maybe)}
+        marking_filter.record_false_positives(len(maybe) - len(found))
+        existing.update(found)
+        for position, marking in chunk:
+            if not marking:
+                yield MarkingCheck(position, None, False, False)
+                continue
+            repeat = marking in seen
+            seen.add(marking)
+            yield MarkingCheck(position, marking, marking in existing, repeat)
+
+
+def iter_plain_markings(lines):
+    """text/plain: одна маркировка на строку; пустая строка — пустая позиция, позиция i — строка i + 1."""
+    return _decode_lines(lines)
+
+
+def iter_ndjson_markings(lines):
+    """NDJSON для проверки: строка или объект {"marking": ...}; битая или пустая строка — пустая позиция."""
+    return ((row or {}).get('marking') for _, row in iter_ndjson_rows(lines, keep_blank=True))
+
+
+# --- Потоковый импорт (CSV / NDJSON) ---
+
+TRUE_VALUES = ('1', 'true', 'yes', 'да')
+
+
+def _parse_counter(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in TRUE_VALUES
+
+
+def _decode_lines(lines):
+    """Байтовые строки тела запроса → str без BOM и перевода строки."""
+    for raw in lines:
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8-sig')
+        yield raw.lstrip('\ufeff').rstrip('\r\n')
+
+
+def iter_csv_rows(lines):
+    """
+    CSV построчно: (номер_строки, {'marking', 'product', 'counter'}) либо (номер_строки, None) для битой строки.
+    Первая строка с колонкой marking считается заголовком, иначе колонки по порядку: marking[,product[,counter]].
+    """
+    columns = ('marking', 'product', 'counter')
+    for line_no, row in enumerate(csv.reader(_decode_lines(lines)), start=1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if line_no == 1 and 'marking' in (cell.strip().lower() for cell in row):
+            columns = tuple(cell.strip().lower() for cell in row)
+            continue
+        yield line_no, dict(zip(columns, (cell.strip() for cell in row)))
+
+
+def iter_ndjson_rows(lines, keep_blank=False):
+    """
+    NDJSON построчно: объект {"marking", "product", "counter"} или просто строка с маркировкой.
+    keep_blank — пустая строка даёт (номер_строки, None), а не пропускается (позиции проверки = номера строк).
+    """
+    for line_no, line in enumerate(_decode_lines(lines), start=1):
+        if not line.strip():
+            if keep_blank:
+                yield line_no, None
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            yield line_no, None
+            continue
+        if isinstance(value, str):
+            value = {'marking': value}
+        yield line_no, value if isinstance(value, dict) else None
+
+
+def _product_ref(row, default_product_id):
+    """Ссылка на товар строки импорта: ('id', 5) по колонке product, ('key', ...) по name/kpi/price, иначе None."""
+    product_id = row.get('product') or (None if row.get('name') else default_product_id)
+    if product_id:
+        try:
+            return ('id', int(product_id))
+        except (TypeError, ValueError):
+            return None
+    if row.get('name') and row.get('kpi') and row.get('price') not in (None, ''):
+        try:
+            return ('key', product_key(row['name'], row['kpi'], row['price']))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def _resolve_product_refs(refs, cache):
+    """Ссылки → id товара (None, если товара с таким id нет). Товары по name/kpi/price — через резолвер."""
+    unknown = refs - cache.keys()
+    ids = {value for kind, value in unknown if kind == 'id'}
+    if ids:
+        found = set(Product.objects.filter(id__in=ids).values_list('id', flat=True))
+        cache.update({('id', p): (p if p in found else None) for p in ids})
+    keys = [value for kind, value in unknown if kind == 'key']
+    if keys:
+        products = resolve_products([{'kpi': kpi, 'name': name, 'price': price} for kpi, name, price in keys])
+        cache.update({('key', key): product.id for key, product in zip(keys, products)})
+
+
+def _import_chunk(income, rows, default_product_id, product_cache):
+    """Один чанк импорта: валидация, проверка дубликатов (как в check_markings_batch), bulk_create."""
+    invalid = []
+    candidates = []
+    for line_no, row in rows:
+        row = row or {}
+        marking = str(row.get('marking') or '').strip()
+        ref = _product_ref(row, default_product_id)
+        if not marking or ref is None:
+            invalid.append(line_no)
+            continue
+        candidates.append((line_no, marking, ref, _parse_counter(row.get('counter'))))
+
+    _resolve_product_refs({ref for _, _, ref, _ in candidates}, product_cache)
+    invalid += [line_no for line_no, _, ref, _ in candidates if product_cache[ref] is None]
+    candidates = [
+        (line_no, marking, product_cache[ref], counter)
+        for line_no, marking, ref, counter in candidates
+        if product_cache[ref] is not None
+    ]
+
+    counts = Counter(marking for _, marking, _, _ in candidates)
+    duplicates = [m for m, c in counts.items() if c > 1]
+    existing = find_existing_markings(counts.keys())
+
+    seen = set()
+    objs = []
+    for _, marking, product_id, counter in candidates:
+        if marking in existing or marking in seen:
+            continue
+        seen.add(marking)
+        objs.append(ProductMarking(
+            marking=marking, counter=counter, product_id=product_id, income=income,
+        ))
+    while True:
+        try:
+            with transaction.atomic():
+                ProductMarking.objects.bulk_create(objs)
+                add_stock(obj.product_id for obj in objs)
+            break
+        except IntegrityError:
+            # Параллельная вставка между проверкой и записью: перечитываем и вставляем остаток, пока не пройдёт.
+            # Если новых совпадений нет — конфликт не по маркировке, повтор не поможет.
+            raced = find_existing_markings(seen) - existing
+            if not raced:
+                raise
+            existing |= raced
+            objs = [o for o in objs if o.marking not in existing]
+    touch_documents(INCOME, [income.id])
+
+    return {
+        'received': len(rows),
+        'created': len(objs),
+        'exists': [m for m in counts if m in existing],
+        'duplicates': duplicates,
+        'invalid': sorted(invalid),
+    }
+
+
+def import_markings(income, rows, default_product_id=None, chunk_size=MARKING_CHUNK_SIZE):
+    """
+    Импорт маркировок в приход из потока строк (iter_csv_rows / iter_ndjson_rows).
+    Читаем и пишем фиксированными чанками, каждый в своей транзакции, — в памяти только текущий чанк.
+    Повтор маркировки между чанками ловится как exists: предыдущий чанк уже в базе.
+    Генерирует результат по каждому чанку.
+    """
+    product_cache = {}
+    for index, chunk in enumerate(chunked(rows, chunk_size), start=1):
+        result = _import_chunk(income, chunk, default_product_id, product_cache)
+        result['chunk'] = index
+        yield result
+
+
+def summarize_import(chunks, limit=IMPORT_CONFLICTS_LIMIT):
+    """
+    Итог импорта по результатам import_markings: по чанкам — только счётчики, конфликты (exists, duplicates,
+    номера строк invalid) — первые limit на весь импорт и полные количества. Память не растёт с размером файла.
+    """
+    summary = {'received': 0, 'created': 0, 'chunks': [], 'truncated': False}
+    for name in ('exists', 'duplicates', 'invalid'):
+        summary[name], summary[f'{name}_count'] = [], 0
+    for result in chunks:
+        summary['received'] += result['received']
+        summary['created'] += result['created']
+        chunk = {'chunk': result['chunk'], 'received': result['received'], 'created': result['created']}
+        for name in ('exists', 'duplicates', 'invalid'):
+            values = result[name]
+            chunk[name] = len(values)
+            summary[f'{name}_count'] += len(values)
+            listed = summary[name]
+            listed += values[:limit - len(listed)]
+            summary['truncated'] |= summary[f'{name}_count'] > len(listed)
+        summary['chunks'].append(chunk)
+    return summary
@@ -0,0 +1,41 @@
+"""
+Пагинация списков: по умолчанию номера страниц (PageNumberPagination, как раньше),
+по запросу клиента — keyset/cursor без OFFSET и COUNT(*): ?pagination=cursor (первая страница),
+дальше — ссылки next/previous с ?cursor=...
+"""
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+def wants_cursor(request):
+    params = request.query_params
+    return 'cursor' in params or (params.get('pagination') or '').strip().lower() == 'cursor'
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Курсор по сортировке самого queryset (get_queryset вьюхи: -created_at,-id или -archived_at,-id для архива),
+    под неё заведены составные индексы. Если queryset не отсортирован — (-created_at, -id).
+    Позиция курсора — значение первого поля сортировки, поэтому оно не должно быть NULL: created_at — NOT NULL,
+    archived_at в архиве гарантирован CHECK-ограничением (миграция 0020).
+    """
+    ordering = ('-created_at', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        order_by = tuple(queryset.query.order_by)
+        return order_by or self.ordering
+
+
+class OptionalCursorPagination(PageNumberPagination):
+    """PageNumberPagination с опциональным переходом на KeysetCursorPagination для отдельного запроса."""
+    cursor_pagination_class = KeysetCursorPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = self.cursor_pagination_class() if wants_cursor(request) else None
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
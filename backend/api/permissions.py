@@ -1,11 +1,13 @@
 from rest_framework import permissions
 
+from .roles import ADMIN_ROLE, WRITE_ROLES, has_role
+
 
 class IsOperatorOrAdminOrReadOnly(permissions.BasePermission):
     """
     Разрешает create/update/delete только пользователям в группах admin или operator.
     Остальным — только чтение (GET, HEAD, OPTIONS).
-    Права проверяются по request.user.groups (из БД), не по токену.
+    Права проверяются по группам пользователя из БД (через кэш api.roles с коротким TTL), не по токену.
     """
 
     def has_permission(self, request, view):
@@ -15,7 +17,7 @@ class IsOperatorOrAdminOrReadOnly(permissions.BasePermission):
             return True
         if request.user.is_superuser:
             return True
-        return request.user.groups.filter(name__in=['admin', 'operator']).exists()
+        return has_role(request.user, *WRITE_ROLES)
 
 
 class IsPlatformAdmin(permissions.BasePermission):
@@ -29,4 +31,4 @@ class IsPlatformAdmin(permissions.BasePermission):
             return False
         if request.user.is_superuser:
             return True
-        return request.user.groups.filter(name='admin').exists()
+        return has_role(request.user, ADMIN_ROLE)
@@ -0,0 +1,62 @@
+"""
+Роли пользователя (группы Django + is_superuser) с кэшем через Django cache framework.
+Один помощник для permission-классов и токен-сериалайзеров: вместо groups.filter(...).exists() на каждый запрос —
+чтение из кэша, в базу не чаще раза в ROLES_CACHE_TTL секунд на пользователя.
+Кэш сбрасывается при изменении групп/is_active через Admin API (AdminUserUpdateSerializer).
+Без общего кэша (по умолчанию LocMemCache — свой в каждом процессе) другие процессы увидят изменение
+не позже чем через TTL, поэтому он короткий.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db.models import Model
+
+from warehouse.models import CustomUser
+
+ADMIN_ROLE = 'admin'
+OPERATOR_ROLE = 'operator'
+WRITE_ROLES = (ADMIN_ROLE, OPERATOR_ROLE)
+
+UserRoles = namedtuple('UserRoles', ('groups', 'is_superuser'))
+
+
+def roles_ttl():
+    return getattr(settings, 'ROLES_CACHE_TTL', 60)
+
+
+def _cache_key(user_id):
+    return f'api:roles:{user_id}'
+
+
+def _user_id(user):
+    return getattr(user, 'pk', user)
+
+
+def get_user_roles(user):
+    """UserRoles(groups=frozenset имён групп, is_superuser) для пользователя или его id."""
+    user_id = _user_id(user)
+    cached = cache.get(_cache_key(user_id))
+    if cached is None:
+        groups = sorted(Group.objects.filter(user__id=user_id).values_list('name', flat=True))
+        # type(), а не isinstance: ленивый ClaimsUser (api.authentication) не должен загружать модель.
+        if issubclass(type(user), Model):
+            is_superuser = bool(user.is_superuser)
+        else:
+            is_superuser = bool(
+                CustomUser.objects.filter(pk=user_id).values_list('is_superuser', flat=True).first()
+            )
+        cached = (groups, is_superuser)
+        cache.set(_cache_key(user_id), cached, roles_ttl())
+    return UserRoles(frozenset(cached[0]), cached[1])
+
+
+def has_role(user, *roles):
+    """Суперпользователь или член хотя бы одной из групп roles."""
+    user_roles = get_user_roles(user)
+    return user_roles.is_superuser or bool(user_roles.groups.intersection(roles))
+
+
+def invalidate_user_roles(user):
+    cache.delete(_cache_key(_user_id(user)))
@@ -1,4 +1,6 @@
 # serializers.py
+from collections import Counter
+
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.password_validation import validate_password
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
@@ -6,14 +8,23 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from django.db import transaction
 from django.contrib.auth import get_user_model
-from warehouse.models import Company, Product, ProductMarking, Income, Outcome, CustomUser
+from warehouse.models import Company, Product, ProductMarking, Income, Outcome, CustomUser, Job
+from warehouse.companies import resolve_company
+from warehouse.digest import find_by_digest
+from warehouse.products import normalize_product_fields, resolve_products
+from warehouse.stock import add_stock, remove_stock
+from .roles import invalidate_user_roles
+from .markings import (
+    CONFLICT_MESSAGES_LIMIT, MarkingRef,
+    chunked, collect_markings, find_marking_conflicts, raise_for_conflicts, bulk_create_markings,
+)
 
 
 def get_or_create_company(company_data):
     """
     Найти или создать компанию. Идентификатор — ИНН (если есть).
-    Иначе fallback на name+phone. Используем update_or_create по ИНН,
-    чтобы обновлять имя/телефон при изменении, а не плодить дубликаты.
+    Иначе fallback на name+phone. По ИНН — resolve_company: обновляет имя/телефон
+    только при изменении (без лишней записи) и не плодит дубликаты.
     Если передан уже объект Company (из CompanyField), возвращаем как есть.
     """
     if isinstance(company_data, Company):
@@ -22,10 +33,7 @@ def get_or_create_company(company_data):
     name = (company_data.get("name") or "").strip()
     phone = (company_data.get("phone") or "").strip()
     if inn:
-        company, _ = Company.objects.update_or_create(
-            inn=inn,
-            defaults={"name": name, "phone": phone},
-        )
+        company = resolve_company(inn, name, phone)
     else:
         company, _ = Company.objects.get_or_create(
             name=name,
@@ -35,6 +43,14 @@ def get_or_create_company(company_data):
     return company
 
 
+def resolve_payload_products(products_data):
+    """Товары прихода одним резолвером (warehouse.products) вместо get_or_create на каждую строку."""
+    try:
+        return resolve_products(products_data)
+    except (TypeError, ValueError) as e:
+        raise ValidationError({'products': ['Некорректная цена товара.']}) from e
+
+
 class CompanyField(serializers.Field):
     """
     Принимает компанию либо по id (выбор из списка), либо как вложенный объект (новая компания).
@@ -108,6 +124,8 @@ class AdminUserUpdateSerializer(serializers.ModelSerializer):
         instance.save()
         if groups is not None:
             instance.groups.set(groups)
+        if groups is not None or 'is_active' in validated_data:
+            invalidate_user_roles(instance)
         return instance
 
 
@@ -124,16 +142,24 @@ class CompanySerializer(serializers.ModelSerializer):
 
 
 class ProductSerializer(serializers.ModelSerializer):
-    """stock — из annotate в ProductViewSet; у нового продукта атрибута нет, возвращаем 0."""
+    """
+    stock — денормализованный остаток Product.quantity (свободные маркировки, см. warehouse.stock).
+    quantity ведётся сервером, поэтому только для чтения.
+    """
 
     stock = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
         fields = '__all__'
+        read_only_fields = ('quantity',)
+
+    def to_internal_value(self, data):
+        # Ключ — в том виде, в каком его сохранит Product.save(): проверка уникальности идёт по нему.
+        return normalize_product_fields(super().to_internal_value(data))
 
     def get_stock(self, obj):
-        return getattr(obj, 'stock', 0)
+        return obj.quantity or 0
 
 
 class ProductSelectSerializer(serializers.ModelSerializer):
@@ -147,6 +173,11 @@ class ProductSelectSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'kpi', 'price')
 
 
+def with_marking_relations(queryset):
+    """То, что читает ProductMarkingSerializer (product.*, income.unit_of_measure), — одним JOIN."""
+    return queryset.select_related('product', 'income')
+
+
 class ProductMarkingSerializer(serializers.ModelSerializer):
     product_name = serializers.SerializerMethodField()
     product_kpi = serializers.SerializerMethodField()
@@ -185,7 +216,11 @@ class IncomeSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def get_product_markings(self, obj):
-        product_markings = ProductMarking.objects.filter(income=obj)
+        # IncomeViewSet prefetch'ит маркировки с товаром (income у маркировки Django проставляет сам) —
+        # без запросов на маркировку. Без prefetch (ответ create/update) — один запрос с товаром.
+        product_markings = obj.income.all()
+        if 'income' not in getattr(obj, '_prefetched_objects_cache', {}):
+            product_markings = product_markings.select_related('product')
         return ProductMarkingSerializer(product_markings, many=True).data
 
     @transaction.atomic
@@ -198,21 +233,19 @@ class IncomeSerializer(serializers.ModelSerializer):
         if not user.is_authenticated:
             raise ValidationError("Пользователь должен быть аутентифицирован для создания записи.")
 
+        # Все конфликты (уже в базе / повторы в payload) проверяем заранее чанками IN,
+        # до записи прихода, и отдаём одной ошибкой со всеми маркировками.
+        raise_for_conflicts(find_marking_conflicts(collect_markings(products_data)))
+
         company = get_or_create_company(company_data)
         income = Income.objects.create(from_company=company, added_by=user, **validated_data)
 
-        for product_data in products_data:
-            markings_data = product_data.pop('markings', [])
-
-            product, created = Product.objects.get_or_create(**product_data)
-
-            for marking_data in markings_data:
-                marking_value = marking_data.get('marking')
-
-                if ProductMarking.objects.filter(marking=marking_value).exists():
-                    raise ValidationError(f'Маркировка "{marking_value}" уже существует.')
-
-                ProductMarking.objects.create(product=product, income=income, **marking_data)
+        products = resolve_payload_products(products_data)
+        entries = [
+            (product, product_data.get('markings', []))
+            for product, product_data in zip(products, products_data)
+        ]
+        bulk_create_markings(income, entries)
 
         return income
 
@@ -237,41 +270,94 @@ class IncomeSerializer(serializers.ModelSerializer):
         instance.save()
 
         if products_data:
-            existing_markings = set(ProductMarking.objects.filter(income=instance).values_list('marking', flat=True))
-            new_markings = {marking['marking'] for product in products_data for marking in product.get('markings', [])}
+            self._reconcile_markings(instance, products_data)
 
-            markings_to_delete = existing_markings - new_markings
-            if markings_to_delete:
-                to_delete_qs = ProductMarking.objects.filter(income=instance, marking__in=markings_to_delete)
-                if to_delete_qs.filter(outcome__isnull=False).exists():
-                    raise ValidationError({
-                        'products': ['Нельзя удалить или убрать из документа списанные маркировки.']
-                    })
-                to_delete_qs.delete()
+        return instance
 
-            for product_data in products_data:
-                markings_data = product_data.pop('markings', [])
+    def _reconcile_markings(self, income, products_data):
+        """
+        Синхронизация маркировок прихода по множествам: текущие маркировки читаем одним запросом,
+        added/removed/unchanged считаем в памяти, удаляем одним bulk delete, добавляем bulk_create.
+        Неизменённые маркировки не трогаем (и за ними не ходим в базу).
+        """
+        current = {
+            marking: (marking_id, outcome_id, product_id)
+            for marking_id, marking, outcome_id, product_id in ProductMarking.objects.filter(income=income)
+            .values_list('id', 'marking', 'outcome_id', 'product_id')
+        }
+        values = collect_markings(products_data)
+        incoming = set(values)
+
+        removed = [current[m] for m in current.keys() - incoming]
+        if any(outcome_id is not None for _, outcome_id, _ in removed):
+            raise ValidationError({
+                'products': ['Нельзя удалить или убрать из документа списанные маркировки.']
+            })
+        raise_for_conflicts(find_marking_conflicts(values, exclude_income=income, known=current.keys()))
 
-                product, created = Product.objects.get_or_create(**product_data)
+        for chunk in chunked([marking_id for marking_id, _, _ in removed]):
+            ProductMarking.objects.filter(income=income, id__in=chunk).delete()
+        # Удаляются только свободные маркировки (списанные отсеяны выше) — все они были в остатке.
+        # Остаток правим одним разом вместе с добавленными: исправление опечатки не меняет его вовсе.
+        removed_stock = Counter()
+        removed_stock.subtract(product_id for _, _, product_id in removed)
 
-                for marking_data in markings_data:
-                    marking_value = marking_data.get('marking')
-                    # Уже есть на этом приходе (оставили в списке) — не создаём повторно
-                    if ProductMarking.objects.filter(marking=marking_value, income=instance).exists():
-                        continue
-                    if ProductMarking.objects.filter(marking=marking_value).exists():
-                        raise ValidationError(f'Маркировка "{marking_value}" уже существует.')
+        entries = []
+        for product, product_data in zip(resolve_payload_products(products_data), products_data):
+            added = [m for m in product_data.get('markings', []) if m.get('marking') not in current]
+            if added:
+                entries.append((product, added))
+        bulk_create_markings(income, entries, exclude_income=income, stock_deltas=removed_stock)
 
-                    ProductMarking.objects.create(product=product, income=instance, **marking_data)
 
-        return instance
+class MarkingRefsField(serializers.Field):
+    """
+    Маркировки расхода: id (число) или сама строка маркировки, можно вперемешку.
+    Резолвятся чанками IN-запросов за один проход (а не SELECT на каждый id, как у PrimaryKeyRelatedField).
+    Возвращает список MarkingRef без повторов, в порядке запроса.
+    """
+    default_error_messages = {
+        'not_a_list': 'Ожидается список id или строк маркировок.',
+        'invalid': 'Некорректная маркировка: {value}.',
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            self.fail('not_a_list')
+        ids, markings = [], []
+        for value in data:
+            if isinstance(value, int) and not isinstance(value, bool):
+                ids.append(value)
+            elif isinstance(value, str) and value.strip():
+                markings.append(value.strip())
+            else:
+                self.fail('invalid', value=value)
+
+        by_id, by_marking = {}, {}
+        fields = ('id', 'marking', 'outcome_id', 'product_id')
+        for chunk in chunked(set(ids)):
+            for row in ProductMarking.objects.filter(id__in=chunk).values_list(*fields):
+                by_id[row[0]] = MarkingRef(*row)
+        for row in find_by_digest(ProductMarking.objects.all(), markings, fields=fields):
+            by_marking[row[1]] = MarkingRef(*row)
+
+        missing = [str(v) for v in ids if v not in by_id] + [v for v in markings if v not in by_marking]
+        if missing:
+            raise ValidationError([f'Маркировка не найдена: {m}' for m in missing[:CONFLICT_MESSAGES_LIMIT]])
+
+        resolved = {}
+        for value in data:
+            ref = by_id[value] if isinstance(value, int) else by_marking[value.strip()]
+            resolved.setdefault(ref.id, ref)
+        return list(resolved.values())
+
+    def to_representation(self, value):
+        return [ref.id for ref in value]
 
 
 class OutcomeSerializer(serializers.ModelSerializer):
     to_company = CompanyField()
-    product_markings = serializers.PrimaryKeyRelatedField(
-        many=True, queryset=ProductMarking.objects.all(), write_only=True
-    )
+    product_markings = MarkingRefsField(write_only=True)
     added_by = serializers.StringRelatedField(read_only=True)  # Display the user's name
 
     def get_fields(self):
@@ -323,20 +409,33 @@ class OutcomeSerializer(serializers.ModelSerializer):
         company = get_or_create_company(company_data)
         outcome = Outcome.objects.create(to_company=company, added_by=user, **validated_data)
 
-        # Защита от гонок: атомарный UPDATE только по маркировкам с outcome__isnull=True;
-        # при параллельных запросах один получит updated < len → 400 + список конфликтных маркировок.
-        marking_ids = [m.id for m in product_markings_data]
-        updated = ProductMarking.objects.filter(
-            id__in=marking_ids, outcome__isnull=True
-        ).update(outcome=outcome)
+        self._attach_markings(outcome, product_markings_data)
+
+        return outcome
+
+    def _attach_markings(self, outcome, refs):
+        """
+        Защита от гонок: атомарный UPDATE (чанками) только по маркировкам с outcome__isnull=True;
+        при параллельных запросах один получит updated < len → 400 + список конфликтных маркировок.
+        refs — MarkingRef; после успешной привязки списанные маркировки снимаются с остатка товаров.
+        """
+        marking_ids = [ref.id for ref in refs]
+        updated = 0
+        for chunk in chunked(marking_ids):
+            updated += ProductMarking.objects.filter(
+                id__in=chunk, outcome__isnull=True
+            ).update(outcome=outcome)
         if updated != len(marking_ids):
-            not_attached = ProductMarking.objects.filter(id__in=marking_ids).exclude(outcome=outcome)
-            conflicting = list(not_attached.values_list('marking', flat=True))[:10]
+            conflicting = []
+            for chunk in chunked(marking_ids):
+                not_attached = ProductMarking.objects.filter(id__in=chunk).exclude(outcome=outcome)
+                conflicting += not_attached.values_list('marking', flat=True)
+                if len(conflicting) >= CONFLICT_MESSAGES_LIMIT:
+                    break
             raise ValidationError({
-                'product_markings': [f'Маркировка уже списана: {m}' for m in conflicting]
+                'product_markings': [f'Маркировка уже списана: {m}' for m in conflicting[:CONFLICT_MESSAGES_LIMIT]]
             })
-
-        return outcome
+        remove_stock(ref.product_id for ref in refs)
 
     @transaction.atomic
     def update(self, instance, validated_data):
@@ -362,34 +461,85 @@ class OutcomeSerializer(serializers.ModelSerializer):
         # current_ids = уже привязано; new_ids = пришло с фронта; привязываем to_attach только при outcome__isnull=True.
         if product_markings_data is not None and not instance.is_archive:
             self._validate_markings_not_already_written_off(product_markings_data, instance=instance)
-            current_ids = set(
-                instance.product_markings.values_list('id', flat=True)
-            )
+            current = dict(instance.product_markings.values_list('id', 'product_id'))
             new_ids = set(m.id for m in product_markings_data)
-            to_detach = current_ids - new_ids
-            to_attach = new_ids - current_ids
+            to_detach = current.keys() - new_ids
+            to_attach = [m for m in product_markings_data if m.id not in current]
 
-            if to_detach:
-                ProductMarking.objects.filter(
-                    id__in=to_detach, outcome=instance
+            detached = 0
+            for chunk in chunked(to_detach):
+                detached += ProductMarking.objects.filter(
+                    id__in=chunk, outcome=instance
                 ).update(outcome=None)
+            if detached:
+                add_stock(current[marking_id] for marking_id in to_detach)
 
             if to_attach:
-                updated = ProductMarking.objects.filter(
-                    id__in=to_attach, outcome__isnull=True
-                ).update(outcome=instance)
-                if updated != len(to_attach):
-                    not_attached = ProductMarking.objects.filter(
-                        id__in=to_attach
-                    ).exclude(outcome=instance)
-                    conflicting = list(not_attached.values_list('marking', flat=True))[:10]
-                    raise ValidationError({
-                        'product_markings': [f'Маркировка уже списана: {m}' for m in conflicting]
-                    })
+                self._attach_markings(instance, to_attach)
 
         return instance
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        representation['product_markings'] = ProductMarkingSerializer(instance.product_markings.all(), many=True).data
+        # Из prefetch (OutcomeViewSet: Prefetch + select_related) — без запросов на маркировку;
+        # после create/update кэша нет — один запрос сразу с товаром и приходом.
+        markings = instance.product_markings.all()
+        if 'product_markings' not in getattr(instance, '_prefetched_objects_cache', {}):
+            markings = with_marking_relations(markings)
+        representation['product_markings'] = ProductMarkingSerializer(markings, many=True).data
         return representation
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """Статус фоновой задачи для опроса клиентом (GET /jobs/<id>/)."""
+
+    class Meta:
+        model = Job
+        fields = (
+            'id', 'kind', 'status', 'progress_done', 'progress_total',
+            'result', 'error', 'created_at', 'started_at', 'finished_at',
+        )
+        read_only_fields = fields
+
+
+class DocumentSummarySerializer(serializers.ModelSerializer):
+    """
+    Краткий вид документа для списков (?view=summary): шапка + количество маркировок по товарам.
+    Счётчики считает SQL (annotate(Count) по странице) и передаёт в context['product_counts'] —
+    сами маркировки не загружаются и не отдаются.
+    """
+    added_by = serializers.StringRelatedField()
+    markings_count = serializers.SerializerMethodField()
+    products = serializers.SerializerMethodField()
+
+    def get_products(self, obj):
+        return self.context.get('product_counts', {}).get(obj.id, [])
+
+    def get_markings_count(self, obj):
+        return sum(row['count'] for row in self.get_products(obj))
+
+
+class IncomeSummarySerializer(DocumentSummarySerializer):
+    from_company = CompanyField(read_only=True)
+
+    class Meta:
+        model = Income
+        fields = (
+            'id', 'added_by', 'from_company', 'contract_date', 'contract_number',
+            'invoice_date', 'invoice_number', 'unit_of_measure', 'total', 'is_archive',
+            'created_at', 'updated_at', 'archived_at', 'archived_by',
+            'markings_count', 'products',
+        )
+
+
+class OutcomeSummarySerializer(DocumentSummarySerializer):
+    to_company = CompanyField(read_only=True)
+
+    class Meta:
+        model = Outcome
+        fields = (
+            'id', 'added_by', 'to_company', 'contract_date', 'contract_number',
+            'invoice_date', 'invoice_number', 'unit_of_measure', 'total', 'is_archive',
+            'created_at', 'updated_at', 'archived_at', 'archived_by',
+            'markings_count', 'products',
+        )
@@ -0,0 +1,43 @@
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from warehouse.models import CustomUser
+
+from .authentication import ACTIVE_USERS_KEY, invalidate_active_users
+from .roles import invalidate_user_roles
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_roles_on_user_change(sender, instance, **kwargs):
+    # is_superuser/is_active через админку Django или shell; AdminUserUpdateSerializer сбрасывает кэш сам.
+    invalidate_user_roles(instance)
+
+
+@receiver(post_save, sender=CustomUser)
+def update_active_users_on_save(sender, instance, **kwargs):
+    # Отключили, включили или создали пользователя — множество активных id stateless-аутентификации перечитается.
+    active = cache.get(ACTIVE_USERS_KEY)
+    if active is not None and (instance.pk in active) != instance.is_active:
+        invalidate_active_users()
+
+
+@receiver(post_delete, sender=CustomUser)
+def update_active_users_on_delete(sender, instance, **kwargs):
+    invalidate_active_users()
+
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+def invalidate_roles_on_groups_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_user_roles(instance)
+    elif pk_set:
+        # group.user_set.add(...) — меняются роли перечисленных пользователей.
+        for user_id in pk_set:
+            invalidate_user_roles(user_id)
+    elif action == 'pre_clear':
+        for user_id in instance.user_set.values_list('id', flat=True):
+            invalidate_user_roles(user_id)
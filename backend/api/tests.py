@@ -1,11 +1,18 @@
 """
 Мини-тесты правил: viewer/operator, двойное списание, удаление только после архива, stock.
 """
-from django.test import TestCase
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth.models import Group
 from django.db.models import Count, Q
 from rest_framework.test import APIClient
 from rest_framework import status
+from api.pagination import KeysetCursorPagination
+from warehouse.archive import set_archived
 from warehouse.models import CustomUser, Company, Product, ProductMarking, Income, Outcome
 
 
@@ -529,3 +536,1819 @@ class TokenRefreshContractTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('access', response.data)
         self.assertTrue(response.data['access'], 'must return new access token')
+
+
+class IncomeBulkCreateTest(TestCase):
+    """Создание прихода: конфликты проверяются пачкой, маркировки вставляются bulk_create."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_bulk_income', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.product = Product.objects.create(name='P', price=1.0, kpi='k')
+        self.income = Income.objects.create(
+            from_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='I0',
+            invoice_date='2024-01-01',
+            invoice_number='I0',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        ProductMarking.objects.create(marking='EXISTING-1', income=self.income, product=self.product)
+
+    def _payload(self, markings):
+        return {
+            'from_company': {'name': 'Co', 'phone': '1', 'inn': '1'},
+            'contract_date': '2024-02-01',
+            'contract_number': 'I1',
+            'invoice_date': '2024-02-01',
+            'invoice_number': 'I1',
+            'unit_of_measure': 'шт',
+            'total': 10.0,
+            'products': [{'name': 'P', 'price': 1.0, 'kpi': 'k', 'markings': [{'marking': m} for m in markings]}],
+        }
+
+    def test_all_conflicts_reported_and_nothing_created(self):
+        payload = self._payload(['NEW-1', 'EXISTING-1', 'NEW-2', 'NEW-2', 'NEW-3'])
+        response = self.client.post('/api/v1/incomes/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        details = response.data['error']['details']
+        self.assertEqual(details['exists'], ['EXISTING-1'])
+        self.assertEqual(details['duplicates'], ['NEW-2'])
+        self.assertFalse(Income.objects.filter(contract_number='I1').exists())
+        self.assertFalse(ProductMarking.objects.filter(marking='NEW-1').exists())
+
+    def _save(self, payload):
+        from types import SimpleNamespace
+        from api.serializers import IncomeSerializer
+
+        serializer = IncomeSerializer(data=payload, context={'request': SimpleNamespace(user=self.operator)})
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    def test_query_count_does_not_grow_with_markings(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as small:
+            self._save(self._payload([f'S-{i}' for i in range(5)]))
+        payload = self._payload([f'L-{i}' for i in range(400)])
+        payload['contract_number'] = 'I2'
+        with CaptureQueriesContext(connection) as large:
+            self._save(payload)
+        self.assertEqual(ProductMarking.objects.filter(marking__startswith='L-').count(), 400)
+        # bulk_create режет пачку по лимиту параметров SQLite — несколько INSERT, но не 400.
+        self.assertLess(len(large.captured_queries), len(small.captured_queries) + 5)
+
+
+class IncomeReconcileUpdateTest(TestCase):
+    """PUT прихода: маркировки синхронизируются по множествам, число запросов не зависит от размера документа."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_reconcile', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.product = Product.objects.create(name='P', price=1.0, kpi='k')
+        self.income = Income.objects.create(
+            from_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking=f'R-{i}', income=self.income, product=self.product) for i in range(300)
+        ])
+
+    def _update(self, markings):
+        from types import SimpleNamespace
+        from api.serializers import IncomeSerializer
+
+        payload = {
+            'products': [{'name': 'P', 'price': 1.0, 'kpi': 'k', 'markings': [{'marking': m} for m in markings]}],
+        }
+        serializer = IncomeSerializer(
+            self.income, data=payload, partial=True,
+            context={'request': SimpleNamespace(user=self.operator)},
+        )
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    def test_fix_one_typo_costs_constant_queries(self):
+        markings = [f'R-{i}' for i in range(300)]
+        markings[7] = 'R-7-FIXED'
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            self._update(markings)
+        self.assertLessEqual(len(ctx.captured_queries), 12)
+        current = set(ProductMarking.objects.filter(income=self.income).values_list('marking', flat=True))
+        self.assertIn('R-7-FIXED', current)
+        self.assertNotIn('R-7', current)
+        self.assertEqual(len(current), 300)
+
+    def test_removing_written_off_marking_fails(self):
+        outcome = Outcome.objects.create(
+            to_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='O1',
+            invoice_date='2024-01-01',
+            invoice_number='O1',
+            unit_of_measure='шт',
+            total=1.0,
+        )
+        ProductMarking.objects.filter(marking='R-0').update(outcome=outcome)
+        from rest_framework.exceptions import ValidationError
+        with self.assertRaises(ValidationError):
+            self._update([f'R-{i}' for i in range(1, 300)])
+        self.assertEqual(ProductMarking.objects.filter(income=self.income).count(), 300)
+
+
+class MarkingImportTest(TestCase):
+    """Потоковый импорт маркировок в приход (CSV / NDJSON): счётчики по чанкам, конфликты — с ограничением списка."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_import', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.product = Product.objects.create(name='P', price=1.0, kpi='k')
+        self.income = Income.objects.create(
+            from_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        ProductMarking.objects.create(marking='OLD-1', income=self.income, product=self.product)
+        self.url = f'/api/v1/incomes/{self.income.id}/markings/import/'
+
+    def test_csv_import(self):
+        body = f'marking,product,counter\nC-1,{self.product.id},1\nC-2,{self.product.id},0\nOLD-1,{self.product.id},0\nC-1,{self.product.id},0\n,{self.product.id},0\n'
+        response = self.client.post(self.url, data=body.encode(), content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['exists'], ['OLD-1'])
+        self.assertEqual(response.data['duplicates'], ['C-1'])
+        self.assertEqual(response.data['invalid'], [6])
+        self.assertFalse(response.data['truncated'])
+        self.assertEqual(response.data['chunks'], [
+            {'chunk': 1, 'received': 5, 'created': 2, 'exists': 1, 'duplicates': 1, 'invalid': 1},
+        ])
+        self.assertTrue(ProductMarking.objects.get(marking='C-1').counter)
+
+    def test_ndjson_import_with_default_product(self):
+        body = '"N-1"\n{"marking": "N-2", "counter": true}\nnot-json\n'
+        response = self.client.post(
+            f'{self.url}?product={self.product.id}', data=body.encode(), content_type='application/x-ndjson',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['invalid'], [3])
+        self.assertEqual(ProductMarking.objects.filter(income=self.income, product=self.product).count(), 3)
+
+    def test_duplicates_across_chunks_reported_as_exists(self):
+        from api.markings import import_markings
+
+        rows = [(i, {'marking': m}) for i, m in enumerate(['X-1', 'X-2', 'X-3', 'X-1'], start=1)]
+        chunks = list(import_markings(self.income, rows, default_product_id=self.product.id, chunk_size=2))
+        self.assertEqual([c['created'] for c in chunks], [2, 1])
+        self.assertEqual(chunks[1]['exists'], ['X-1'])
+
+    def test_repeated_insert_race_reported_as_exists(self):
+        from api import markings
+        from api.markings import import_markings
+
+        ProductMarking.objects.create(marking='R-1', income=self.income, product=self.product)
+        real = markings.find_existing_markings
+        calls = []
+
+        def racing(values, *args, **kwargs):
+            # 1-й вызов — проверка до вставки (R-1 «ещё нет»); после 1-го повтора другой запрос вставляет R-2.
+            calls.append(1)
+            if len(calls) == 1:
+                return set()
+            found = real(values, *args, **kwargs)
+            if len(calls) == 2:
+                ProductMarking.objects.create(marking='R-2', income=self.income, product=self.product)
+            return found
+
+        rows = [(i, {'marking': m}) for i, m in enumerate(['R-1', 'R-2', 'R-3'], start=1)]
+        with mock.patch('api.markings.find_existing_markings', racing):
+            [chunk] = import_markings(self.income, rows, default_product_id=self.product.id)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(chunk['created'], 1)
+        self.assertEqual(chunk['exists'], ['R-1', 'R-2'])
+        self.assertEqual(ProductMarking.objects.filter(marking__startswith='R-').count(), 3)
+
+    def test_conflict_lists_are_capped(self):
+        from api.markings import import_markings, summarize_import
+
+        rows = [(i, {'marking': f'DUP-{i}'}) for i in range(1, 8)]
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking=m['marking'], income=self.income, product=self.product) for _, m in rows
+        ])
+        chunks = import_markings(self.income, rows, default_product_id=self.product.id, chunk_size=3)
+        summary = summarize_import(chunks, limit=4)
+        self.assertEqual(summary['exists'], ['DUP-1', 'DUP-2', 'DUP-3', 'DUP-4'])
+        self.assertEqual(summary['exists_count'], 7)
+        self.assertTrue(summary['truncated'])
+        self.assertEqual([c['exists'] for c in summary['chunks']], [3, 3, 1])
+
+    def test_archived_income_rejected(self):
+        set_archived(Income, [self.income.id], True)
+        response = self.client.post(self.url, data=b'A-1\n', content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error']['code'], 'ARCHIVED')
+
+
+class AsyncJobTest(TestCase):
+    """?async=1: POST возвращает 202 и id задачи; run_jobs выполняет задачу; GET /jobs/<id>/ отдаёт прогресс."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_jobs', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+
+    def _payload(self, markings):
+        return {
+            'from_company': {'name': 'Co', 'phone': '1', 'inn': '1'},
+            'contract_date': '2024-02-01',
+            'contract_number': 'J1',
+            'invoice_date': '2024-02-01',
+            'invoice_number': 'J1',
+            'unit_of_measure': 'шт',
+            'total': 10.0,
+            'products': [{'name': 'P', 'price': 1.0, 'kpi': 'k', 'markings': [{'marking': m} for m in markings]}],
+        }
+
+    def test_async_income_create(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        response = self.client.post('/api/v1/incomes/?async=1', self._payload(['J-1', 'J-2']), format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = response.data['id']
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertFalse(Income.objects.filter(contract_number='J1').exists())
+
+        call_command('run_jobs', '--once', stdout=StringIO())
+
+        response = self.client.get(f'/api/v1/jobs/{job_id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'done')
+        self.assertEqual((response.data['progress_done'], response.data['progress_total']), (2, 2))
+        income = Income.objects.get(id=response.data['result']['id'])
+        self.assertEqual(income.added_by, self.operator)
+        self.assertEqual(ProductMarking.objects.filter(income=income).count(), 2)
+
+    def test_failed_job_keeps_validation_details(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        self.client.post('/api/v1/incomes/?async=1', self._payload(['D-1']), format='json')
+        payload = self._payload(['D-1'])
+        payload['contract_number'] = 'J2'
+        response = self.client.post('/api/v1/incomes/?async=1', payload, format='json')
+        call_command('run_jobs', '--once', stdout=StringIO())
+        response = self.client.get(f'/api/v1/jobs/{response.data["id"]}/')
+        self.assertEqual(response.data['status'], 'failed')
+        self.assertEqual(response.data['result']['error']['exists'], ['D-1'])
+
+    def test_progress_total_known_at_enqueue(self):
+        from warehouse.models import Job
+
+        response = self.client.post('/api/v1/incomes/?async=1', self._payload(['P-1', 'P-2', 'P-3']), format='json')
+        job = Job.objects.get(id=response.data['id'])
+        self.assertEqual((job.progress_done, job.progress_total), (0, 3))
+
+    def test_reclaimed_job_discards_its_writes(self):
+        from django.db.models import F
+        from warehouse.jobs import claim_next, run_job
+        from warehouse.models import Job
+
+        response = self.client.post('/api/v1/incomes/?async=1', self._payload(['L-1']), format='json')
+        job = claim_next()
+        # Пока воркер выполнял задачу, её вернули в очередь и захватил другой воркер.
+        Job.objects.filter(id=job.id).update(attempt=F('attempt') + 1)
+        run_job(job)
+        self.assertFalse(Income.objects.filter(contract_number='J1').exists())
+        self.assertFalse(ProductMarking.objects.filter(marking='L-1').exists())
+        stored = Job.objects.get(id=response.data['id'])
+        self.assertEqual((stored.status, stored.attempt), (Job.STATUS_RUNNING, 2))
+
+    def test_stale_running_job_is_reclaimed(self):
+        from datetime import timedelta
+
+        from django.core.management import call_command
+        from django.utils import timezone
+        from warehouse.models import Job
+
+        response = self.client.post('/api/v1/incomes/?async=1', self._payload(['S-1']), format='json')
+        # Долгая задача с живым пульсом: время старта не важно.
+        Job.objects.filter(id=response.data['id']).update(
+            status=Job.STATUS_RUNNING, started_at=timezone.now() - timedelta(hours=1), heartbeat_at=timezone.now(),
+        )
+        call_command('run_jobs', '--once', '--stale-after', '60', stdout=StringIO())
+        self.assertEqual(Job.objects.get(id=response.data['id']).status, Job.STATUS_RUNNING)
+        # Воркер упал: пульса нет дольше --stale-after.
+        Job.objects.filter(id=response.data['id']).update(heartbeat_at=timezone.now() - timedelta(minutes=10))
+        out = StringIO()
+        call_command('run_jobs', '--once', '--stale-after', '60', stdout=out)
+        self.assertIn('Возвращено в очередь', out.getvalue())
+        job = Job.objects.get(id=response.data['id'])
+        self.assertEqual((job.status, job.attempt), (Job.STATUS_DONE, 1))
+        self.assertEqual(Income.objects.filter(contract_number='J1').count(), 1)
+
+    def test_other_users_jobs_hidden(self):
+        from warehouse.jobs import enqueue
+
+        other = create_user('operator_jobs_other', 'pass', 'operator')
+        job = enqueue('income_create', {}, user=other)
+        response = self.client.get(f'/api/v1/jobs/{job.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ProductResolverTest(TestCase):
+    """Резолвер товаров: один запрос на пачку, недостающие — bulk_create, float-цена не плодит дубликаты."""
+
+    def test_resolve_existing_and_missing(self):
+        from warehouse.products import resolve_products
+
+        existing = Product.objects.create(name='P', price=1.1, kpi='k')
+        data = [
+            {'name': 'P', 'kpi': 'k', 'price': 1.1000000001},
+            {'name': 'Q', 'kpi': 'k', 'price': '2.5'},
+            {'name': 'Q', 'kpi': 'k', 'price': 2.5},
+        ]
+        # Поиск и вставка (+ SAVEPOINT/RELEASE вокруг вставки — на случай гонки).
+        with self.assertNumQueries(4):
+            products = resolve_products(data)
+        self.assertEqual(products[0].id, existing.id)
+        self.assertIsNotNone(products[1].id)
+        self.assertEqual(products[1].id, products[2].id)
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_concurrent_create_reuses_existing_product(self):
+        from warehouse import products as resolver
+
+        # Параллельный запрос создал товар между поиском и вставкой: поиск его «не видит».
+        existing = Product.objects.create(name=' R ', price=4.0000001, kpi='k')
+        self.assertEqual((existing.name, existing.price), ('R', 4.0))
+        calls = []
+
+        def find_products(keys):
+            calls.append(keys)
+            return {} if len(calls) == 1 else real_find(keys)
+
+        real_find = resolver.find_products
+        data = [{'name': 'R', 'kpi': 'k', 'price': 4}, {'name': 'S', 'kpi': 'k', 'price': 1}]
+        with mock.patch.object(resolver, 'find_products', find_products):
+            products = resolver.resolve_products(data)
+        self.assertEqual(products[0].id, existing.id)
+        self.assertEqual(Product.objects.filter(name='R').count(), 1)
+        self.assertEqual(Product.objects.filter(name='S').count(), 1)
+
+    def test_api_rejects_duplicate_after_normalization(self):
+        Group.objects.get_or_create(name='operator')
+        client = APIClient()
+        client.force_authenticate(user=create_user('operator_product_key', 'pass', 'operator'))
+        Product.objects.create(name='T', price=1.1, kpi='k')
+        response = client.post('/api/v1/products/', {'name': 'T ', 'kpi': 'k', 'price': 1.1000000001}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Product.objects.filter(name='T').count(), 1)
+
+    def test_import_resolves_products_by_name(self):
+        Group.objects.get_or_create(name='operator')
+        client = APIClient()
+        client.force_authenticate(user=create_user('operator_resolver', 'pass', 'operator'))
+        company = Company.objects.create(name='Co', phone='1', inn='1')
+        income = Income.objects.create(
+            from_company=company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        body = 'marking,name,kpi,price\nZ-1,New,kz,3\nZ-2,New,kz,3.0\n'
+        response = client.post(
+            f'/api/v1/incomes/{income.id}/markings/import/', data=body.encode(), content_type='text/csv',
+        )
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(Product.objects.filter(name='New').count(), 1)
+
+
+class CompanyResolverTest(TestCase):
+    """Компания по ИНН: без изменений — одно чтение по индексу, без UPDATE."""
+
+    def test_unchanged_company_is_not_written(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from warehouse.companies import resolve_company
+
+        company = resolve_company('777', 'Co', '1')
+        with CaptureQueriesContext(connection) as ctx:
+            same = resolve_company('777', 'Co', '1')
+        self.assertEqual(same.id, company.id)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertTrue(ctx.captured_queries[0]['sql'].startswith('SELECT'))
+
+    def test_changed_fields_are_updated(self):
+        from warehouse.companies import resolve_company
+
+        company = resolve_company('778', 'Co', '1')
+        resolve_company('778', 'Co renamed', '1')
+        company.refresh_from_db()
+        self.assertEqual(company.name, 'Co renamed')
+        self.assertEqual(Company.objects.filter(inn='778').count(), 1)
+
+    def test_deleted_company_is_recreated(self):
+        from warehouse.companies import resolve_company
+
+        company = resolve_company('779', 'Co', '1')
+        company.delete()
+        recreated = resolve_company('779', 'Co', '1')
+        self.assertNotEqual(recreated.id, company.id)
+        self.assertTrue(Company.objects.filter(id=recreated.id).exists())
+
+
+class OutcomeByMarkingCodeTest(TestCase):
+    """Расход принимает id или строки маркировок; резолв и списание — пачкой, без SELECT на каждую."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_outcome_codes', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.product = Product.objects.create(name='P', price=1.0, kpi='k')
+        self.income = Income.objects.create(
+            from_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking=f'W-{i}', income=self.income, product=self.product) for i in range(300)
+        ])
+
+    def _payload(self, markings, number='O1'):
+        return {
+            'to_company': {'name': 'To', 'phone': '2', 'inn': '2'},
+            'contract_date': '2024-01-01',
+            'contract_number': number,
+            'invoice_date': '2024-01-01',
+            'invoice_number': number,
+            'unit_of_measure': 'шт',
+            'total': 10.0,
+            'product_markings': markings,
+        }
+
+    def _save(self, payload):
+        from types import SimpleNamespace
+        from api.serializers import OutcomeSerializer
+
+        serializer = OutcomeSerializer(data=payload, context={'request': SimpleNamespace(user=self.operator)})
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    def test_write_off_by_codes_and_ids(self):
+        first_id = ProductMarking.objects.get(marking='W-0').id
+        response = self.client.post('/api/v1/outcomes/', self._payload([first_id, 'W-1', 'W-2', 'W-1']), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        outcome = Outcome.objects.get(contract_number='O1')
+        self.assertCountEqual(
+            outcome.product_markings.values_list('marking', flat=True), ['W-0', 'W-1', 'W-2'],
+        )
+
+    def test_unknown_marking_rejected(self):
+        response = self.client.post('/api/v1/outcomes/', self._payload(['W-0', 'NOPE']), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('NOPE', response.data['error']['message'])
+
+    def test_query_count_does_not_grow_with_markings(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self._save(self._payload(['W-0'], number='O0'))  # компания создана, дальше только чтение
+        with CaptureQueriesContext(connection) as small:
+            self._save(self._payload(['W-1', 'W-2']))
+        with CaptureQueriesContext(connection) as large:
+            self._save(self._payload([f'W-{i}' for i in range(3, 300)], number='O2'))
+        self.assertEqual(len(large.captured_queries), len(small.captured_queries))
+
+    def test_conflict_reported_with_codes(self):
+        self._save(self._payload(['W-5']))
+        response = self.client.post('/api/v1/outcomes/', self._payload(['W-5', 'W-6'], number='O2'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error']['details']['product_markings'], ['Маркировка уже списана: W-5'])
+
+
+class QueryCountMixin:
+    """Общее для тестов числа запросов: клиент-viewer, документ с N маркировками (товар на каждую), подсчёт запросов."""
+
+    username = None
+
+    def setUp(self):
+        Group.objects.get_or_create(name='viewer')
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_user(self.username, 'pass', 'viewer'))
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.counter = 0
+
+    def _document(self, model, count, prefix, unit_of_measure='шт', **markings_fields):
+        """Документ model (Income/Outcome) и count маркировок prefix-N; markings_fields — income/outcome маркировок."""
+        company = {'from_company' if model is Income else 'to_company': self.company}
+        document = model.objects.create(
+            **company,
+            contract_date='2024-01-01',
+            contract_number=prefix,
+            invoice_date='2024-01-01',
+            invoice_number=prefix,
+            unit_of_measure=unit_of_measure,
+            total=1.0,
+        )
+        markings_fields.setdefault('income' if model is Income else 'outcome', document)
+        for _ in range(count):
+            self.counter += 1
+            product = Product.objects.create(name=f'P{self.counter}', price=1.0, kpi='k')
+            ProductMarking.objects.create(marking=f'{prefix}-{self.counter}', product=product, **markings_fields)
+        return document
+
+    def _count_queries(self, url):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(ctx.captured_queries), response
+
+
+class OutcomeQueryCountTest(QueryCountMixin, TestCase):
+    """Список и детальная расходов — постоянное число запросов, независимо от числа расходов и маркировок."""
+
+    username = 'viewer_outcome_queries'
+
+    def setUp(self):
+        super().setUp()
+        self.income = Income.objects.create(
+            from_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+
+    def _outcome_with_markings(self, count):
+        return self._document(Outcome, count, 'Q', income=self.income)
+
+    def test_list_query_count_is_constant(self):
+        self._outcome_with_markings(1)
+        small, _ = self._count_queries('/api/v1/outcomes/')
+        for _ in range(3):
+            self._outcome_with_markings(5)
+        large, response = self._count_queries('/api/v1/outcomes/')
+        self.assertEqual(large, small)
+        self.assertEqual(response.data['results'][0]['product_markings'][0]['income_unit_of_measure'], 'шт')
+
+    def test_detail_query_count_is_constant(self):
+        small_outcome = self._outcome_with_markings(1)
+        large_outcome = self._outcome_with_markings(10)
+        small, _ = self._count_queries(f'/api/v1/outcomes/{small_outcome.id}/')
+        large, response = self._count_queries(f'/api/v1/outcomes/{large_outcome.id}/')
+        self.assertEqual(large, small)
+        self.assertEqual(len(response.data['product_markings']), 10)
+
+
+class IncomeQueryCountTest(QueryCountMixin, TestCase):
+    """Список и детальная приходов — маркировки/товары/единицы из prefetch, число запросов постоянно."""
+
+    username = 'viewer_income_queries'
+
+    def _income_with_markings(self, count):
+        return self._document(Income, count, 'IQ', unit_of_measure='кг')
+
+    def test_list_query_count_is_constant(self):
+        self._income_with_markings(1)
+        small, _ = self._count_queries('/api/v1/incomes/')
+        for _ in range(3):
+            self._income_with_markings(5)
+        large, response = self._count_queries('/api/v1/incomes/')
+        self.assertEqual(large, small)
+        marking = response.data['results'][0]['product_markings'][0]
+        self.assertEqual(marking['income_unit_of_measure'], 'кг')
+        self.assertTrue(marking['product_name'].startswith('P'))
+
+    def test_detail_query_count_is_constant(self):
+        small_income = self._income_with_markings(1)
+        large_income = self._income_with_markings(10)
+        small, _ = self._count_queries(f'/api/v1/incomes/{small_income.id}/')
+        large, response = self._count_queries(f'/api/v1/incomes/{large_income.id}/')
+        self.assertEqual(large, small)
+        self.assertEqual(len(response.data['product_markings']), 10)
+
+
+class DocumentSummaryViewTest(TestCase):
+    """?view=summary: шапки документов + количество маркировок по товарам, без массивов маркировок."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='viewer')
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_user('viewer_summary', 'pass', 'viewer'))
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.p1 = Product.objects.create(name='A', price=1.0, kpi='k')
+        self.p2 = Product.objects.create(name='B', price=2.0, kpi='k')
+        self.income = Income.objects.create(
+            from_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        self.outcome = Outcome.objects.create(
+            to_company=self.company,
+            contract_date='2024-01-01',
+            contract_number='O1',
+            invoice_date='2024-01-01',
+            invoice_number='O1',
+            unit_of_measure='шт',
+            total=10.0,
+        )
+        for i in range(3):
+            ProductMarking.objects.create(marking=f'SA-{i}', income=self.income, product=self.p1)
+        ProductMarking.objects.create(marking='SB-0', income=self.income, product=self.p2, outcome=self.outcome)
+
+    def test_income_summary(self):
+        response = self.client.get('/api/v1/incomes/?view=summary')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        row = response.data['results'][0]
+        self.assertNotIn('product_markings', row)
+        self.assertEqual(row['markings_count'], 4)
+        self.assertEqual([(p['name'], p['count']) for p in row['products']], [('A', 3), ('B', 1)])
+        self.assertEqual(row['from_company']['name'], 'Co')
+
+    def test_outcome_summary(self):
+        response = self.client.get('/api/v1/outcomes/?view=summary')
+        row = response.data['results'][0]
+        self.assertEqual(row['markings_count'], 1)
+        self.assertEqual(row['products'][0]['product'], self.p2.id)
+
+    def test_summary_with_marking_filter_counts_all_markings(self):
+        response = self.client.get('/api/v1/incomes/?view=summary&marking=SA-1')
+        self.assertEqual(response.data['results'][0]['markings_count'], 4)
+
+
+class CursorPaginationTest(TestCase):
+    """?pagination=cursor — keyset по (-created_at, -id); без параметра — прежняя PageNumberPagination."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='viewer')
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_user('viewer_cursor', 'pass', 'viewer'))
+        company = Company.objects.create(name='Co', phone='1', inn='1')
+        product = Product.objects.create(name='P', price=1.0, kpi='k')
+        income = Income.objects.create(
+            from_company=company,
+            contract_date='2024-01-01',
+            contract_number='I1',
+            invoice_date='2024-01-01',
+            invoice_number='I1',
+            unit_of_measure='шт',
+            total=100.0,
+        )
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking=f'CP-{i}', income=income, product=product) for i in range(120)
+        ])
+
+    def test_cursor_walks_all_markings_once(self):
+        seen = []
+        url = '/api/v1/product-markings/available/?pagination=cursor'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            seen += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(len(seen), 120)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+    def test_page_number_still_default(self):
+        response = self.client.get('/api/v1/product-markings/available/?page=2')
+        self.assertEqual(response.data['count'], 120)
+        self.assertEqual(len(response.data['results']), 50)
+
+    def test_incomes_cursor(self):
+        response = self.client.get('/api/v1/incomes/?pagination=cursor')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+
+
+class StockCounterTest(TestCase):
+    """Product.quantity (stock) поддерживается на каждом пути: приход, списание, возврат, удаление; rebuild_stock."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_stock', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+
+    def _stock(self, name='P'):
+        return Product.objects.get(name=name).quantity
+
+    def _create_income(self, markings):
+        response = self.client.post('/api/v1/incomes/', {
+            'from_company': {'name': 'Co', 'phone': '1', 'inn': '1'},
+            'contract_date': '2024-02-01',
+            'contract_number': 'I1',
+            'invoice_date': '2024-02-01',
+            'invoice_number': 'I1',
+            'unit_of_measure': 'шт',
+            'total': 10.0,
+            'products': [{'name': 'P', 'price': 1.0, 'kpi': 'k', 'markings': [{'marking': m} for m in markings]}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return Income.objects.get(contract_number='I1')
+
+    def _outcome_payload(self, markings):
+        return {
+            'to_company': {'name': 'To', 'phone': '2', 'inn': '2'},
+            'contract_date': '2024-03-01',
+            'contract_number': 'O1',
+            'invoice_date': '2024-03-01',
+            'invoice_number': 'O1',
+            'unit_of_measure': 'шт',
+            'total': 5.0,
+            'product_markings': markings,
+        }
+
+    def test_admin_bulk_delete_keeps_counters(self):
+        from django.contrib import admin
+        from warehouse.models import DashboardRollup
+        from warehouse.rollups import INCOME, STOCK
+
+        with self.captureOnCommitCallbacks(execute=True):
+            income = self._create_income(['A-1', 'A-2', 'A-3'])
+        model_admin = admin.site._registry[ProductMarking]
+        with self.captureOnCommitCallbacks(execute=True):
+            # «Удалить выбранные» в админке — queryset.delete() в обход ProductMarking.delete().
+            model_admin.delete_queryset(None, ProductMarking.objects.filter(marking__in=['A-1', 'A-2']))
+        self.assertEqual(self._stock(), 1)
+        self.assertEqual(DashboardRollup.objects.get(direction=STOCK, year=0, month=0).items, 1)
+        month = DashboardRollup.objects.get(direction=INCOME, year=2024, month=2)
+        self.assertEqual(month.items, 1)
+        self.assertEqual(income.income.count(), 1)
+
+    def test_write_off_detach_and_destroy(self):
+        self._create_income(['S-1', 'S-2', 'S-3', 'S-4'])
+        self.assertEqual(self._stock(), 4)
+
+        response = self.client.post('/api/v1/outcomes/', self._outcome_payload(['S-1', 'S-2', 'S-3']), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._stock(), 1)
+
+        outcome = Outcome.objects.get(contract_number='O1')
+        response = self.client.put(f'/api/v1/outcomes/{outcome.id}/', self._outcome_payload(['S-1', 'S-4']), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._stock(), 2)
+
+        # Конфликт при списании откатывает и остаток.
+        response = self.client.post('/api/v1/outcomes/', self._outcome_payload(['S-2', 'S-4']), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._stock(), 2)
+
+        self.client.post(f'/api/v1/outcomes/{outcome.id}/archive/')
+        response = self.client.delete(f'/api/v1/outcomes/{outcome.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self._stock(), 4)
+
+    def test_reconcile_and_income_destroy(self):
+        income = self._create_income(['R-1', 'R-2', 'R-3'])
+        from types import SimpleNamespace
+        from api.serializers import IncomeSerializer
+
+        serializer = IncomeSerializer(income, data={
+            'from_company': {'name': 'Co', 'phone': '1', 'inn': '1'},
+            'contract_date': '2024-02-01', 'contract_number': 'I1',
+            'invoice_date': '2024-02-01', 'invoice_number': 'I1',
+            'unit_of_measure': 'шт', 'total': 10.0,
+            'products': [{'name': 'P', 'price': 1.0, 'kpi': 'k', 'markings': [{'marking': 'R-1'}, {'marking': 'R-9'}]}],
+        }, context={'request': SimpleNamespace(user=self.operator)})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.assertEqual(self._stock(), 2)
+
+        self.client.post(f'/api/v1/incomes/{income.id}/archive/')
+        response = self.client.delete(f'/api/v1/incomes/{income.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self._stock(), 0)
+
+    def test_single_marking_save_and_delete(self):
+        income = self._create_income(['M-1'])
+        other = Product.objects.create(name='Q', price=2.0, kpi='q')
+        marking = ProductMarking.objects.create(marking='M-2', income=income, product=Product.objects.get(name='P'))
+        self.assertEqual(self._stock(), 2)
+
+        marking = ProductMarking.objects.get(id=marking.id)
+        marking.product = other
+        marking.save()
+        self.assertEqual((self._stock(), self._stock('Q')), (1, 1))
+
+        marking.delete()
+        self.assertEqual(self._stock('Q'), 0)
+
+    def test_product_list_reads_counter(self):
+        self._create_income(['L-1', 'L-2'])
+        response = self.client.get('/api/v1/products/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['stock'], 2)
+
+    def test_rebuild_stock_command(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        self._create_income(['B-1', 'B-2'])
+        Product.objects.filter(name='P').update(quantity=7)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_stock', '--check', stdout=StringIO())
+        call_command('rebuild_stock', stdout=StringIO())
+        self.assertEqual(self._stock(), 2)
+        call_command('rebuild_stock', '--check', stdout=StringIO())
+
+
+class DashboardRollupTest(TestCase):
+    """dashboard_stats читает сводки DashboardRollup; они пересчитываются после commit при изменениях документов."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_rollup', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+
+    def _post(self, url, payload):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response
+
+    def _create_income(self, number, contract_date, markings, price=2.0):
+        return self._post('/api/v1/incomes/', {
+            'from_company': {'name': 'Co', 'phone': '1', 'inn': '1'},
+            'contract_date': contract_date,
+            'contract_number': number,
+            'invoice_date': contract_date,
+            'invoice_number': number,
+            'unit_of_measure': 'шт',
+            'total': 100.0,
+            'products': [{'name': 'P', 'price': price, 'kpi': 'k', 'markings': [{'marking': m} for m in markings]}],
+        })
+
+    def _create_outcome(self, number, contract_date, markings):
+        return self._post('/api/v1/outcomes/', {
+            'to_company': {'name': 'To', 'phone': '2', 'inn': '2'},
+            'contract_date': contract_date,
+            'contract_number': number,
+            'invoice_date': contract_date,
+            'invoice_number': number,
+            'unit_of_measure': 'шт',
+            'total': 30.0,
+            'product_markings': markings,
+        })
+
+    def _stats(self, year):
+        response = self.client.get(f'/api/v1/stats/dashboard/?year={year}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_stats_follow_documents(self):
+        self._create_income('I1', '2024-03-10', ['D-1', 'D-2', 'D-3'])
+        self._create_income('I2', '2023-12-31', ['D-4'])
+        self._create_outcome('O1', '2024-05-02', ['D-1', 'D-4'])
+
+        stats = self._stats(2024)
+        self.assertEqual(stats['available_years'], [2024, 2023])
+        self.assertEqual(stats['incomes']['by_month'][2], {'month': 3, 'doc_count': 1, 'total': 100.0, 'items': 3})
+        self.assertEqual(stats['incomes']['total_count'], 1)
+        self.assertEqual(stats['outcomes']['by_month'][4], {'month': 5, 'doc_count': 1, 'total': 30.0, 'items': 2})
+        self.assertEqual(stats['outcomes']['total_items'], 2)
+        self.assertEqual(stats['stock'], {'items_count': 2, 'value': 4.0})
+
+        # Перенос расхода в другой месяц пересчитывает оба месяца.
+        outcome = Outcome.objects.get(contract_number='O1')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/v1/outcomes/{outcome.id}/',
+                {'to_company': {'name': 'To', 'phone': '2', 'inn': '2'}, 'contract_date': '2024-06-01'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = self._stats(2024)
+        self.assertEqual(stats['outcomes']['by_month'][4]['doc_count'], 0)
+        self.assertEqual(stats['outcomes']['by_month'][5]['items'], 2)
+
+    def test_stock_value_follows_price_change(self):
+        self._create_income('I1', '2024-03-10', ['V-1', 'V-2'])
+        product = Product.objects.get(name='P')
+        product.price = 5.0
+        product.save()
+        self.assertEqual(self._stats(2024)['stock'], {'items_count': 2, 'value': 10.0})
+
+    def test_rebuild_matches_incremental(self):
+        from warehouse.models import DashboardRollup
+        from warehouse.rollups import rebuild_rollups
+
+        self._create_income('I1', '2024-03-10', ['X-1', 'X-2'])
+        self._create_outcome('O1', '2024-04-02', ['X-2'])
+        before = self._stats(2024)
+        DashboardRollup.objects.all().delete()
+        rebuild_rollups()
+        self.assertEqual(self._stats(2024), before)
+
+
+class ListQueryPlanTest(TestCase):
+    """Горячие списки идут по составным индексам: EXPLAIN QUERY PLAN на SQLite (регрессия сортировки/фильтров)."""
+
+    def _plan(self, viewset_class, params):
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+
+        view = viewset_class()
+        view.request = Request(APIRequestFactory().get('/', params))
+        view.action = 'list'
+        view.format_kwarg = None
+        return view.filter_queryset(view.get_queryset())[:50].explain()
+
+    def setUp(self):
+        from django.db import connection
+
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN — формат SQLite')
+
+    def test_archive_lists_use_composite_indexes(self):
+        from api.views import IncomeViewSet, OutcomeViewSet
+
+        for viewset_class, prefix in ((IncomeViewSet, 'income'), (OutcomeViewSet, 'outcome')):
+            plan = self._plan(viewset_class, {'is_archive': 'true'})
+            self.assertIn(f'USING INDEX {prefix}_arch_archived_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+            plan = self._plan(viewset_class, {'is_archive': 'false'})
+            self.assertIn(f'USING INDEX {prefix}_arch_created_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_year_filter_is_a_date_range(self):
+        from api.views import IncomeViewSet
+
+        plan = self._plan(IncomeViewSet, {'year': '2024'})
+        self.assertIn('contract_date>? AND contract_date<?', plan)
+
+
+class MarkingSearchIndexTest(TestCase):
+    """Поиск маркировок по подстроке через warehouse.search (на SQLite — FTS5 trigram, синхронизируется триггерами)."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_search', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.product = Product.objects.create(name='Widget', price=1.0, kpi='k')
+        self.income = Income.objects.create(
+            from_company=company, contract_date='2024-01-01', contract_number='I1',
+            invoice_date='2024-01-01', invoice_number='I1', unit_of_measure='шт', total=1.0,
+        )
+        self.other_income = Income.objects.create(
+            from_company=company, contract_date='2024-01-01', contract_number='I2',
+            invoice_date='2024-01-01', invoice_number='I2', unit_of_measure='шт', total=1.0,
+        )
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking='0104600Abc"Q1', income=self.income, product=self.product),
+            ProductMarking(marking='0104600XYZ-2', income=self.income, product=self.product),
+            ProductMarking(marking='0104600xyz-3', income=self.other_income, product=self.product),
+        ])
+
+    def _markings(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(row['marking'] for row in response.data['results'])
+
+    def test_uses_fts_index_on_sqlite(self):
+        from django.db import connection
+        from warehouse.search import FTS_TABLE, marking_search_q, search_index_available
+
+        if connection.vendor != 'sqlite':
+            self.skipTest('FTS5 — только SQLite')
+        self.assertTrue(search_index_available())
+        plan = ProductMarking.objects.filter(marking_search_q('xyz')).explain()
+        self.assertIn(FTS_TABLE, plan)
+
+    def test_postgres_query_matches_trgm_index(self):
+        from django.db import connection
+        from warehouse import search
+
+        # GIN pg_trgm построен по marking: запрос должен быть ILIKE по колонке, а не UPPER(...) LIKE из icontains.
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(search, 'search_index_available', return_value=True):
+            q = search.marking_search_q('a%_b')
+        matches = q.children[0][1]
+        self.assertIn('WHERE marking ILIKE %s', matches.sql)
+        self.assertEqual(matches.params, ['%a\\%\\_b%'])
+
+    def test_filters_route_through_index(self):
+        self.assertEqual(self._markings('/api/v1/product-markings/?search=xyz'), ['0104600XYZ-2', '0104600xyz-3'])
+        self.assertEqual(self._markings('/api/v1/product-markings/?search=c"q'), ['0104600Abc"Q1'])
+        self.assertEqual(
+            self._markings('/api/v1/product-markings/available/?search=Widg'),
+            ['0104600Abc"Q1', '0104600XYZ-2', '0104600xyz-3'],
+        )
+        response = self.client.get('/api/v1/incomes/?marking=XYZ-&view=summary')
+        self.assertEqual(sorted(row['contract_number'] for row in response.data['results']), ['I1', 'I2'])
+
+    def test_short_query_falls_back_to_icontains(self):
+        self.assertEqual(self._markings('/api/v1/product-markings/?search=-3'), ['0104600xyz-3'])
+
+    def test_index_follows_updates_and_deletes(self):
+        marking = ProductMarking.objects.get(marking='0104600XYZ-2')
+        marking.marking = '0104600QQQ-2'
+        marking.save()
+        ProductMarking.objects.filter(marking='0104600xyz-3').delete()
+        self.assertEqual(self._markings('/api/v1/product-markings/?search=xyz'), [])
+        self.assertEqual(self._markings('/api/v1/product-markings/?search=qqq'), ['0104600QQQ-2'])
+
+
+class MarkingDigestLookupTest(TestCase):
+    """Точные поиски маркировок идут по marking_hash (64 бит) со сверкой полной строки."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_digest', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        self.product = Product.objects.create(name='P', price=1.0, kpi='k')
+        ProductMarking.objects.bulk_create([ProductMarking(marking='H-1', product=self.product)])
+        ProductMarking.objects.create(marking='H-2', product=self.product)
+
+    def test_hash_filled_on_bulk_create_save_and_rename(self):
+        from warehouse.digest import marking_digest
+
+        marking = ProductMarking.objects.get(marking='H-2')
+        self.assertEqual(ProductMarking.objects.get(marking='H-1').marking_hash, marking_digest('H-1'))
+        self.assertEqual(marking.marking_hash, marking_digest('H-2'))
+        marking.marking = 'H-3'
+        marking.save(update_fields=['marking'])
+        marking.refresh_from_db()
+        self.assertEqual(marking.marking_hash, marking_digest('H-3'))
+
+    def test_check_endpoints(self):
+        self.assertTrue(self.client.get('/api/v1/product-markings/check-marking/H-1/').data['exists'])
+        self.assertFalse(self.client.get('/api/v1/product-markings/check-marking/H-9/').data['exists'])
+        response = self.client.post('/api/v1/product-markings/check/', {'markings': ['H-1', 'H-9', 'H-2', 'H-9']}, format='json')
+        self.assertCountEqual(response.data['exists'], ['H-1', 'H-2'])
+        self.assertEqual(response.data['duplicates'], ['H-9'])
+
+    def test_collision_is_verified_against_full_string(self):
+        from warehouse import digest
+
+        # Все строки с одинаковым хэшем: поиск по хэшу найдёт H-1, но строка не совпадёт.
+        ProductMarking.objects.update(marking_hash=42)
+        with mock.patch.object(digest, 'marking_digest', return_value=42):
+            self.assertFalse(digest.marking_exists(ProductMarking.objects.all(), 'H-9'))
+            self.assertTrue(digest.marking_exists(ProductMarking.objects.all(), 'H-1'))
+            found = list(digest.find_by_digest(ProductMarking.objects.all(), ['H-2', 'H-9']))
+        self.assertEqual(found, [('H-2',)])
+
+    def test_lookup_uses_hash_index(self):
+        from django.db import connection
+        from warehouse.digest import marking_digest
+
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN — формат SQLite')
+        plan = ProductMarking.objects.filter(marking_hash=marking_digest('H-1')).values_list('marking').explain()
+        self.assertIn('marking_hash', plan)
+
+
+class CheckMarkingsBatchTest(TestCase):
+    """check_markings_batch: любой размер (чанками), потоковое тело, компактные форматы ответа."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        self.operator = create_user('operator_check_batch', 'pass', 'operator')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        product = Product.objects.create(name='P', price=1.0, kpi='k')
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking=f'C-{i}', product=product) for i in range(0, 3000, 2)
+        ])
+
+    def test_large_batch_is_chunked(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        markings = [f'C-{i}' for i in range(3000)] + ['C-0']
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/v1/product-markings/check/?result=indexes', {'markings': markings}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 3001)
+        self.assertEqual(response.data['exists'], list(range(0, 3000, 2)) + [3000])
+        self.assertEqual(response.data['duplicates'], [3000])
+        self.assertLessEqual(len(ctx.captured_queries), 10)
+
+    def test_default_lists_format_unchanged(self):
+        response = self.client.post(
+            '/api/v1/product-markings/check/', {'markings': ['C-2', 'N-1', 'N-1', '', 'C-2']}, format='json',
+        )
+        self.assertEqual(response.data, {'exists': ['C-2'], 'duplicates': ['N-1', 'C-2']})
+
+    def test_streamed_plain_body_with_bitmap(self):
+        import base64
+
+        body = 'C-0\nN-1\n\nC-4\nN-1\n'
+        response = self.client.post(
+            '/api/v1/product-markings/check/?result=bitmap', data=body, content_type='text/plain',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 5)
+        self.assertEqual(base64.b64decode(response.data['exists']), bytes([0b01001]))
+        self.assertEqual(base64.b64decode(response.data['duplicates']), bytes([0b10000]))
+        self.assertEqual(base64.b64decode(response.data['empty']), bytes([0b00100]))
+
+    def test_blank_lines_keep_line_positions(self):
+        body = 'C-0\n\nN-1\n   \nC-4\n'
+        response = self.client.post(
+            '/api/v1/product-markings/check/?result=indexes', data=body, content_type='text/plain',
+        )
+        self.assertEqual(response.data, {'total': 5, 'exists': [0, 4], 'duplicates': [], 'empty': [1, 3]})
+        body = '"C-0"\n\n"C-2"\n'
+        response = self.client.post(
+            '/api/v1/product-markings/check/?result=indexes', data=body, content_type='application/x-ndjson',
+        )
+        self.assertEqual(response.data, {'total': 3, 'exists': [0, 2], 'duplicates': [], 'empty': [1]})
+
+    def test_streamed_ndjson_body(self):
+        body = '"C-6"\n{"marking": "N-7"}\nnot json\n'
+        response = self.client.post(
+            '/api/v1/product-markings/check/?result=indexes', data=body, content_type='application/x-ndjson',
+        )
+        self.assertEqual(response.data, {'total': 3, 'exists': [0], 'duplicates': [], 'empty': [2]})
+
+
+class MarkingExistenceFilterTest(TestCase):
+    """Фильтр Блума: «точно новая» без запроса, существующие — через базу, догоняющая синхронизация, счётчики."""
+
+    def setUp(self):
+        from warehouse.bloom import marking_filter
+
+        Group.objects.get_or_create(name='operator')
+        Group.objects.get_or_create(name='admin')
+        self.operator = create_user('operator_bloom', 'pass', 'operator')
+        self.admin = create_user('admin_bloom', 'pass', 'admin')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        self.product = Product.objects.create(name='P', price=1.0, kpi='k')
+        ProductMarking.objects.bulk_create([ProductMarking(marking=f'B-{i}', product=self.product) for i in range(50)])
+        self.filter = marking_filter
+        self.filter.rebuild()
+        self.filter.reset_counters()
+
+    def _exists(self, marking):
+        return self.client.get(f'/api/v1/product-markings/check-marking/{marking}/').data['exists']
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        from warehouse.bloom import BloomFilter
+        from warehouse.digest import marking_digest
+
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(marking_digest(f'X-{i}'))
+        self.assertTrue(all(marking_digest(f'X-{i}') in bloom for i in range(1000)))
+        false_positives = sum(marking_digest(f'Y-{i}') in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_new_code_answered_without_query(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with self.settings(MARKING_FILTER_SYNC_SECONDS=3600):
+            self._exists('B-0')  # запрос аутентификации/прогрев — вне замера
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertFalse(self._exists('NEW-1'))
+            self.assertFalse(any('warehouse_productmarking' in q['sql'] for q in ctx.captured_queries))
+            self.assertTrue(self._exists('B-1'))
+        stats = self.filter.stats()
+        self.assertEqual(stats['definitely_new'], 1)
+        self.assertEqual(stats['maybe_exists'], 2)
+
+    def test_local_creates_are_added_and_other_processes_synced(self):
+        ProductMarking.objects.create(marking='LOCAL-1', product=self.product)
+        with self.settings(MARKING_FILTER_SYNC_SECONDS=3600):
+            self.assertTrue(self._exists('LOCAL-1'))
+        # Запись в обход этого процесса (как из другого воркера) — догоняется синхронизацией по id.
+        from warehouse.digest import marking_digest
+
+        ProductMarking.objects.filter(marking='B-49').update(marking='REMOTE-1', marking_hash=marking_digest('REMOTE-1'))
+        with self.settings(MARKING_FILTER_SYNC_SECONDS=0):
+            self.assertTrue(self._exists('REMOTE-1'))
+
+    def test_edit_from_other_process_is_synced(self):
+        from warehouse.bloom import MarkingExistenceFilter
+
+        # Фильтр «этого» процесса; save() ниже пополняет только фильтр своего процесса, как у другого воркера.
+        local = MarkingExistenceFilter()
+        local.rebuild()
+        marking = ProductMarking.objects.get(marking='B-0')
+        marking.marking = 'EDITED-1'
+        marking.save()
+        with mock.patch('warehouse.bloom.SYNC_ID_OVERLAP', 0), self.settings(MARKING_FILTER_SYNC_SECONDS=0):
+            self.assertTrue(local.might_exist('EDITED-1'))
+
+    def test_repeated_syncs_do_not_inflate_count(self):
+        from warehouse.bloom import MarkingExistenceFilter
+
+        local = MarkingExistenceFilter()
+        items = local.rebuild()['items']
+        self.assertEqual(items, 50)
+        with self.settings(MARKING_FILTER_SYNC_SECONDS=0):
+            for _ in range(5):
+                local.might_exist('NEW-1')
+        stats = local.stats()
+        self.assertEqual((stats['items'], stats['rebuilds']), (items, 1))
+
+    def test_batch_check_uses_filter(self):
+        response = self.client.post(
+            '/api/v1/product-markings/check/', {'markings': ['B-3', 'N-1', 'N-2']}, format='json',
+        )
+        self.assertEqual(response.data['exists'], ['B-3'])
+        self.assertGreaterEqual(self.filter.stats()['definitely_new'], 1)
+
+    def test_admin_stats_and_rebuild(self):
+        self.assertEqual(self.client.get('/api/v1/admin/marking-filter/').status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post('/api/v1/admin/marking-filter/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['items'], 50)
+        self.assertIn('false_positives', self.client.get('/api/v1/admin/marking-filter/').data)
+
+
+class RoleCacheTest(TestCase):
+    """Роли пользователя кэшируются (api.roles) и сбрасываются при изменении групп/is_active."""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        for name in ('admin', 'operator', 'viewer'):
+            Group.objects.get_or_create(name=name)
+        self.admin = create_user('roles_admin', 'pass', 'admin')
+        self.operator = create_user('roles_operator', 'pass', 'operator')
+        self.client = APIClient()
+
+    def test_roles_are_read_once_per_ttl(self):
+        from api.roles import has_role
+
+        with self.assertNumQueries(1):
+            self.assertTrue(has_role(self.operator, 'admin', 'operator'))
+        with self.assertNumQueries(0):
+            self.assertTrue(has_role(self.operator, 'operator'))
+            self.assertFalse(has_role(self.operator, 'admin'))
+
+    def test_write_permission_does_not_query_groups(self):
+        from api.roles import get_user_roles
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        get_user_roles(self.operator)
+        self.client.force_authenticate(user=self.operator)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post('/api/v1/companies/', {'name': 'Co', 'phone': '1', 'inn': '1'}, format='json')
+        self.assertFalse([q for q in ctx.captured_queries if 'auth_group' in q['sql']])
+
+    def test_admin_update_invalidates_roles(self):
+        from api.roles import has_role
+
+        self.assertTrue(has_role(self.operator, 'operator'))
+        viewer = Group.objects.get(name='viewer')
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.patch(
+            f'/api/v1/admin/users/{self.operator.id}/', {'groups': [viewer.id]}, format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(has_role(self.operator, 'operator'))
+        self.client.force_authenticate(user=self.operator)
+        response = self.client.post('/api/v1/companies/', {'name': 'Co', 'phone': '1', 'inn': '1'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_token_responses_use_cached_roles(self):
+        login = self.client.post('/api/v1/token/', {'username': 'roles_operator', 'password': 'pass'}, format='json')
+        self.assertEqual(login.data['groups'], ['operator'])
+        self.assertFalse(login.data['is_superuser'])
+        response = self.client.post('/api/v1/token/refresh/', {'refresh': login.data['refresh']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['groups'], ['operator'])
+
+
+class StatelessJWTAuthTest(TestCase):
+    """request.user из claims токена (api.authentication): без SELECT пользователя, deny-list отключённых."""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        for name in ('admin', 'operator'):
+            Group.objects.get_or_create(name=name)
+        self.admin = create_user('stateless_admin', 'pass', 'admin')
+        self.operator = create_user('stateless_operator', 'pass', 'operator')
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.client = APIClient()
+        login = self.client.post('/api/v1/token/', {'username': 'stateless_operator', 'password': 'pass'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {login.data['access']}")
+
+    def _user_queries(self, method, url, **kwargs):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, format='json', **kwargs)
+        return response, [q['sql'] for q in ctx.captured_queries if 'warehouse_customuser' in q['sql']]
+
+    def test_requests_do_not_load_user(self):
+        # Первый запрос прогревает кэши ролей и deny-list.
+        response, _ = self._user_queries('get', '/api/v1/companies/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response, user_queries = self._user_queries('post', '/api/v1/companies/', data={'name': 'N', 'phone': '2'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(user_queries, [])
+
+    def test_model_is_loaded_when_view_needs_it(self):
+        from api.authentication import ClaimsUser
+        from api.roles import get_user_roles
+
+        income = Income.objects.create(
+            from_company=self.company, contract_date='2024-01-01', contract_number='1',
+            invoice_date='2024-01-01', invoice_number='1', unit_of_measure='шт', total=1.0,
+        )
+        response = self.client.post(f'/api/v1/incomes/{income.id}/archive/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        income.refresh_from_db()
+        self.assertEqual(income.archived_by_id, self.operator.id)
+
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        token = AccessToken.for_user(self.operator)
+        token['username'] = 'stateless_operator'
+        user = ClaimsUser(token)
+        get_user_roles(self.operator.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(user and user.is_authenticated)
+            self.assertEqual((user.id, user.username, user.is_superuser), (self.operator.id, 'stateless_operator', False))
+        with self.assertNumQueries(1):
+            self.assertIsInstance(user, CustomUser)
+
+    def test_deactivated_user_is_rejected(self):
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_200_OK)
+        admin_client = APIClient()
+        admin_client.force_authenticate(user=self.admin)
+        response = admin_client.patch(
+            f'/api/v1/admin/users/{self.operator.id}/', {'is_active': False}, format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_user_is_rejected(self):
+        self.operator.delete()
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_deleted_by_other_process_is_rejected_after_ttl(self):
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_200_OK)
+        # Сигналы другого процесса до кэша этого не доходят; кэш активных id живёт ROLES_CACHE_TTL.
+        with mock.patch('api.signals.invalidate_active_users'):
+            self.operator.delete()
+        from django.core.cache import cache
+        from api.authentication import ACTIVE_USERS_KEY
+
+        cache.delete(ACTIVE_USERS_KEY)  # истёк TTL
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_created_by_other_process_is_accepted(self):
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_200_OK)
+        with mock.patch('api.signals.invalidate_active_users'):
+            create_user('stateless_new', 'pass', 'operator')
+        login = self.client.post('/api/v1/token/', {'username': 'stateless_new', 'password': 'pass'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {login.data['access']}")
+        self.assertEqual(self.client.get('/api/v1/companies/').status_code, status.HTTP_200_OK)
+
+
+
+class TokenRefreshPipelineTest(TestCase):
+    """Ротация refresh: один разбор токена, роли из кэша, отзыв — одна строка RevokedToken."""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        Group.objects.get_or_create(name='operator')
+        self.user = create_user('pipeline_user', 'pass', 'operator')
+        self.client = APIClient()
+
+    def _login(self):
+        response = self.client.post('/api/v1/token/', {'username': 'pipeline_user', 'password': 'pass'}, format='json')
+        return response.data['refresh']
+
+    def _refresh(self, token):
+        return self.client.post('/api/v1/token/refresh/', {'refresh': token}, format='json')
+
+    def test_rotation_writes_only_revoked_jti(self):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+        from warehouse.models import RevokedToken
+
+        refresh = self._refresh(self._login()).data['refresh']  # прогрев кэшей ролей и deny-list
+        with self.assertNumQueries(3):  # отзыв проверяет сама вставка: SAVEPOINT, INSERT jti, RELEASE
+            response = self._refresh(refresh)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['groups'], ['operator'])
+        self.assertEqual(RevokedToken.objects.count(), 2)
+        self.assertFalse(OutstandingToken.objects.exists())
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+    def test_rotated_token_cannot_be_reused(self):
+        refresh = self._login()
+        self.assertEqual(self._refresh(refresh).status_code, status.HTTP_200_OK)
+        self.assertEqual(self._refresh(refresh).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_refreshed_access_carries_current_roles(self):
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        refresh = self._login()
+        self.user.groups.clear()
+        response = self._refresh(refresh)
+        self.assertEqual(response.data['groups'], [])
+        self.assertEqual(AccessToken(response.data['access'])['groups'], [])
+
+    def test_logout_revokes_token(self):
+        refresh = self._login()
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/api/v1/logout/', {'refresh_token': refresh}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_205_RESET_CONTENT)
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self._refresh(refresh).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_benchmark_command(self):
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('bench_token_refresh', count=3, stdout=out)
+        self.assertIn('текущий', out.getvalue())
+        self.assertFalse(CustomUser.objects.filter(username__startswith='bench-refresh-').exists())
+
+
+class TokenPruneTest(TestCase):
+    """prune_tokens удаляет только истёкшие записи; недавно отозванные jti проверяются без запроса."""
+
+    def setUp(self):
+        from django.utils import timezone
+        from datetime import timedelta
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+        from warehouse.models import RevokedToken
+
+        self.user = create_user('prune_user', 'pass')
+        now = timezone.now()
+        for i in range(5):
+            expires_at = now - timedelta(days=1) if i < 3 else now + timedelta(days=1)
+            RevokedToken.objects.create(jti=f'revoked-{i}', expires_at=expires_at)
+            token = OutstandingToken.objects.create(user=self.user, jti=f'out-{i}', token='t', expires_at=expires_at)
+            if i % 2 == 0:
+                BlacklistedToken.objects.create(token=token)
+
+    def test_prune_deletes_expired_in_batches(self):
+        from django.core.management import call_command
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+        from warehouse.models import RevokedToken
+
+        out = StringIO()
+        call_command('prune_tokens', batch_size=2, stdout=out)
+        self.assertIn('отозванных 3', out.getvalue())
+        self.assertEqual(sorted(RevokedToken.objects.values_list('jti', flat=True)), ['revoked-3', 'revoked-4'])
+        self.assertEqual(OutstandingToken.objects.count(), 2)
+        self.assertEqual(BlacklistedToken.objects.count(), 1)
+
+    def test_recently_revoked_expires(self):
+        import time as time_module
+        from api.tokens import RecentlyRevoked, is_revoked, recently_revoked
+
+        cache = RecentlyRevoked(limit=2)
+        cache.add('old', time_module.time() - 1)
+        cache.add('a', time_module.time() + 60)
+        cache.add('b', time_module.time() + 120)
+        cache.add('c', time_module.time() + 180)
+        self.assertNotIn('old', cache)
+        self.assertNotIn('a', cache)  # вытеснен лимитом как истекающий раньше всех
+        self.assertIn('c', cache)
+
+        recently_revoked.clear()
+        exp = time_module.time() + 60
+        self.assertTrue(is_revoked('revoked-4', exp))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_revoked('revoked-4', exp))
+
+
+class DocumentExportTest(TestCase):
+    """/incomes/export/ и /outcomes/export/: фильтры списка, одна выборка, CSV и XLSX потоком."""
+
+    def setUp(self):
+        self.user = create_user('export_user', 'pass')
+        self.company = Company.objects.create(name='Поставщик', phone='1', inn='123')
+        self.product = Product.objects.create(name='Товар', price=2.5, kpi='kpi')
+        self.incomes = []
+        for i, year in enumerate((2023, 2024, 2024)):
+            income = Income.objects.create(
+                from_company=self.company, contract_date=f'{year}-03-01', contract_number=f'C-{i}',
+                invoice_date=f'{year}-03-01', invoice_number=f'I-{i}', unit_of_measure='шт', total=10.0,
+            )
+            self.incomes.append(income)
+        ProductMarking.objects.bulk_create([
+            ProductMarking(marking=f'0104600\x1d91EE{i}', income=self.incomes[1], product=self.product)
+            for i in range(3)
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def _content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_csv_applies_list_filters(self):
+        import csv as csv_module
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/incomes/export/?year=2024')
+            content = self._content(response).decode('utf-8-sig')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('attachment', response['Content-Disposition'])
+        rows = list(csv_module.reader(StringIO(content)))
+        self.assertEqual(rows[0][:2], ['ID', 'Номер договора'])
+        # Три маркировки C-1 и пустая строка маркировки у C-2 (без маркировок); C-0 — за 2023.
+        self.assertEqual(sorted(row[1] for row in rows[1:]), ['C-1', 'C-1', 'C-1', 'C-2'])
+        self.assertIn('0104600\x1d91EE0', [row[-1] for row in rows])
+
+    def test_xlsx_is_valid_workbook(self):
+        import zipfile
+
+        response = self.client.get('/api/v1/incomes/export/?type=xlsx&year=2024')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        archive = zipfile.ZipFile(BytesIO(self._content(response)))
+        self.assertIn('xl/workbook.xml', archive.namelist())
+        sheet = archive.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertEqual(sheet.count('<row>'), 5)
+        self.assertIn('0104600_x001D_91EE0', sheet)
+        self.assertIn('<v>2.5</v>', sheet)
+
+    def test_xlsx_splits_sheets(self):
+        import zipfile
+        from api.export import xlsx_stream
+
+        content = b''.join(xlsx_stream(['a'], ([i] for i in range(5)), max_rows=3))
+        archive = zipfile.ZipFile(BytesIO(content))
+        self.assertEqual(archive.read('xl/worksheets/sheet3.xml').decode('utf-8').count('<row>'), 2)
+        self.assertIn('Лист3', archive.read('xl/workbook.xml').decode('utf-8'))
+
+    def test_outcome_export_and_bad_type(self):
+        outcome = Outcome.objects.create(
+            to_company=self.company, contract_date='2024-05-01', contract_number='O-1',
+            invoice_date='2024-05-01', invoice_number='OI-1', unit_of_measure='шт', total=5.0,
+        )
+        ProductMarking.objects.filter(income=self.incomes[1]).update(outcome=outcome)
+        content = self._content(self.client.get('/api/v1/outcomes/export/')).decode('utf-8-sig')
+        self.assertEqual(content.count('O-1'), 3)
+        response = self.client.get('/api/v1/outcomes/export/?type=pdf')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+DOCUMENT_TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'documents': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'documents-test'},
+}
+
+
+@override_settings(CACHES=DOCUMENT_TEST_CACHES)
+class DocumentRenderTest(TestCase):
+    """Печатные формы на сервере: строки по товарам без загрузки маркировок, кэш архивных форм, пачка."""
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        caches['documents'].clear()
+        self.user = create_user('document_user', 'pass')
+        self.company = Company.objects.create(name='Покупатель', phone='99890', inn='555')
+        self.product = Product.objects.create(name='Чай', price=1500.5, kpi='KPI-1')
+        self.outcomes = [
+            Outcome.objects.create(
+                to_company=self.company, contract_date='2024-05-01', contract_number=f'O-{i}',
+                invoice_date='2024-05-02', invoice_number=f'OI-{i}', unit_of_measure='шт', total=3001.0,
+                is_archive=i == 0,
+            )
+            for i in range(2)
+        ]
+        for outcome in self.outcomes:
+            ProductMarking.objects.bulk_create([
+                ProductMarking(marking=f'DOC-{outcome.id}-{i}', product=self.product, outcome=outcome) for i in range(2)
+            ])
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_single_document(self):
+        response = self.client.get(f'/api/v1/outcomes/{self.outcomes[1].id}/document/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        html = response.content.decode('utf-8')
+        self.assertIn('Расход № O-1', html)
+        self.assertIn('KPI-1', html)
+        self.assertIn('3 001 сум.', html)
+        self.assertNotIn('DOC-', html)
+
+    def test_batch_renders_in_one_pass_and_caches_archived(self):
+        ids = ','.join(str(outcome.id) for outcome in self.outcomes)
+        with self.assertNumQueries(2):  # шапки документов + GROUP BY строк
+            html = self.client.get(f'/api/v1/outcomes/documents/?ids={ids}').content.decode('utf-8')
+        self.assertEqual(html.count('class="document"'), 2)
+        self.assertLess(html.index('O-0'), html.index('O-1'))
+        # Архивный документ — из кэша; строки читаются только для неархивного.
+        ProductMarking.objects.filter(outcome=self.outcomes[0]).delete()
+        with self.assertNumQueries(2):
+            html = self.client.get(f'/api/v1/outcomes/documents/?ids={ids}').content.decode('utf-8')
+        self.assertNotIn('Нет данных о продуктах', html)
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/v1/outcomes/documents/?ids={self.outcomes[0].id}')
+
+    def test_batch_validation(self):
+        response = self.client.get('/api/v1/outcomes/documents/?ids=1,x')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f'/api/v1/outcomes/documents/?ids={self.outcomes[0].id},999999')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['error']['details']['missing'], [999999])
+
+
+class BulkArchiveTest(TestCase):
+    """bulk-archive/bulk-unarchive: один UPDATE на чанк, статус по каждому id, отбор по id или фильтру."""
+
+    def setUp(self):
+        Group.objects.get_or_create(name='operator')
+        Group.objects.get_or_create(name='viewer')
+        self.operator = create_user('bulk_operator', 'pass', 'operator')
+        self.viewer = create_user('bulk_viewer', 'pass', 'viewer')
+        self.company = Company.objects.create(name='Co', phone='1', inn='1')
+        self.incomes = [
+            Income.objects.create(
+                from_company=self.company, contract_date=f'{year}-01-10', contract_number=f'B-{i}',
+                invoice_date=f'{year}-01-10', invoice_number=f'BI-{i}', unit_of_measure='шт', total=1.0,
+                is_archive=i == 0,
+            )
+            for i, year in enumerate((2023, 2023, 2023, 2024))
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.operator)
+        from api.roles import get_user_roles
+
+        get_user_roles(self.operator)  # роли — из кэша, в счётчик запросов не попадают
+
+    def test_archive_by_ids_reports_each_id(self):
+        ids = [income.id for income in self.incomes[:3]] + [999999]
+        with self.assertNumQueries(4):  # SAVEPOINT/SELECT/UPDATE/RELEASE — одна пачка
+            response = self.client.post('/api/v1/incomes/bulk-archive/', {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['updated'], 2)
+        statuses = {row['id']: row['status'] for row in response.data['results']}
+        self.assertEqual(statuses[self.incomes[0].id], 'already_archived')
+        self.assertEqual(statuses[self.incomes[1].id], 'archived')
+        self.assertEqual(statuses[999999], 'not_found')
+        income = Income.objects.get(id=self.incomes[1].id)
+        self.assertTrue(income.is_archive)
+        self.assertEqual(income.archived_by_id, self.operator.id)
+        self.assertIsNotNone(income.archived_at)
+
+    def test_row_changed_concurrently_reported_unchanged(self):
+        from types import SimpleNamespace
+
+        from django.utils import timezone
+
+        raced = self.incomes[1]
+        filters = []
+
+        def racing_filter(**kwargs):
+            filters.append(kwargs)
+            if len(filters) == 2:  # между чтением и UPDATE документ архивирует другой запрос
+                Income.objects.filter(id=raced.id).update(is_archive=True, archived_at=timezone.now())
+            return Income.objects.filter(**kwargs)
+
+        ids = [raced.id, self.incomes[2].id]
+        results = set_archived(SimpleNamespace(objects=SimpleNamespace(filter=racing_filter)), ids, True)
+        self.assertEqual(results, {raced.id: 'already_archived', self.incomes[2].id: 'archived'})
+
+    def test_archive_and_unarchive_by_filter(self):
+        response = self.client.post('/api/v1/incomes/bulk-archive/', {'filter': {'year': 2023}}, format='json')
+        self.assertEqual(response.data['updated'], 2)
+        self.assertEqual(Income.objects.filter(is_archive=True).count(), 3)
+        response = self.client.post('/api/v1/incomes/bulk-unarchive/', {'filter': {'year': 2023}}, format='json')
+        self.assertEqual(response.data['updated'], 3)
+        self.assertFalse(Income.objects.filter(is_archive=True, archived_by__isnull=False).exists())
+        self.assertFalse(Income.objects.filter(archived_at__isnull=False).exists())
+
+    def test_outcome_bulk_and_validation(self):
+        outcome = Outcome.objects.create(
+            to_company=self.company, contract_date='2024-01-10', contract_number='O', invoice_date='2024-01-10',
+            invoice_number='OI', unit_of_measure='шт', total=1.0,
+        )
+        response = self.client.post('/api/v1/outcomes/bulk-archive/', {'ids': [outcome.id]}, format='json')
+        self.assertEqual(response.data['results'], [{'id': outcome.id, 'status': 'archived'}])
+        self.assertEqual(
+            self.client.post('/api/v1/outcomes/bulk-archive/', {}, format='json').status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        self.assertEqual(
+            self.client.post('/api/v1/outcomes/bulk-archive/', {'ids': ['x']}, format='json').status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        self.client.force_authenticate(user=self.viewer)
+        response = self.client.post('/api/v1/outcomes/bulk-archive/', {'ids': [outcome.id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class NullTimestampKeysetTest(TransactionTestCase):
+    """Записи без created_at/archived_at (до миграции 0006): после 0020 курсор проходит их все."""
+
+    before = [('warehouse', '0019_revoked_token')]
+    after = [('warehouse', '0020_non_null_keyset_timestamps')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def setUp(self):
+        old_apps = self.migrate(self.before)
+        company = old_apps.get_model('warehouse', 'Company').objects.create(name='Co', phone='1', inn='1')
+        income_model = old_apps.get_model('warehouse', 'Income')
+        document = dict(
+            from_company=company,
+            contract_date='2024-01-01',
+            invoice_date='2024-01-01',
+            invoice_number='N',
+            unit_of_measure='шт',
+            total=1.0,
+        )
+        for i in range(5):
+            income_model.objects.create(contract_number=f'NEW-{i}', **document)
+        for i in range(5):
+            income_model.objects.create(contract_number=f'OLD-{i}', is_archive=True, **document)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE warehouse_income SET created_at = NULL, updated_at = NULL, archived_at = NULL "
+                "WHERE contract_number LIKE 'OLD-%%'"
+            )
+        self.migrate(self.after)
+        Group.objects.get_or_create(name='viewer')
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_user('viewer_null_keyset', 'pass', 'viewer'))
+
+    def walk(self, url):
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen += [row['contract_number'] for row in response.data['results']]
+            url = response.data['next']
+        return seen
+
+    @mock.patch.object(KeysetCursorPagination, 'page_size', 2)
+    def test_cursor_includes_legacy_rows(self):
+        seen = self.walk('/api/v1/incomes/?view=summary&pagination=cursor')
+        self.assertEqual(len(seen), 10)
+        # Старые записи получают LEGACY_CREATED_AT и идут после новых.
+        self.assertEqual(seen[5:], [f'OLD-{i}' for i in reversed(range(5))])
+
+    @mock.patch.object(KeysetCursorPagination, 'page_size', 2)
+    def test_archive_cursor_includes_legacy_rows(self):
+        seen = self.walk('/api/v1/incomes/?view=summary&is_archive=true&pagination=cursor')
+        self.assertEqual(sorted(seen), [f'OLD-{i}' for i in range(5)])
+        self.assertFalse(Income.objects.filter(is_archive=True, archived_at__isnull=True).exists())
@@ -0,0 +1,135 @@
+"""
+Refresh-токены с компактным отзывом (warehouse.RevokedToken) вместо таблиц token_blacklist:
+выпуск не пишет OutstandingToken, ротация и logout — одна вставка jti, проверка — поиск по первичному ключу.
+Повторное использование уже отозванного токена (две параллельные ротации одного refresh) отсекается
+уникальностью jti: вторая вставка не проходит.
+
+Недавно отозванные jti держатся в памяти процесса (recently_revoked) до истечения их exp. При ротации
+проверка отзыва идёт только по памяти: отозванный в другом процессе токен всё равно не пройдёт вставку jti.
+Истёкшие строки удаляет `manage.py prune_tokens`.
+"""
+import heapq
+import threading
+import time
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_api_settings
+from rest_framework_simplejwt.tokens import BlacklistMixin, RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from warehouse.models import RevokedToken
+
+
+PRUNE_BATCH_SIZE = 1000
+RECENTLY_REVOKED_LIMIT = 100_000
+
+
+class RecentlyRevoked:
+    """jti → exp отозванных токенов; запись выбрасывается, когда токен истёк (он и так не пройдёт проверку подписи)."""
+
+    def __init__(self, limit=RECENTLY_REVOKED_LIMIT):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._expires = {}
+        self._heap = []
+
+    def _evict(self, now):
+        while self._heap and (self._heap[0][0] <= now or len(self._expires) > self.limit):
+            exp, jti = heapq.heappop(self._heap)
+            if self._expires.get(jti) == exp:
+                del self._expires[jti]
+
+    def add(self, jti, exp):
+        with self._lock:
+            if jti not in self._expires:
+                self._expires[jti] = exp
+                heapq.heappush(self._heap, (exp, jti))
+            self._evict(time.time())
+
+    def __contains__(self, jti):
+        with self._lock:
+            self._evict(time.time())
+            return jti in self._expires
+
+    def __len__(self):
+        return len(self._expires)
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+            self._heap.clear()
+
+
+recently_revoked = RecentlyRevoked()
+
+
+def is_revoked(jti, exp):
+    if jti in recently_revoked:
+        return True
+    if RevokedToken.objects.filter(jti=jti).exists():
+        recently_revoked.add(jti, exp)
+        return True
+    return False
+
+
+def revoke(jti, exp):
+    """True — токен отозван этим вызовом; False — он уже был отозван раньше."""
+    if jti in recently_revoked:
+        return False
+    try:
+        with transaction.atomic():
+            RevokedToken.objects.create(jti=jti, expires_at=datetime_from_epoch(exp))
+    except IntegrityError:
+        recently_revoked.add(jti, exp)
+        return False
+    recently_revoked.add(jti, exp)
+    return True
+
+
+class CompactRefreshToken(RefreshToken):
+    def check_blacklist(self):
+        if is_revoked(self.payload[jwt_api_settings.JTI_CLAIM], self.payload['exp']):
+            raise TokenError('Токен отозван')
+
+    def blacklist(self):
+        return revoke(self.payload[jwt_api_settings.JTI_CLAIM], self.payload['exp'])
+
+    @classmethod
+    def for_user(cls, user):
+        # Минуя BlacklistMixin.for_user: список выпущенных токенов (OutstandingToken) не ведём.
+        return super(BlacklistMixin, cls).for_user(user)
+
+
+class RotatingRefreshToken(CompactRefreshToken):
+    """Токен, который сейчас будет ротирован: окончательную проверку отзыва делает вставка jti в blacklist()."""
+
+    def check_blacklist(self):
+        if self.payload[jwt_api_settings.JTI_CLAIM] in recently_revoked:
+            raise TokenError('Токен отозван')
+
+
+def _prune(queryset, key, batch_size, pause):
+    """Удаляет строки queryset пачками по ключу: каждая пачка — отдельный короткий DELETE ... WHERE key IN (...)."""
+    deleted = 0
+    while True:
+        keys = list(queryset.order_by().values_list(key, flat=True)[:batch_size])
+        if not keys:
+            return deleted
+        queryset.model.objects.filter(**{f'{key}__in': keys}).delete()
+        deleted += len(keys)
+        if pause:
+            time.sleep(pause)
+
+
+def prune_expired_tokens(batch_size=PRUNE_BATCH_SIZE, pause=0):
+    """{таблица: удалено строк} — отзывы и записи token_blacklist с истёкшим сроком."""
+    now = timezone.now()
+    return {
+        'revoked': _prune(RevokedToken.objects.filter(expires_at__lt=now), 'jti', batch_size, pause),
+        # Сначала чёрный список: тогда удаление выпущенных токенов не каскадирует на него.
+        'blacklisted': _prune(BlacklistedToken.objects.filter(token__expires_at__lt=now), 'id', batch_size, pause),
+        'outstanding': _prune(OutstandingToken.objects.filter(expires_at__lt=now), 'id', batch_size, pause),
+    }
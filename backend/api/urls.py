@@ -2,10 +2,10 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
 from .views import (
-    CompanyViewSet, ProductViewSet, ProductMarkingViewSet, IncomeViewSet, OutcomeViewSet,
+    CompanyViewSet, ProductViewSet, ProductMarkingViewSet, IncomeViewSet, OutcomeViewSet, JobViewSet,
     UpdateMarkingView, MyTokenObtainPairView, MyTokenRefreshView, RegisterView, logout_view,
     check_marking_exists, check_markings_batch, dashboard_stats,
-    AdminUserViewSet, AdminRoleViewSet, AdminResetPasswordView,
+    AdminUserViewSet, AdminRoleViewSet, AdminResetPasswordView, AdminMarkingFilterView,
 )
 
 router = DefaultRouter()
@@ -14,6 +14,7 @@ router.register(r'products', ProductViewSet)
 router.register(r'product-markings', ProductMarkingViewSet)
 router.register(r'incomes', IncomeViewSet)
 router.register(r'outcomes', OutcomeViewSet)
+router.register(r'jobs', JobViewSet)
 
 admin_router = DefaultRouter()
 admin_router.register(r'users', AdminUserViewSet, basename='admin-users')
@@ -25,6 +26,7 @@ urlpatterns = [
     path('stats/dashboard/', dashboard_stats, name='dashboard-stats'),
     path('admin/', include(admin_router.urls)),
     path('admin/reset-password/', AdminResetPasswordView.as_view(), name='admin-reset-password'),
+    path('admin/marking-filter/', AdminMarkingFilterView.as_view(), name='admin-marking-filter'),
     path('incomes/<int:income_id>/products/<int:product_id>/markings/<int:marking_id>/',
          UpdateMarkingView.as_view(), name='update-marking'),
     path('product-markings/check-marking/<str:marking>/', check_marking_exists, name='check-marking'),
@@ -3,7 +3,7 @@ from rest_framework.views import APIView
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 from rest_framework_simplejwt.settings import api_settings as jwt_api_settings
@@ -16,22 +16,44 @@ from rest_framework.viewsets import GenericViewSet
 from django.contrib.auth.models import Group
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.db import transaction
+import base64
 import logging
-from collections import Counter
-from django.db.models import Count, Q, Sum
-from django.db.models.functions import TruncMonth
+from django.db.models import Count, Prefetch, Q
 from django_filters.rest_framework import DjangoFilterBackend
-from warehouse.models import Company, Product, ProductMarking, Income, Outcome, CustomUser
+from warehouse.models import Company, Product, ProductMarking, Income, Outcome, CustomUser, Job, DashboardRollup
+from warehouse.archive import ARCHIVED, NOT_FOUND, UNARCHIVED, set_archived
+from warehouse.bloom import marking_filter
+from warehouse.digest import marking_exists
+from warehouse.jobs import enqueue
+from warehouse.search import marking_search_q
+from warehouse.stock import adjust_stock, free_counts
 from .serializers import (
     CompanySerializer, ProductSerializer, ProductMarkingSerializer, IncomeSerializer,
     OutcomeSerializer,
     ProductSelectSerializer,
     AdminUserListSerializer, AdminUserCreateSerializer, AdminUserUpdateSerializer, GroupSerializer,
+    JobSerializer, IncomeSummarySerializer, OutcomeSummarySerializer,
+    with_marking_relations,
 )
 from .permissions import IsOperatorOrAdminOrReadOnly, IsPlatformAdmin
+from .authentication import is_denied
+from .roles import get_user_roles
+from .tokens import CompactRefreshToken, RotatingRefreshToken
 from .responses import error_response, _first_validation_message
+from .documents import MAX_BATCH_DOCUMENTS, load_documents, render_documents_page
+from .export import (
+    CSV_CONTENT_TYPE, INCOME_EXPORT, OUTCOME_EXPORT, XLSX_CONTENT_TYPE, csv_stream, export_rows, xlsx_stream,
+)
+from .jobs import markings_count
 from .filters import IncomeFilter, OutcomeFilter, ProductMarkingFilter
+from .markings import (
+    check_markings, import_markings, iter_csv_rows, iter_ndjson_markings, iter_ndjson_rows, iter_plain_markings,
+    summarize_import,
+)
+from .pagination import OptionalCursorPagination
 
 
 class CompanyViewSet(viewsets.ModelViewSet):
@@ -41,12 +63,9 @@ class CompanyViewSet(viewsets.ModelViewSet):
 
 
 class ProductViewSet(viewsets.ModelViewSet):
-    # stock = число ProductMarking у продукта с outcome IS NULL.
-    # Связь Product -> ProductMarking: related_name="product" (ProductMarking.product -> Product).
-    # Считаем маркировки: Count(обратная_связь, filter=обратная_связь__outcome__isnull=True).
-    queryset = Product.objects.annotate(
-        stock=Count('product', filter=Q(product__outcome__isnull=True))
-    )
+    # stock = Product.quantity: счётчик свободных маркировок, поддерживается при каждом изменении маркировок
+    # (warehouse.stock) — без GROUP BY по всей таблице маркировок на каждую страницу.
+    queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated, IsOperatorOrAdminOrReadOnly]
 
@@ -74,21 +93,26 @@ class ProductViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+def marking_archived_error(income_id):
+    return error_response(
+        'ARCHIVED',
+        'Нельзя изменять маркировки в архивном документе прихода.',
+        details={'income_id': income_id},
+        status_code=status.HTTP_400_BAD_REQUEST,
+    )
+
+
 class ProductMarkingViewSet(viewsets.ModelViewSet):
     queryset = ProductMarking.objects.select_related('income', 'product', 'outcome').all()
     serializer_class = ProductMarkingSerializer
     permission_classes = [IsAuthenticated, IsOperatorOrAdminOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_class = ProductMarkingFilter
+    pagination_class = OptionalCursorPagination
     http_method_names = ['get', 'post', 'put', 'delete']
 
     def _marking_archived_error(self, income_id):
-        return error_response(
-            'ARCHIVED',
-            'Нельзя изменять маркировки в архивном документе прихода.',
-            details={'income_id': income_id},
-            status_code=status.HTTP_400_BAD_REQUEST,
-        )
+        return marking_archived_error(income_id)
 
     def _is_archived_income(self, marking):
         return marking.income_id is not None and marking.income is not None and marking.income.is_archive
@@ -144,10 +168,11 @@ class ProductMarkingViewSet(viewsets.ModelViewSet):
 
         Оптимизация: select_related('product', 'income') убирает N+1 при отдаче
         product_name, product_kpi, income_unit_of_measure. Индексы: outcome_id, product_id, income_id.
-        Поиск по marking (icontains). Для Postgres: при росте данных можно добавить
-        pg_trgm и GIN-индекс по marking для ускорения ILIKE.
+        Поиск по marking — через индекс поиска (warehouse.search: FTS5 trigram на SQLite, pg_trgm на Postgres),
+        по названию товара — по маленькой таблице товаров, дальше по индексу product_id.
 
-        Query params: search (по marking, product name), page.
+        Query params: search (по marking, product name), page; pagination=cursor / cursor — keyset
+        по (-created_at, -id) без OFFSET (глубокие страницы не замедляются с ростом склада).
         """
         qs = (
             ProductMarking.objects.filter(
@@ -155,13 +180,14 @@ class ProductMarkingViewSet(viewsets.ModelViewSet):
                 income__is_archive=False,
             )
             .select_related('product', 'income')
-            .order_by('-created_at')
+            .order_by('-created_at', '-id')
         )
 
         search = (request.query_params.get('search') or '').strip()
         if search:
             qs = qs.filter(
-                Q(marking__icontains=search) | Q(product__name__icontains=search)
+                marking_search_q(search)
+                | Q(product_id__in=Product.objects.filter(name__icontains=search).values('id'))
             )
         
         page = self.paginate_queryset(qs)
@@ -173,27 +199,243 @@ class ProductMarkingViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+def wants_async(request):
+    """?async=1 — тяжёлую операцию выполняет фоновая задача (manage.py run_jobs), ответ 202 с id задачи."""
+    return (request.query_params.get('async') or '').strip().lower() in ('1', 'true')
+
+
+def job_accepted_response(job):
+    return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+def is_summary_view(request):
+    return (request.query_params.get('view') or '').strip().lower() == 'summary'
+
+
+class SummaryListMixin:
+    """
+    ?view=summary для списка документов: шапка + количество маркировок по товарам, без массивов маркировок.
+    Счётчики — один GROUP BY по маркировкам документов текущей страницы (annotate(Count) в SQL).
+    Полные маркировки отдаёт только детальный эндпоинт.
+    """
+    summary_serializer_class = None
+    summary_marking_field = None  # FK ProductMarking → документ: 'income' / 'outcome'
+
+    def is_summary(self):
+        return self.action == 'list' and is_summary_view(self.request)
+
+    def get_serializer_class(self):
+        if self.is_summary():
+            return self.summary_serializer_class
+        return super().get_serializer_class()
+
+    def product_counts(self, document_ids):
+        field = f'{self.summary_marking_field}_id'
+        rows = (
+            ProductMarking.objects.filter(**{f'{field}__in': document_ids})
+            .values(field, 'product_id', 'product__name', 'product__kpi', 'product__price')
+            .annotate(count=Count('id'))
+            .order_by(field, 'product__name', 'product_id')
+        )
+        counts = {}
+        for row in rows:
+            counts.setdefault(row[field], []).append({
+                'product': row['product_id'],
+                'name': row['product__name'],
+                'kpi': row['product__kpi'],
+                'price': row['product__price'],
+                'count': row['count'],
+            })
+        return counts
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_summary():
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        documents = page if page is not None else list(queryset)
+        context = self.get_serializer_context()
+        context['product_counts'] = self.product_counts([d.id for d in documents])
+        serializer = self.get_serializer_class()(documents, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+
+
+class ExportMixin:
+    """
+    GET .../export/?type=csv|xlsx — документы под теми же фильтрами, что и список, с маркировками — потоком (api.export):
+    одна выборка values_list через iterator(), без моделей и сериалайзеров; память не зависит от объёма выгрузки.
+    """
+    export_spec = None  # (колонки, связь документ → маркировки): INCOME_EXPORT / OUTCOME_EXPORT
+    export_name = None
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request):
+        file_type = (request.query_params.get('type') or 'csv').strip().lower()
+        if file_type not in ('csv', 'xlsx'):
+            return error_response(
+                'VALIDATION_ERROR',
+                'Параметр type: csv или xlsx',
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        columns, marking_relation = self.export_spec
+        queryset = self.filter_queryset(self.get_queryset()).prefetch_related(None)
+        rows = export_rows(queryset, columns, marking_relation)
+        headers = [header for header, _ in columns]
+        if file_type == 'xlsx':
+            response = StreamingHttpResponse(xlsx_stream(headers, rows), content_type=XLSX_CONTENT_TYPE)
+        else:
+            response = StreamingHttpResponse(csv_stream(headers, rows), content_type=CSV_CONTENT_TYPE)
+        filename = f'{self.export_name}-{timezone.localdate():%Y%m%d}.{file_type}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+class PrintableDocumentMixin:
+    """
+    Печатная форма на сервере (api.documents): GET .../{id}/document/ и пачкой GET .../documents/?ids=1,2,3.
+    Маркировки не загружаются — строки по товарам считаются GROUP BY; формы архивных документов кэшируются.
+    """
+    document_kind = None  # 'income' / 'outcome'
+
+    def _document_response(self, ids):
+        documents, missing = load_documents(self.document_kind, ids)
+        if missing:
+            return error_response(
+                'NOT_FOUND',
+                'Документ не найден',
+                details={'missing': missing},
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        html = render_documents_page(self.document_kind, documents)
+        return HttpResponse(html, content_type='text/html; charset=utf-8')
+
+    @action(detail=True, methods=['get'], url_path='document')
+    def document(self, request, pk=None):
+        try:
+            return self._document_response([int(pk)])
+        except ValueError:
+            return error_response('NOT_FOUND', 'Документ не найден', status_code=status.HTTP_404_NOT_FOUND)
+
+    @action(detail=False, methods=['get'], url_path='documents')
+    def documents(self, request):
+        raw = [part.strip() for part in (request.query_params.get('ids') or '').split(',') if part.strip()]
+        try:
+            ids = list(dict.fromkeys(int(part) for part in raw))
+        except ValueError:
+            return error_response('VALIDATION_ERROR', 'ids: список id через запятую')
+        if not ids or len(ids) > MAX_BATCH_DOCUMENTS:
+            return error_response('VALIDATION_ERROR', f'ids: от 1 до {MAX_BATCH_DOCUMENTS} документов')
+        return self._document_response(ids)
+
+
+class BulkArchiveMixin:
+    """
+    POST .../bulk-archive/ и .../bulk-unarchive/: {"ids": [...]} или {"filter": {параметры фильтра списка}}.
+    Один UPDATE на чанк (warehouse.archive), без save() каждого документа; в ответе — статус по каждому id.
+    """
+    MAX_BULK_IDS = 10000
+
+    def _bulk_ids(self, request, archived):
+        """(ids, None) или (None, ответ с ошибкой)."""
+        ids, filters = request.data.get('ids'), request.data.get('filter')
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                return None, error_response('VALIDATION_ERROR', 'ids: список целых id')
+            return ids, None
+        if not isinstance(filters, dict) or not filters:
+            return None, error_response('VALIDATION_ERROR', 'Укажите ids или непустой filter')
+        model = self.filterset_class._meta.model
+        filterset = self.filterset_class(data=filters, queryset=model.objects.order_by('id'), request=request)
+        if not filterset.is_valid():
+            return None, error_response(
+                'VALIDATION_ERROR', _first_validation_message(filterset.errors), details=filterset.errors,
+            )
+        # Документы, которые уже в нужном состоянии, по фильтру не трогаем.
+        queryset = filterset.qs.filter(is_archive__in=[not archived])
+        return list(queryset.values_list('id', flat=True)[:self.MAX_BULK_IDS + 1]), None
+
+    def _bulk_set_archived(self, request, archived):
+        ids, error = self._bulk_ids(request, archived)
+        if error is not None:
+            return error
+        if len(ids) > self.MAX_BULK_IDS:
+            return error_response('VALIDATION_ERROR', f'Не больше {self.MAX_BULK_IDS} документов за запрос')
+        model = self.filterset_class._meta.model
+        results = set_archived(model, ids, archived, user_id=request.user.id if archived else None)
+        changed = ARCHIVED if archived else UNARCHIVED
+        return Response({
+            'updated': sum(1 for result in results.values() if result == changed),
+            'results': [{'id': doc_id, 'status': result} for doc_id, result in results.items()],
+        }, status=status.HTTP_200_OK)
+
+    def _set_one_archived(self, pk, archived):
+        """archive/unarchive одного документа — тем же UPDATE, без загрузки и save() всей строки."""
+        try:
+            doc_id = int(pk)
+        except (TypeError, ValueError):
+            doc_id = None
+        model = self.filterset_class._meta.model
+        user_id = self.request.user.id if archived else None
+        if doc_id is None or set_archived(model, [doc_id], archived, user_id=user_id)[doc_id] == NOT_FOUND:
+            return error_response('NOT_FOUND', 'Документ не найден', status_code=status.HTTP_404_NOT_FOUND)
+        return Response({'detail': 'ok', 'is_archive': archived}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], url_path='bulk-archive')
+    def bulk_archive(self, request):
+        return self._bulk_set_archived(request, True)
+
+    @action(detail=False, methods=['post'], url_path='bulk-unarchive')
+    def bulk_unarchive(self, request):
+        return self._bulk_set_archived(request, False)
+
 # Правило архива: is_archive=True = полная заморозка документа (финальная фиксация).
 # Нельзя: updateIncome, updateMarking, deleteMarking для прихода/маркировок прихода;
 # updateOutcome для расхода; архивный документ можно только удалить (после архивации).
 # Изменение is_archive только через POST .../archive/ и .../unarchive/.
 
 
-class IncomeViewSet(viewsets.ModelViewSet):
+class IncomeViewSet(SummaryListMixin, ExportMixin, PrintableDocumentMixin, BulkArchiveMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated, IsOperatorOrAdminOrReadOnly]
-    queryset = Income.objects.prefetch_related("income").select_related('from_company', 'added_by').order_by('-created_at', '-id')
+    queryset = Income.objects.select_related('from_company', 'added_by').order_by('-created_at', '-id')
     serializer_class = IncomeSerializer
+    summary_serializer_class = IncomeSummarySerializer
+    summary_marking_field = 'income'
+    export_spec = INCOME_EXPORT
+    export_name = 'incomes'
+    document_kind = 'income'
+    pagination_class = OptionalCursorPagination
     filter_backends = [DjangoFilterBackend]
     filterset_class = IncomeFilter
 
     def get_queryset(self):
-        """Все приходы видны всем авторизованным пользователям (без фильтра по added_by)."""
-        qs = Income.objects.prefetch_related("income").select_related('from_company', 'added_by')
+        """
+        Все приходы видны всем авторизованным пользователям (без фильтра по added_by).
+        Маркировки с товаром — один prefetch-запрос на страницу (unit_of_measure берётся у самого прихода);
+        в ?view=summary маркировки не грузятся вовсе.
+        """
+        qs = Income.objects.select_related('from_company', 'added_by')
+        if not self.is_summary():
+            qs = qs.prefetch_related(
+                Prefetch('income', queryset=ProductMarking.objects.select_related('product'))
+            )
         if self.request.query_params.get('is_archive') == 'true':
             # Последний добавленный в архив — первым в списке
             return qs.order_by('-archived_at', '-id')
         return qs.order_by('-created_at', '-id')
 
+    def create(self, request, *args, **kwargs):
+        """?async=1: payload валидируется сразу, запись прихода и маркировок — в фоновой задаче."""
+        if not wants_async(request):
+            return super().create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return job_accepted_response(enqueue(
+            'income_create', request.data, user=request.user, total=markings_count(serializer.validated_data),
+        ))
+
     # Правило архива (must при странице /archive): архивный приход — только чтение. PUT/PATCH → 400.
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -220,21 +462,51 @@ class IncomeViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], url_path='archive')
     def archive(self, request, pk=None):
         """Правило №2: архивировать перед удалением. Аудит: archived_at, archived_by."""
-        income = self.get_object()
-        income.is_archive = True
-        income.archived_at = timezone.now()
-        income.archived_by = request.user
-        income.save()
-        return Response({'detail': 'ok', 'is_archive': True}, status=status.HTTP_200_OK)
+        return self._set_one_archived(pk, True)
 
     @action(detail=True, methods=['post'], url_path='unarchive')
     def unarchive(self, request, pk=None):
-        income = self.get_object()
-        income.is_archive = False
-        income.archived_at = None
-        income.archived_by = None
-        income.save()
-        return Response({'detail': 'ok', 'is_archive': False}, status=status.HTTP_200_OK)
+        return self._set_one_archived(pk, False)
+
+    @action(detail=True, methods=['post'], url_path='markings/import')
+    def import_markings(self, request, pk=None):
+        """
+        Потоковый импорт маркировок из выгрузки сканера в приход.
+        Тело — CSV или NDJSON (Content-Type text/csv | application/x-ndjson, либо ?type=csv|ndjson):
+        читается построчно и пишется чанками, память не растёт с размером файла.
+        CSV: заголовок marking,product,counter или колонки по порядку. NDJSON: объект или строка на строку.
+        Товар строки: product (id) либо name,kpi,price — через резолвер товаров (недостающие создаются).
+        Query params: product — id товара для строк без колонок товара.
+        Правила: как у ProductMarkingViewSet (архивный приход — 400 ARCHIVED),
+        дубликаты — как в check_markings_batch (exists / duplicates), конфликтные строки пропускаются.
+        Ответ: received, created; exists / duplicates / invalid (номера строк) — первые IMPORT_CONFLICTS_LIMIT
+        на весь импорт и *_count с полными количествами, truncated — списки обрезаны; chunks — счётчики по чанкам.
+        """
+        income = generics.get_object_or_404(Income.objects.all(), pk=pk)
+        if income.is_archive:
+            return marking_archived_error(income.id)
+
+        content_type = (request.content_type or '').split(';')[0].strip().lower()
+        body_type = (request.query_params.get('type') or '').strip().lower()
+        if not body_type:
+            body_type = 'csv' if content_type in ('text/csv', 'application/csv') else 'ndjson'
+        if body_type not in ('csv', 'ndjson'):
+            return error_response(
+                "BAD_REQUEST",
+                "Поддерживаются форматы csv и ndjson",
+                details={'type': body_type},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        if request.stream is None:
+            return error_response(
+                "BAD_REQUEST",
+                "Пустое тело запроса",
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+
+        rows = iter_csv_rows(request.stream) if body_type == 'csv' else iter_ndjson_rows(request.stream)
+        chunks = import_markings(income, rows, default_product_id=request.query_params.get('product'))
+        return Response({'income': income.id, **summarize_import(chunks)}, status=status.HTTP_200_OK)
 
     def destroy(self, request, *args, **kwargs):
         income = self.get_object()
@@ -256,26 +528,54 @@ class IncomeViewSet(viewsets.ModelViewSet):
             )
 
         related_markings = ProductMarking.objects.filter(income=income)
-        related_markings.delete()
-        income.delete()
+        with transaction.atomic():
+            # Списанных нет (проверено выше): все удаляемые маркировки были в остатке.
+            adjust_stock({pid: -count for pid, count in free_counts(related_markings).items()})
+            related_markings.delete()
+            income.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class OutcomeViewSet(viewsets.ModelViewSet):
-    queryset = Outcome.objects.select_related('to_company', 'added_by').prefetch_related('product_markings').order_by('-created_at', '-id')
+class OutcomeViewSet(SummaryListMixin, ExportMixin, PrintableDocumentMixin, BulkArchiveMixin, viewsets.ModelViewSet):
+    queryset = Outcome.objects.select_related('to_company', 'added_by').order_by('-created_at', '-id')
     serializer_class = OutcomeSerializer
+    summary_serializer_class = OutcomeSummarySerializer
+    summary_marking_field = 'outcome'
+    export_spec = OUTCOME_EXPORT
+    export_name = 'outcomes'
+    document_kind = 'outcome'
+    pagination_class = OptionalCursorPagination
     permission_classes = [IsAuthenticated, IsOperatorOrAdminOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_class = OutcomeFilter
 
     def get_queryset(self):
-        """Все расходы видны всем авторизованным пользователям (без фильтра по added_by)."""
-        qs = Outcome.objects.select_related('to_company', 'added_by').prefetch_related('product_markings')
+        """
+        Все расходы видны всем авторизованным пользователям (без фильтра по added_by).
+        Маркировки с товаром и приходом — одним prefetch-запросом на страницу: число запросов
+        не зависит ни от размера страницы, ни от числа маркировок в расходе.
+        В ?view=summary маркировки не грузятся вовсе.
+        """
+        qs = Outcome.objects.select_related('to_company', 'added_by')
+        if not self.is_summary():
+            qs = qs.prefetch_related(
+                Prefetch('product_markings', queryset=with_marking_relations(ProductMarking.objects.all()))
+            )
         if self.request.query_params.get('is_archive') == 'true':
             # Последний добавленный в архив — первым в списке
             return qs.order_by('-archived_at', '-id')
         return qs.order_by('-created_at', '-id')
 
+    def create(self, request, *args, **kwargs):
+        """?async=1: payload валидируется сразу, списание маркировок — в фоновой задаче."""
+        if not wants_async(request):
+            return super().create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return job_accepted_response(enqueue(
+            'outcome_create', request.data, user=request.user, total=markings_count(serializer.validated_data),
+        ))
+
     # Правило архива (must при отдельной странице /archive): архивный расход — только чтение.
     # PUT/PATCH/DELETE по архиву: редактирование запрещено (400); удаление — только после архива, затем разрешено.
     def update(self, request, *args, **kwargs):
@@ -302,21 +602,11 @@ class OutcomeViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post'], url_path='archive')
     def archive(self, request, pk=None):
-        outcome = self.get_object()
-        outcome.is_archive = True
-        outcome.archived_at = timezone.now()
-        outcome.archived_by = request.user
-        outcome.save()
-        return Response({'detail': 'ok', 'is_archive': True}, status=status.HTTP_200_OK)
+        return self._set_one_archived(pk, True)
 
     @action(detail=True, methods=['post'], url_path='unarchive')
     def unarchive(self, request, pk=None):
-        outcome = self.get_object()
-        outcome.is_archive = False
-        outcome.archived_at = None
-        outcome.archived_by = None
-        outcome.save()
-        return Response({'detail': 'ok', 'is_archive': False}, status=status.HTTP_200_OK)
+        return self._set_one_archived(pk, False)
 
     def destroy(self, request, *args, **kwargs):
         outcome = self.get_object()
@@ -327,11 +617,28 @@ class OutcomeViewSet(viewsets.ModelViewSet):
                 details={'id': outcome.id},
                 status_code=status.HTTP_400_BAD_REQUEST,
             )
-        ProductMarking.objects.filter(outcome=outcome).update(outcome=None)
-        outcome.delete()
+        markings = ProductMarking.objects.filter(outcome=outcome)
+        with transaction.atomic():
+            returned = dict(markings.order_by().values_list('product_id').annotate(count=Count('id')))
+            markings.update(outcome=None)
+            adjust_stock(returned)
+            outcome.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class JobViewSet(GenericViewSet, ListModelMixin, RetrieveModelMixin):
+    """Фоновые задачи: опрос статуса и прогресса (GET /jobs/<id>/). Пользователь видит свои задачи, admin — все."""
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        qs = Job.objects.select_related('created_by').order_by('-id')
+        if IsPlatformAdmin().has_permission(self.request, self):
+            return qs
+        return qs.filter(created_by=self.request.user)
+
+
 class UpdateMarkingView(APIView):
     """PUT/DELETE маркировки в приходе. Запрет, если marking.outcome != null (уже списана)."""
     permission_classes = [IsAuthenticated, IsOperatorOrAdminOrReadOnly]
@@ -404,6 +711,8 @@ class UpdateMarkingView(APIView):
 
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = CompactRefreshToken
+
     @classmethod
     def get_token(cls, user):
         token = super(MyTokenObtainPairSerializer, cls).get_token(user)
@@ -414,10 +723,15 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
         token['email'] = user.email
         token['phone'] = user.phone
         token['position'] = user.position
+        # Роли на момент выпуска — для клиента и ClaimsUser.token_groups; права проверяются через api.roles.
+        roles = get_user_roles(user)
+        token['groups'] = sorted(roles.groups)
+        token['is_superuser'] = roles.is_superuser
         return token
 
     def validate(self, attrs):
         data = super().validate(attrs)
+        roles = get_user_roles(self.user)
         data.update({
             'username': self.user.username,
             'first_name': self.user.first_name,
@@ -425,8 +739,8 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
             'email': self.user.email,
             'phone': self.user.phone,
             'position': self.user.position,
-            'groups': [g.name for g in self.user.groups.all()],
-            'is_superuser': self.user.is_superuser,
+            'groups': sorted(roles.groups),
+            'is_superuser': roles.is_superuser,
         })
         return data
 
@@ -436,27 +750,39 @@ class MyTokenObtainPairView(TokenObtainPairView):
 
 
 class MyTokenRefreshSerializer(TokenRefreshSerializer):
-    """Добавляем groups в ответ refresh для UI (безопасность — по request.user.groups)."""
+    """
+    Ротация refresh за один разбор токена: подпись и отзыв проверяются в конструкторе, роли — из кэша api.roles,
+    отзыв старого токена — одна вставка jti (api.tokens). groups в ответе — для UI (безопасность — по группам в БД).
+    """
+    token_class = CompactRefreshToken
 
     def validate(self, attrs):
-        # Получаем user_id до super().validate(): после него токен попадёт в blacklist,
-        # и повторный RefreshToken(attrs['refresh']) вызовет TokenError при verify().
-        refresh = RefreshToken(attrs['refresh'])
+        rotating = jwt_api_settings.ROTATE_REFRESH_TOKENS and jwt_api_settings.BLACKLIST_AFTER_ROTATION
+        # При ротации отзыв проверяется вставкой jti, без отдельного запроса (api.tokens).
+        refresh = (RotatingRefreshToken if rotating else self.token_class)(attrs['refresh'])
         user_id = refresh.payload.get(jwt_api_settings.USER_ID_CLAIM)
-
-        data = super().validate(attrs)
-
-        if user_id:
-            user = get_user_model().objects.filter(**{jwt_api_settings.USER_ID_FIELD: user_id}).first()
-            if user:
-                data['groups'] = [g.name for g in user.groups.all()]
-                data['is_superuser'] = user.is_superuser
-            else:
-                data['groups'] = []
-                data['is_superuser'] = False
-        else:
-            data['groups'] = []
-            data['is_superuser'] = False
+        if user_id and is_denied(user_id):
+            raise TokenError('Пользователь отключён')
+
+        # Удалённый пользователь — пустые роли. Claims обновляем, чтобы новый access нёс актуальные роли.
+        roles = get_user_roles(user_id) if user_id else None
+        groups = sorted(roles.groups) if roles else []
+        is_superuser = roles.is_superuser if roles else False
+        refresh['groups'] = groups
+        refresh['is_superuser'] = is_superuser
+
+        data = {'access': str(refresh.access_token)}
+        if jwt_api_settings.ROTATE_REFRESH_TOKENS:
+            if jwt_api_settings.BLACKLIST_AFTER_ROTATION and not refresh.blacklist():
+                # Уже отозван: ротирован раньше (в том числе параллельным запросом) или logout в другом процессе.
+                raise TokenError('Токен отозван')
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+
+        data['groups'] = groups
+        data['is_superuser'] = is_superuser
         return data
 
 
@@ -500,7 +826,7 @@ def logout_view(request):
                 "Требуется refresh_token",
                 status_code=status.HTTP_400_BAD_REQUEST,
             )
-        token = RefreshToken(refresh_token)
+        token = CompactRefreshToken(refresh_token)
         token.blacklist()
         return Response(status=status.HTTP_205_RESET_CONTENT)
     except Exception:
@@ -513,47 +839,109 @@ def logout_view(request):
 
 @api_view(['GET'])
 def check_marking_exists(request, marking):
-    exists = ProductMarking.objects.filter(marking=marking).exists()
+    # Скан на приёмке — почти всегда новый код: фильтр Блума отвечает «точно нет» без запроса к базе.
+    if not marking_filter.might_exist(marking):
+        return Response({'exists': False})
+    exists = marking_exists(ProductMarking.objects.all(), marking)
+    if not exists:
+        marking_filter.record_false_positives(1)
     return Response({'exists': exists})
 
 
+CHECK_RESULT_FORMATS = ('lists', 'indexes', 'bitmap')
+
+
+def _set_bit(bitmap, position):
+    """Бит position (младший бит байта — первая позиция); bytearray растёт по мере чтения потока."""
+    index = position // 8
+    if index >= len(bitmap):
+        bitmap.extend(b'\0' * (index + 1 - len(bitmap)))
+    bitmap[index] |= 1 << (position % 8)
+
+
 @api_view(['POST'])
 @perm_classes([IsAuthenticated])
 def check_markings_batch(request):
     """
-    Проверка маркировок пачкой.
-    Body: { "markings": ["ABC1", "ABC2", ...] }
-    Response: { "exists": [...], "duplicates": [...] }
-    exists — уже есть в базе; duplicates — повторились внутри запроса.
+    Проверка маркировок пачкой любого размера: чанками по marking_hash, по запросу на чанк.
+    Body: { "markings": ["ABC1", "ABC2", ...] } либо потоком — text/plain (маркировка на строку)
+    или application/x-ndjson (строка или {"marking": ...} на строку); поток читается построчно.
+    ?result= формат ответа:
+    - lists (по умолчанию): { "exists": [...], "duplicates": [...] } — exists уже есть в базе,
+      duplicates — значения, повторившиеся внутри запроса;
+    - indexes: { "total", "exists": [позиции], "duplicates": [позиции повторов], "empty": [позиции] };
+    - bitmap: то же битовыми масками в base64 (бит i = позиция i, младший бит байта — первая позиция).
+    Позиции — с нуля, в порядке присланных маркировок; в потоковом теле позиция i — строка i + 1
+    (пустая строка — пустая позиция, в empty).
     """
-    markings = request.data.get('markings')
-    if not isinstance(markings, list):
+    result_format = (request.query_params.get('result') or 'lists').strip().lower()
+    if result_format not in CHECK_RESULT_FORMATS:
         return Response(
-            {'error': 'Ожидается массив markings'},
+            {'error': f'result: одно из {", ".join(CHECK_RESULT_FORMATS)}'},
             status=status.HTTP_400_BAD_REQUEST,
         )
-    # Нормализуем: строки, без пустых
-    normalized = [str(m).strip() for m in markings if m is not None and str(m).strip()]
-    if not normalized:
-        return Response({'exists': [], 'duplicates': []})
-
-    # Дубликаты внутри запроса (значения, встречающиеся больше одного раза)
-    counts = Counter(normalized)
-    duplicates = [m for m, c in counts.items() if c > 1]
 
-    # Уже есть в базе
-    unique_markings = list(set(normalized))
-    existing_qs = ProductMarking.objects.filter(marking__in=unique_markings)
-    exists = list(existing_qs.values_list('marking', flat=True))
+    content_type = (request.content_type or '').split(';')[0].strip().lower()
+    if content_type == 'text/plain':
+        markings = iter_plain_markings(request.stream or [])
+    elif content_type == 'application/x-ndjson':
+        markings = iter_ndjson_markings(request.stream or [])
+    else:
+        markings = request.data.get('markings')
+        if not isinstance(markings, list):
+            return Response(
+                {'error': 'Ожидается массив markings'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-    return Response({'exists': exists, 'duplicates': duplicates})
+    checks = check_markings(markings)
+    if result_format == 'lists':
+        # Прежний формат: уникальные значения в порядке первого появления
+        exists, duplicates = {}, {}
+        for check in checks:
+            if check.exists:
+                exists.setdefault(check.marking, None)
+            if check.repeat:
+                duplicates.setdefault(check.marking, None)
+        return Response({'exists': list(exists), 'duplicates': list(duplicates)})
+
+    total = 0
+    if result_format == 'indexes':
+        exists, duplicates, empty = [], [], []
+        for check in checks:
+            total += 1
+            if check.marking is None:
+                empty.append(check.position)
+            if check.exists:
+                exists.append(check.position)
+            if check.repeat:
+                duplicates.append(check.position)
+        return Response({'total': total, 'exists': exists, 'duplicates': duplicates, 'empty': empty})
+
+    exists, duplicates, empty = bytearray(), bytearray(), bytearray()
+    for check in checks:
+        total += 1
+        if check.marking is None:
+            _set_bit(empty, check.position)
+        if check.exists:
+            _set_bit(exists, check.position)
+        if check.repeat:
+            _set_bit(duplicates, check.position)
+    size = (total + 7) // 8
+    return Response({
+        'total': total,
+        'encoding': 'base64',
+        'exists': base64.b64encode(bytes(exists.ljust(size, b'\0'))).decode('ascii'),
+        'duplicates': base64.b64encode(bytes(duplicates.ljust(size, b'\0'))).decode('ascii'),
+        'empty': base64.b64encode(bytes(empty.ljust(size, b'\0'))).decode('ascii'),
+    })
 
 
 @api_view(['GET'])
 @perm_classes([IsAuthenticated])
 def dashboard_stats(request):
     """
-    Статистика для дашборда без загрузки всех записей: агрегаты по году, доступные годы, остаток.
+    Статистика для дашборда из готовых сводок (warehouse.rollups): агрегаты по году, доступные годы, остаток.
     GET ?year=2024 — по умолчанию текущий год.
     """
     from datetime import date
@@ -564,70 +952,45 @@ def dashboard_stats(request):
     except (TypeError, ValueError):
         year = date.today().year
 
-    # Доступные годы (есть приходы или расходы)
-    income_years = [d.year for d in Income.objects.dates('contract_date', 'year', order='DESC')]
-    outcome_years = [d.year for d in Outcome.objects.dates('contract_date', 'year', order='DESC')]
-    available_years = sorted(set(income_years) | set(outcome_years), reverse=True) or [year]
-
-    # Приходы по месяцам за год (агрегаты, без загрузки записей)
-    income_by_month = (
-        Income.objects.filter(contract_date__year=year)
-        .annotate(month=TruncMonth('contract_date'))
-        .values('month')
-        .annotate(
-            doc_count=Count('id'),
-            total=Sum('total'),
-            items=Count('income', distinct=False),
-        )
+    # Всё из сводок DashboardRollup (warehouse.rollups): строки года по обоим направлениям и строка остатка —
+    # один запрос по уникальному индексу (direction, year, month), плюс список лет из той же маленькой таблицы.
+    rows = DashboardRollup.objects.filter(
+        Q(year=year, direction__in=(DashboardRollup.DIRECTION_INCOME, DashboardRollup.DIRECTION_OUTCOME))
+        | Q(direction=DashboardRollup.DIRECTION_STOCK, year=0, month=0)
     )
-    month_to_income = {row['month'].month: row for row in income_by_month if row['month']}
-    income_by_month_12 = []
-    income_total_count = 0
-    income_total_sum = 0.0
-    income_total_items = 0
-    for m in range(1, 13):
-        row = month_to_income.get(m, {'doc_count': 0, 'total': 0, 'items': 0})
-        total = float(row['total'] or 0)
-        doc_count = row['doc_count'] or 0
-        items = row['items'] or 0
-        income_by_month_12.append({'month': m, 'doc_count': doc_count, 'total': total, 'items': items})
-        income_total_count += doc_count
-        income_total_sum += total
-        income_total_items += items
-
-    # Расходы по месяцам за год
-    outcome_by_month = (
-        Outcome.objects.filter(contract_date__year=year)
-        .annotate(month=TruncMonth('contract_date'))
-        .values('month')
-        .annotate(
-            doc_count=Count('id'),
-            total=Sum('total'),
-            items=Count('product_markings', distinct=False),
-        )
-    )
-    month_to_outcome = {row['month'].month: row for row in outcome_by_month if row['month']}
-    outcome_by_month_12 = []
-    outcome_total_count = 0
-    outcome_total_sum = 0.0
-    outcome_total_items = 0
-    for m in range(1, 13):
-        row = month_to_outcome.get(m, {'doc_count': 0, 'total': 0, 'items': 0})
-        total = float(row['total'] or 0)
-        doc_count = row['doc_count'] or 0
-        items = row['items'] or 0
-        outcome_by_month_12.append({'month': m, 'doc_count': doc_count, 'total': total, 'items': items})
-        outcome_total_count += doc_count
-        outcome_total_sum += total
-        outcome_total_items += items
+    by_bucket = {(row.direction, row.month): row for row in rows}
+    available_years = sorted(set(
+        DashboardRollup.objects.filter(doc_count__gt=0)
+        .exclude(direction=DashboardRollup.DIRECTION_STOCK)
+        .values_list('year', flat=True)
+    ), reverse=True) or [year]
+
+    def by_month_12(direction):
+        months = []
+        for m in range(1, 13):
+            row = by_bucket.get((direction, m))
+            months.append({
+                'month': m,
+                'doc_count': row.doc_count if row else 0,
+                'total': float(row.total) if row else 0.0,
+                'items': row.items if row else 0,
+            })
+        return months
+
+    income_by_month_12 = by_month_12(DashboardRollup.DIRECTION_INCOME)
+    income_total_count = sum(row['doc_count'] for row in income_by_month_12)
+    income_total_sum = sum(row['total'] for row in income_by_month_12)
+    income_total_items = sum(row['items'] for row in income_by_month_12)
+
+    outcome_by_month_12 = by_month_12(DashboardRollup.DIRECTION_OUTCOME)
+    outcome_total_count = sum(row['doc_count'] for row in outcome_by_month_12)
+    outcome_total_sum = sum(row['total'] for row in outcome_by_month_12)
+    outcome_total_items = sum(row['items'] for row in outcome_by_month_12)
 
     # Остаток: количество свободных маркировок и сумма по цене продукта
-    stock_agg = ProductMarking.objects.filter(outcome__isnull=True).aggregate(
-        items_count=Count('id'),
-        value=Sum('product__price'),
-    )
-    stock_value = float(stock_agg['value'] or 0)
-    stock_items = stock_agg['items_count'] or 0
+    stock_row = by_bucket.get((DashboardRollup.DIRECTION_STOCK, 0))
+    stock_value = float(stock_row.total) if stock_row else 0.0
+    stock_items = stock_row.items if stock_row else 0
 
     return Response({
         'year': year,
@@ -742,3 +1105,19 @@ class AdminResetPasswordView(APIView):
             user_id, getattr(user, 'username', ''), request.user.id,
         )
         return Response({'detail': 'Password updated'}, status=status.HTTP_200_OK)
+
+
+class AdminMarkingFilterView(APIView):
+    """
+    Admin API: фильтр Блума по маркировкам в памяти этого процесса (warehouse.bloom).
+    GET — размер и счётчики (checks, definitely_new, maybe_exists, false_positives, rebuilds); POST — перестроить.
+    """
+    permission_classes = [IsPlatformAdmin]
+
+    def get(self, request):
+        return Response(marking_filter.stats())
+
+    def post(self, request):
+        stats = marking_filter.rebuild()
+        admin_audit_logger.info('marking_filter_rebuild items=%s by admin_id=%s', stats['items'], request.user.id)
+        return Response(stats)
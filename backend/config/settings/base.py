@@ -77,9 +77,14 @@ TEMPLATES = [
     },
 ]
 
+# Stateless-режим (api.authentication): request.user из claims токена, без SELECT пользователя на каждый запрос.
+JWT_STATELESS_AUTH = os.getenv("JWT_STATELESS_AUTH", "1") == "1"
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "api.authentication.StatelessJWTAuthentication"
+        if JWT_STATELESS_AUTH
+        else "rest_framework_simplejwt.authentication.JWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": (
         "rest_framework.permissions.IsAuthenticated",
@@ -139,3 +144,27 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Фильтр Блума по маркировкам (warehouse.bloom): «точно новая» без запроса к базе.
+# SYNC_SECONDS — как часто догонять маркировки, созданные другими процессами (id > последний виденный).
+MARKING_FILTER_ENABLED = os.getenv("MARKING_FILTER_ENABLED", "1") == "1"
+MARKING_FILTER_SYNC_SECONDS = float(os.getenv("MARKING_FILTER_SYNC_SECONDS", "2"))
+
+# Кэш ролей пользователя (api.roles): группы и is_superuser для permission-классов и токенов.
+# Без общего кэша (Redis/Memcached в CACHES) другие процессы увидят смену ролей не позже чем через TTL.
+ROLES_CACHE_TTL = int(os.getenv("ROLES_CACHE_TTL", "60"))
+
+# Кэши: default — в памяти процесса (роли, активные пользователи); documents — печатные формы архивных документов
+# (api.documents), на диске и бессрочно: архивный документ не меняется.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "documents": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("DOCUMENT_CACHE_DIR", str(BASE_DIR / "cache" / "documents")),
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 100_000},
+    },
+}
+DOCUMENT_CACHE_ALIAS = "documents"
@@ -1,11 +1,44 @@
+from django import forms
 from django.contrib import admin
 from .models import *
+from .products import normalize_product_fields
+from .stock import delete_markings
+
+
+class ProductAdminForm(forms.ModelForm):
+    """
+    Не даём завести в админке дубликат товара: ключ нормализуется, как в резолвере прихода и импорта,
+    дальше его проверяет уникальное ограничение product_natural_key (оно же защищает от гонки при сохранении).
+    """
+
+    class Meta:
+        model = Product
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.errors:
+            return cleaned_data
+        cleaned_data.update(normalize_product_fields(cleaned_data))
+        return cleaned_data
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    form = ProductAdminForm
+    list_display = ('id', 'name', 'kpi', 'price')
+    search_fields = ('name', 'kpi')
+
+
+@admin.register(ProductMarking)
+class ProductMarkingAdmin(admin.ModelAdmin):
+    def delete_queryset(self, request, queryset):
+        # «Удалить выбранные» — queryset.delete() в обход ProductMarking.delete(): остаток и сводки правим сами.
+        delete_markings(queryset)
 
 
 admin.site.register(Company)
-admin.site.register(Product)
-admin.site.register(ProductMarking)
 admin.site.register(Income)
 admin.site.register(Outcome)
 admin.site.register(CustomUser)
-
+admin.site.register(Job)
@@ -0,0 +1,52 @@
+"""
+Массовая архивация/разархивация документов (Income/Outcome): один UPDATE ... SET is_archive, archived_at,
+archived_by, updated_at на чанк id вместо save() каждого документа. Условие по текущему is_archive в том же
+UPDATE делает операцию идемпотентной при параллельных запросах. updated_at меняется, как и при save(), —
+от него зависят ключи кэша печатных форм (api.documents). Сводки дашборда от флага архива не зависят.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+ARCHIVE_CHUNK_SIZE = 500
+
+ARCHIVED = 'archived'
+UNARCHIVED = 'unarchived'
+ALREADY_ARCHIVED = 'already_archived'
+NOT_ARCHIVED = 'not_archived'
+NOT_FOUND = 'not_found'
+
+
+def set_archived(model, ids, archived, user_id=None):
+    """
+    Архивирует (archived=True) или возвращает из архива документы model по ids.
+    Возвращает {id: статус} для каждого id: archived/unarchived, already_archived/not_archived, not_found.
+    """
+    ids = list(dict.fromkeys(ids))
+    now = timezone.now()
+    values = {
+        'is_archive': archived,
+        'archived_at': now if archived else None,
+        'archived_by_id': user_id if archived else None,
+        'updated_at': now,
+    }
+    changed, unchanged = (ARCHIVED, ALREADY_ARCHIVED) if archived else (UNARCHIVED, NOT_ARCHIVED)
+    results = {}
+    for start in range(0, len(ids), ARCHIVE_CHUNK_SIZE):
+        chunk = ids[start:start + ARCHIVE_CHUNK_SIZE]
+        with transaction.atomic():
+            current = dict(model.objects.filter(id__in=chunk).values_list('id', 'is_archive'))
+            to_change = [doc_id for doc_id, is_archive in current.items() if is_archive != archived]
+            done = set()
+            if to_change:
+                updated = model.objects.filter(id__in=to_change, is_archive__in=[not archived]).update(**values)
+                done = set(to_change)
+                if updated < len(to_change):
+                    # Часть строк между чтением и UPDATE изменил параллельный запрос: своими считаем только
+                    # строки с нашим updated_at, остальные — без изменений.
+                    done = set(model.objects.filter(id__in=to_change, updated_at=now).values_list('id', flat=True))
+        for doc_id in chunk:
+            if doc_id not in current:
+                results[doc_id] = NOT_FOUND
+            else:
+                results[doc_id] = changed if doc_id in done else unchanged
+    return results
@@ -0,0 +1,175 @@
+"""
+Фильтр Блума по существующим маркировкам (в памяти процесса): ответ «точно новая» без запроса к базе.
+Ключ — marking_hash (warehouse.digest), k позиций — двойным хэшированием из двух половин 64-битного хэша.
+
+Наполнение: лениво при первом обращении — потоковым запросом по marking_hash; дальше маркировки,
+созданные в этом процессе (save/bulk_create), добавляются сразу, а созданные или изменённые (save() меняет
+updated_at) другими процессами — догоняются запросом «id > последний_виденный или updated_at >= последний_виденный»
+не чаще раза в MARKING_FILTER_SYNC_SECONDS. Прежний текст изменённой маркировки остаётся в фильтре, как удалённый.
+Удалённые маркировки из фильтра не убираются (Блум этого не умеет): они дают «возможно есть»,
+и ответ уточняет база. Окончательная защита от дубликатов — уникальный индекс при записи.
+"""
+import datetime
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from .digest import marking_digest
+
+DEFAULT_ERROR_RATE = 0.01
+# Запас ёмкости при построении: фильтр перестраивается, когда элементов становится больше ёмкости.
+GROWTH_FACTOR = 2
+MIN_CAPACITY = 10_000
+# При догоняющей синхронизации перечитываем последние id: транзакции коммитятся не строго по порядку id.
+SYNC_ID_OVERLAP = 1000
+# То же для updated_at: запись с меткой времени раньше уже виденной может закоммититься позже.
+SYNC_TIME_OVERLAP = datetime.timedelta(seconds=60)
+BUILD_BATCH_SIZE = 5000
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = max(int(capacity), 1)
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest):
+        h1 = digest & 0xFFFFFFFF
+        h2 = (digest >> 32) & 0xFFFFFFFF | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, digest):
+        """
+        count растёт, только если элемент изменил хотя бы один бит: повторное добавление (догоняющая синхронизация
+        перечитывает последние строки) не раздувает счётчик и не вызывает лишних перестроений.
+        """
+        added = False
+        for position in self._positions(digest):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, digest):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+
+class MarkingExistenceFilter:
+    """Потокобезопасная обёртка: ленивое построение, догоняющая синхронизация, счётчики для админки."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_id = 0
+        self._last_updated_at = None
+        self._synced_at = 0.0
+        self.counters = {}
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {'checks': 0, 'definitely_new': 0, 'maybe_exists': 0, 'false_positives': 0, 'rebuilds': 0}
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'MARKING_FILTER_ENABLED', True)
+
+    def _add_rows(self, rows):
+        for marking_id, digest, marking, updated_at in rows:
+            self._bloom.add(digest if digest is not None else marking_digest(marking))
+            self._last_id = max(self._last_id, marking_id)
+            if updated_at is not None and (self._last_updated_at is None or updated_at > self._last_updated_at):
+                self._last_updated_at = updated_at
+        self._synced_at = time.monotonic()
+
+    def _build(self):
+        from .models import ProductMarking
+
+        total = ProductMarking.objects.count()
+        self._bloom = BloomFilter(max(MIN_CAPACITY, total * GROWTH_FACTOR), DEFAULT_ERROR_RATE)
+        self._last_id, self._last_updated_at = 0, None
+        try:
+            self._add_rows(
+                ProductMarking.objects.order_by()
+                .values_list('id', 'marking_hash', 'marking', 'updated_at')
+                .iterator(chunk_size=BUILD_BATCH_SIZE)
+            )
+        except BaseException:
+            # Недостроенный фильтр дал бы ложные «точно новая» — следующее обращение построит заново.
+            self._bloom = None
+            raise
+        self.counters['rebuilds'] += 1
+
+    def _sync(self):
+        from .models import ProductMarking
+
+        changed = Q(id__gt=self._last_id - SYNC_ID_OVERLAP)
+        if self._last_updated_at is not None:
+            changed |= Q(updated_at__gte=self._last_updated_at - SYNC_TIME_OVERLAP)
+        self._add_rows(ProductMarking.objects.filter(changed).values_list('id', 'marking_hash', 'marking', 'updated_at'))
+
+    def _ensure_ready(self):
+        if self._bloom is None or self._bloom.count > self._bloom.capacity:
+            self._build()
+        elif time.monotonic() - self._synced_at >= getattr(settings, 'MARKING_FILTER_SYNC_SECONDS', 2.0):
+            self._sync()
+
+    def rebuild(self):
+        with self._lock:
+            self._build()
+        return self.stats()
+
+    def might_exist(self, marking):
+        """False — маркировки точно нет в базе; True — возможно есть (проверить запросом)."""
+        return self.partition([marking])[1] != []
+
+    def partition(self, markings):
+        """(точно новые, возможно существующие) — без запроса к базе, кроме построения/синхронизации фильтра."""
+        markings = list(markings)
+        if not self.enabled:
+            return [], markings
+        with self._lock:
+            self._ensure_ready()
+            new, maybe = [], []
+            for marking in markings:
+                (maybe if marking_digest(marking) in self._bloom else new).append(marking)
+            self.counters['checks'] += len(markings)
+            self.counters['definitely_new'] += len(new)
+            self.counters['maybe_exists'] += len(maybe)
+        return new, maybe
+
+    def record_false_positives(self, count):
+        if count:
+            with self._lock:
+                self.counters['false_positives'] += count
+
+    def add(self, digests):
+        """Маркировки, созданные в этом процессе. Если фильтр ещё не построен — попадут при построении."""
+        with self._lock:
+            if self._bloom is not None:
+                for digest in digests:
+                    self._bloom.add(digest)
+
+    def stats(self):
+        with self._lock:
+            bloom = self._bloom
+            return {
+                'enabled': self.enabled,
+                'built': bloom is not None,
+                'items': bloom.count if bloom else 0,
+                'capacity': bloom.capacity if bloom else 0,
+                'size_bytes': len(bloom.bits) if bloom else 0,
+                'hashes': bloom.hashes if bloom else 0,
+                'last_id': self._last_id,
+                **self.counters,
+            }
+
+
+marking_filter = MarkingExistenceFilter()
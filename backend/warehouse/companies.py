@@ -0,0 +1,27 @@
+"""
+Резолвер компаний по ИНН для приходов/расходов.
+Одно чтение по уникальному индексу inn; запись только если name/phone действительно изменились (без лишнего UPDATE
+и блокировки записи SQLite на каждое сохранение документа).
+"""
+from django.db import IntegrityError, transaction
+
+from .models import Company
+
+
+def resolve_company(inn, name, phone):
+    """Компания по ИНН: найти, создать, либо обновить только изменившиеся поля."""
+    company = Company.objects.filter(inn=inn).first()
+    if company is None:
+        try:
+            with transaction.atomic():
+                company = Company.objects.create(inn=inn, name=name, phone=phone)
+        except IntegrityError:
+            # Параллельный запрос успел создать компанию с этим ИНН.
+            company = Company.objects.get(inn=inn)
+
+    changed = [field for field, value in (('name', name), ('phone', phone)) if getattr(company, field) != value]
+    if changed:
+        company.name = name
+        company.phone = phone
+        company.save(update_fields=changed)
+    return company
@@ -0,0 +1,38 @@
+"""
+Компактный ключ маркировки для точных сравнений: 64-битный хэш строки (колонка ProductMarking.marking_hash).
+Индекс по BIGINT в разы меньше B-tree по длинным DataMatrix-строкам, поэтому проверки «есть ли такая маркировка»
+ищут по хэшу, а совпадение строки проверяют уже на найденных строках (коллизии 64 бит возможны, хоть и редки).
+"""
+import hashlib
+
+# Сколько хэшей в одном IN (...): с запасом ниже лимита параметров SQLite.
+DIGEST_CHUNK_SIZE = 500
+
+
+def marking_digest(value):
+    """blake2b-8 строки маркировки как знаковое 64-битное целое (влезает в BigIntegerField любой БД)."""
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def find_by_digest(queryset, values, fields=('marking',)):
+    """
+    Строки queryset, у которых marking — одно из values: поиск по marking_hash (чанками),
+    затем сверка полной строки. Генерирует кортежи values_list(*fields); fields должны включать marking.
+    """
+    position = fields.index('marking')
+    values = list(set(values))
+    for start in range(0, len(values), DIGEST_CHUNK_SIZE):
+        chunk = set(values[start:start + DIGEST_CHUNK_SIZE])
+        rows = queryset.filter(marking_hash__in=[marking_digest(v) for v in chunk]).values_list(*fields)
+        for row in rows:
+            if row[position] in chunk:
+                yield row
+
+
+def marking_exists(queryset, value):
+    """Есть ли маркировка value: точечный поиск по хэшу, сверка строки (обычно одна строка)."""
+    return any(
+        marking == value
+        for marking in queryset.filter(marking_hash=marking_digest(value)).values_list('marking', flat=True)
+    )
@@ -0,0 +1,140 @@
+"""
+Очередь фоновых задач в БД: регистрация обработчиков, постановка в очередь, захват и выполнение.
+Воркер — `manage.py run_jobs`; брокер не нужен (подходит для PythonAnywhere).
+
+Обработчик и запись итога (status=done) — одна транзакция: задача либо выполнена и отмечена, либо не оставила
+ничего. Пока задача выполняется, воркер раз в heartbeat_interval обновляет heartbeat_at из отдельного потока;
+задача без пульса дольше stale_after возвращается в очередь (reclaim_stale). Итог записывается только при
+совпадении номера захвата (attempt): если задачу уже вернули в очередь и захватили снова, транзакция прежнего
+воркера откатывается — документ не создаётся дважды.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+HEARTBEAT_SECONDS = 30.0
+STALE_AFTER_SECONDS = 300.0
+
+
+class JobFailed(Exception):
+    """Ожидаемая ошибка задачи: details уходят клиенту в job.result (например, ошибки валидации)."""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+class JobLost(Exception):
+    """Задачу вернули в очередь (пульс пропал) и захватили снова — итог этого выполнения не записывается."""
+
+
+def register(kind):
+    """Декоратор: обработчик задачи kind. Обработчик получает Job и возвращает JSON-совместимый result."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, payload, user=None, total=0):
+    """total — объём работы (например, число маркировок) для progress_total: известен до выполнения."""
+    if kind not in HANDLERS:
+        raise ValueError(f"Неизвестный тип задачи: {kind}")
+    return Job.objects.create(kind=kind, payload=payload, created_by=user, progress_total=total)
+
+
+def claim_next():
+    """
+    Захватить самую старую задачу из очереди. Условный UPDATE ... WHERE status='pending'
+    защищает от двойного захвата, если воркеров несколько.
+    """
+    pending = Job.objects.filter(status=Job.STATUS_PENDING).order_by("id").values_list("id", flat=True)
+    for job_id in pending[:5]:
+        now = timezone.now()
+        claimed = Job.objects.filter(id=job_id, status=Job.STATUS_PENDING).update(
+            status=Job.STATUS_RUNNING, started_at=now, heartbeat_at=now, attempt=F("attempt") + 1,
+        )
+        if claimed:
+            return Job.objects.select_related("created_by").get(id=job_id)
+    return None
+
+
+def reclaim_stale(stale_after=STALE_AFTER_SECONDS):
+    """
+    Вернуть в очередь задачи, у которых нет пульса дольше stale_after секунд: воркер упал или был остановлен
+    посреди задачи. Его транзакция не закоммичена (или откатится по attempt), поэтому задачу можно выполнить
+    заново. Возвращает число возвращённых задач.
+    """
+    deadline = timezone.now() - timedelta(seconds=stale_after)
+    stale = Q(heartbeat_at__lt=deadline) | Q(heartbeat_at__isnull=True, started_at__lt=deadline)
+    return Job.objects.filter(stale, status=Job.STATUS_RUNNING).update(
+        status=Job.STATUS_PENDING, started_at=None, heartbeat_at=None, progress_done=0,
+    )
+
+
+@contextmanager
+def heartbeat(job, interval=HEARTBEAT_SECONDS):
+    """Пока выполняется блок — раз в interval секунд обновлять heartbeat_at (поток со своим соединением)."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                try:
+                    Job.objects.filter(pk=job.pk, attempt=job.attempt).update(heartbeat_at=timezone.now())
+                except DatabaseError:
+                    # SQLite: запись заблокирована транзакцией задачи — попробуем на следующем такте.
+                    logger.warning("job %s: heartbeat skipped", job.pk)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"job-{job.pk}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _finish(job, **fields):
+    """Записать итог, если задача всё ещё за этим захватом; иначе JobLost."""
+    fields["finished_at"] = timezone.now()
+    updated = Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING, attempt=job.attempt).update(**fields)
+    if not updated:
+        raise JobLost(f"job {job.pk} attempt {job.attempt} was reclaimed")
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+
+def run_job(job, heartbeat_interval=HEARTBEAT_SECONDS):
+    """Выполнить захваченную задачу и записать итог (done/failed)."""
+    handler = HANDLERS.get(job.kind)
+    try:
+        try:
+            if handler is None:
+                raise JobFailed(f"Неизвестный тип задачи: {job.kind}")
+            with heartbeat(job, heartbeat_interval), transaction.atomic():
+                result = handler(job)
+                _finish(job, status=Job.STATUS_DONE, result=result, progress_done=job.progress_total)
+        except JobFailed as exc:
+            _finish(job, status=Job.STATUS_FAILED, error=str(exc), result={"error": exc.details})
+        except JobLost:
+            raise
+        except Exception as exc:
+            logger.exception("job %s (%s) failed", job.pk, job.kind)
+            _finish(job, status=Job.STATUS_FAILED, error=str(exc) or exc.__class__.__name__)
+    except JobLost:
+        logger.warning("job %s (%s): reclaimed by another worker, result discarded", job.pk, job.kind)
+    return job
@@ -0,0 +1,36 @@
+"""
+Фильтр Блума по маркировкам (warehouse.bloom): построение и проверка на текущих данных.
+Фильтр живёт в памяти каждого процесса приложения, поэтому команда строит собственную копию —
+чтобы оценить размер, время построения и долю ложных срабатываний. Перестроить фильтр в работающих
+процессах — POST /api/v1/admin/marking-filter/ (или перезапуск: фильтр строится лениво).
+Запуск: python manage.py marking_filter [--probe 10000]
+"""
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from warehouse.bloom import MarkingExistenceFilter
+
+
+class Command(BaseCommand):
+    help = "Строит фильтр Блума по маркировкам и показывает размер и долю ложных срабатываний"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--probe", type=int, default=10000, help="Сколько заведомо новых кодов проверить")
+
+    def handle(self, *args, **options):
+        marking_filter = MarkingExistenceFilter()
+        started = time.monotonic()
+        stats = marking_filter.rebuild()
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"Маркировок: {stats['items']}, ёмкость: {stats['capacity']}, "
+            f"размер: {stats['size_bytes'] / 1024:.1f} КиБ, хэшей: {stats['hashes']}, построение: {elapsed:.2f} с"
+        )
+
+        probe = options["probe"]
+        if probe > 0:
+            _, maybe = marking_filter.partition(f"probe-{uuid.uuid4().hex}" for _ in range(probe))
+            self.stdout.write(f"Ложных срабатываний на {probe} новых кодах: {len(maybe)} ({len(maybe) / probe:.2%})")
+        self.stdout.write(self.style.SUCCESS("Готово"))
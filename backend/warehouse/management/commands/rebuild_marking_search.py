@@ -0,0 +1,24 @@
+"""
+Пересоздаёт индекс поиска маркировок (warehouse.search) и заново наполняет его.
+Нужен, если миграция пересоздала таблицу маркировок на SQLite (триггеры FTS удаляются вместе со старой таблицей) —
+до этого поиск работает, но через icontains.
+Запуск: python manage.py rebuild_marking_search
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from warehouse.search import drop_search_index, install_search_index
+
+
+class Command(BaseCommand):
+    help = "Пересоздаёт индекс поиска маркировок (FTS5 trigram / pg_trgm)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Алиас базы")
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        drop_search_index(connection)
+        if not install_search_index(connection):
+            raise CommandError(f"Бэкенд {connection.vendor} не поддерживает индекс поиска: остаётся icontains")
+        self.stdout.write(self.style.SUCCESS("Индекс поиска маркировок пересоздан"))
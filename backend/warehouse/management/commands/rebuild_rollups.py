@@ -0,0 +1,16 @@
+"""
+Полный пересчёт сводок дашборда (warehouse.DashboardRollup) по текущим документам и маркировкам.
+Нужен после ручных правок в БД в обход приложения; в обычной работе сводки поддерживаются сами.
+Запуск: python manage.py rebuild_rollups
+"""
+from django.core.management.base import BaseCommand
+
+from warehouse.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает месячные сводки и строку остатка для дашборда"
+
+    def handle(self, *args, **options):
+        buckets = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Месячных сводок: {buckets}"))
@@ -0,0 +1,38 @@
+"""
+Сверка и пересчёт остатков Product.quantity (число свободных маркировок товара).
+Запуск: python manage.py rebuild_stock           — пересчитать расходящиеся товары
+        python manage.py rebuild_stock --check   — только проверить (код выхода 1 при расхождениях, для cron/CI)
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from warehouse.stock import find_stock_mismatches, rebuild_stock
+
+# Сколько расхождений печатать построчно.
+REPORT_LIMIT = 20
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает и сверяет денормализованный остаток товаров (Product.quantity)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Только сверить, ничего не меняя")
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            mismatches = find_stock_mismatches()
+        else:
+            with transaction.atomic():
+                mismatches = rebuild_stock()
+
+        for product_id, stored, actual in mismatches[:REPORT_LIMIT]:
+            self.stdout.write(f"product #{product_id}: quantity={stored}, свободных маркировок={actual}")
+        if len(mismatches) > REPORT_LIMIT:
+            self.stdout.write(f"... и ещё {len(mismatches) - REPORT_LIMIT}")
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("Остатки сходятся"))
+        elif options["check"]:
+            raise CommandError(f"Расхождений остатка: {len(mismatches)}")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Исправлено товаров: {len(mismatches)}"))
@@ -0,0 +1,60 @@
+"""
+Воркер очереди фоновых задач (warehouse.Job). Брокер не нужен: задачи берутся из БД.
+Запуск: python manage.py run_jobs            — бесконечный цикл (always-on task на PythonAnywhere)
+        python manage.py run_jobs --once     — выполнить всё, что в очереди, и выйти (cron / scheduled task)
+Пока задача выполняется, воркер раз в --heartbeat секунд обновляет её пульс. Задачи в running без пульса
+дольше --stale-after секунд (воркер упал посреди задачи) возвращаются в очередь — при запуске и каждый раз,
+когда очередь пустеет.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from warehouse.jobs import HEARTBEAT_SECONDS, STALE_AFTER_SECONDS, claim_next, reclaim_stale, run_job
+
+
+class Command(BaseCommand):
+    help = "Выполняет фоновые задачи из очереди warehouse.Job"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Выйти, когда очередь опустеет")
+        parser.add_argument("--sleep", type=float, default=2.0, help="Пауза при пустой очереди, сек")
+        parser.add_argument("--max-jobs", type=int, default=0, help="Выйти после N задач (0 — без ограничения)")
+        parser.add_argument(
+            "--heartbeat", type=float, default=HEARTBEAT_SECONDS,
+            help="Интервал пульса выполняемой задачи, сек",
+        )
+        parser.add_argument(
+            "--stale-after", type=float, default=STALE_AFTER_SECONDS,
+            help="Вернуть в очередь задачи без пульса дольше N секунд (0 — не возвращать)",
+        )
+
+    def handle(self, *args, **options):
+        if 0 < options["stale_after"] <= options["heartbeat"]:
+            raise CommandError("--stale-after должен быть больше --heartbeat")
+        processed = 0
+        self.reclaim(options["stale_after"])
+        try:
+            while True:
+                job = claim_next()
+                if job is None:
+                    if self.reclaim(options["stale_after"]):
+                        continue
+                    if options["once"]:
+                        break
+                    time.sleep(options["sleep"])
+                    continue
+                run_job(job, heartbeat_interval=options["heartbeat"])
+                processed += 1
+                self.stdout.write(f"{job} progress={job.progress_done}/{job.progress_total}")
+                if options["max_jobs"] and processed >= options["max_jobs"]:
+                    break
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f"Выполнено задач: {processed}"))
+
+    def reclaim(self, stale_after):
+        reclaimed = reclaim_stale(stale_after) if stale_after > 0 else 0
+        if reclaimed:
+            self.stdout.write(self.style.WARNING(f"Возвращено в очередь зависших задач: {reclaimed}"))
+        return reclaimed
@@ -0,0 +1,42 @@
+# Индекс (kpi, name) — натуральный ключ товара для резолвера warehouse.products.
+# Перед этим сливаем дубликаты, которые плодил get_or_create по float-цене:
+# одинаковые kpi, name и цена с точностью до копеек → оставляем товар с минимальным id,
+# маркировки дубликатов переназначаем на него, дубликаты удаляем.
+
+from django.db import migrations, models
+
+
+def merge_duplicate_products(apps, schema_editor):
+    Product = apps.get_model("warehouse", "Product")
+    ProductMarking = apps.get_model("warehouse", "ProductMarking")
+
+    main_by_key = {}
+    duplicates = {}
+    for product_id, kpi, name, price in Product.objects.order_by("id").values_list("id", "kpi", "name", "price"):
+        key = ((kpi or "").strip(), (name or "").strip(), round(float(price), 2))
+        main_id = main_by_key.setdefault(key, product_id)
+        if main_id != product_id:
+            duplicates.setdefault(main_id, []).append(product_id)
+
+    for main_id, duplicate_ids in duplicates.items():
+        ProductMarking.objects.filter(product_id__in=duplicate_ids).update(product_id=main_id)
+        Product.objects.filter(id__in=duplicate_ids).delete()
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0011_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_products, noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['kpi', 'name'], name='product_kpi_name_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.14 on 2026-10-17 12:39
+# Keyset-пагинация: (-created_at, -id) для списков и маркировок склада; архив фильтруется по is_archive
+# и сортируется по -archived_at — (is_archive, -archived_at, -id), фильтр и сортировка одним индексом.
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0012_product_natural_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['-created_at', '-id'], name='income_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['is_archive', '-archived_at', '-id'], name='income_arch_archived_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outcome',
+            index=models.Index(fields=['-created_at', '-id'], name='outcome_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outcome',
+            index=models.Index(fields=['is_archive', '-archived_at', '-id'], name='outcome_arch_archived_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productmarking',
+            index=models.Index(fields=['-created_at', '-id'], name='marking_created_id_idx'),
+        ),
+    ]
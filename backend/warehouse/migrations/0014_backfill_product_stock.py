@@ -0,0 +1,35 @@
+# Product.quantity становится денормализованным остатком (свободные маркировки товара, см. warehouse.stock).
+# Заполняем его по текущим данным; дальше счётчик поддерживается при изменении маркировок.
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_stock(apps, schema_editor):
+    Product = apps.get_model("warehouse", "Product")
+    ProductMarking = apps.get_model("warehouse", "ProductMarking")
+
+    free = dict(
+        ProductMarking.objects.filter(outcome__isnull=True, product__isnull=False)
+        .order_by()
+        .values_list("product_id")
+        .annotate(count=Count("id"))
+    )
+    Product.objects.update(quantity=0)
+    for product_id, count in free.items():
+        Product.objects.filter(id=product_id).update(quantity=count)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0013_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_stock, noop),
+    ]
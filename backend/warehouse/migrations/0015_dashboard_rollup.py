@@ -0,0 +1,73 @@
+# Generated by Django 4.2.14 on 2026-10-17 12:45
+
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def backfill_rollups(apps, schema_editor):
+    """Начальное заполнение сводок дашборда (дальше их поддерживает warehouse.rollups)."""
+    DashboardRollup = apps.get_model("warehouse", "DashboardRollup")
+    Product = apps.get_model("warehouse", "Product")
+    ProductMarking = apps.get_model("warehouse", "ProductMarking")
+
+    buckets = {}
+    for direction, model_name, date_field in (
+        ("income", "Income", "income__contract_date"),
+        ("outcome", "Outcome", "outcome__contract_date"),
+    ):
+        model = apps.get_model("warehouse", model_name)
+        docs = (
+            model.objects.annotate(y=ExtractYear("contract_date"), m=ExtractMonth("contract_date"))
+            .order_by().values("y", "m").annotate(doc_count=Count("id"), total=Sum("total"))
+        )
+        for row in docs:
+            buckets[(direction, row["y"], row["m"])] = DashboardRollup(
+                direction=direction, year=row["y"], month=row["m"],
+                doc_count=row["doc_count"], total=float(row["total"] or 0),
+            )
+        items = (
+            ProductMarking.objects.filter(**{f"{date_field}__isnull": False})
+            .annotate(y=ExtractYear(date_field), m=ExtractMonth(date_field))
+            .order_by().values("y", "m").annotate(items=Count("id"))
+        )
+        for row in items:
+            if (direction, row["y"], row["m"]) in buckets:
+                buckets[(direction, row["y"], row["m"])].items = row["items"]
+
+    stock = Product.objects.aggregate(items=Sum("quantity"), value=Sum(F("quantity") * F("price")))
+    buckets[("stock", 0, 0)] = DashboardRollup(
+        direction="stock", year=0, month=0, items=stock["items"] or 0, total=float(stock["value"] or 0),
+    )
+    DashboardRollup.objects.bulk_create(buckets.values())
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0014_backfill_product_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[('income', 'Приход'), ('outcome', 'Расход'), ('stock', 'Остаток')], max_length=16)),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('doc_count', models.IntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+                ('items', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dashboardrollup',
+            constraint=models.UniqueConstraint(fields=('direction', 'year', 'month'), name='dashboard_rollup_bucket_uniq'),
+        ),
+        migrations.RunPython(backfill_rollups, noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.14 on 2026-10-17 12:48
+# Списки с фильтром по архиву (?is_archive=false) сортируются по -created_at: (is_archive, -created_at, -id).
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0015_dashboard_rollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['is_archive', '-created_at', '-id'], name='income_arch_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outcome',
+            index=models.Index(fields=['is_archive', '-created_at', '-id'], name='outcome_arch_created_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Индекс поиска маркировок по подстроке (warehouse.search):
+# SQLite — FTS5 trigram + триггеры синхронизации, Postgres — pg_trgm + GIN по marking.
+# Если сборка SQLite без trigram или нет прав на CREATE EXTENSION — миграция проходит, поиск остаётся на icontains.
+
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from warehouse.search import install_search_index
+
+    install_search_index(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    from warehouse.search import drop_search_index
+
+    drop_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0016_archive_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.14 on 2026-10-17 12:51
+# marking_hash — 64-битный хэш маркировки для точных поисков (warehouse.digest), заполняем для существующих строк.
+
+import hashlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def digest(value):
+    # Копия warehouse.digest.marking_digest на момент миграции: blake2b-8, знаковое 64-битное целое.
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def backfill_marking_hash(apps, schema_editor):
+    ProductMarking = apps.get_model('warehouse', 'ProductMarking')
+    last_id = 0
+    while True:
+        batch = list(
+            ProductMarking.objects.filter(id__gt=last_id).order_by('id').only('id', 'marking')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for marking in batch:
+            marking.marking_hash = digest(marking.marking)
+        ProductMarking.objects.bulk_update(batch, ['marking_hash'])
+        last_id = batch[-1].id
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0017_marking_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productmarking',
+            name='marking_hash',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_marking_hash, noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.14 on 2026-10-17 13:02
+# Компактное хранилище отозванных refresh-токенов; переносим ещё не истёкшие записи token_blacklist,
+# чтобы уже отозванные токены не стали снова действительными.
+
+from django.db import migrations, models
+from django.utils import timezone
+
+BATCH_SIZE = 2000
+
+
+def copy_blacklist(apps, schema_editor):
+    RevokedToken = apps.get_model('warehouse', 'RevokedToken')
+    BlacklistedToken = apps.get_model('token_blacklist', 'BlacklistedToken')
+    rows = (
+        BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now(), token__jti__isnull=False)
+        .values_list('token__jti', 'token__expires_at')
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    batch = []
+    for jti, expires_at in rows:
+        batch.append(RevokedToken(jti=jti, expires_at=expires_at))
+        if len(batch) >= BATCH_SIZE:
+            RevokedToken.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    RevokedToken.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0018_productmarking_marking_hash'),
+        ('token_blacklist', '0012_alter_outstandingtoken_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('jti', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.RunPython(copy_blacklist, noop),
+    ]
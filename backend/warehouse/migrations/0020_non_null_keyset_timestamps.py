@@ -0,0 +1,80 @@
+# Ключ keyset-пагинации не может быть NULL: курсор берёт позицию из первого поля сортировки, и строки
+# с NULL (записи до миграции 0006) выпадали из следующих страниц. Заполняем пропуски и запрещаем NULL:
+# - created_at (Income/Outcome/ProductMarking) — updated_at, иначе LEGACY_CREATED_AT (старые записи — в конце списка);
+# - archived_at у архивных документов — updated_at/created_at; CHECK: архивный документ всегда с archived_at,
+#   поэтому в списке архива (фильтр is_archive, сортировка -archived_at) NULL нет.
+# Пересоздание таблицы маркировок на SQLite удаляет триггеры FTS (0017) — ставим индекс поиска заново.
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+
+LEGACY_CREATED_AT = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def backfill_timestamps(apps, schema_editor):
+    for model_name in ('Income', 'Outcome', 'ProductMarking'):
+        model = apps.get_model('warehouse', model_name)
+        model.objects.filter(created_at__isnull=True).update(
+            created_at=Coalesce(F('updated_at'), Value(LEGACY_CREATED_AT))
+        )
+    for model_name in ('Income', 'Outcome'):
+        model = apps.get_model('warehouse', model_name)
+        model.objects.filter(is_archive=True, archived_at__isnull=True).update(
+            archived_at=Coalesce(F('updated_at'), F('created_at'))
+        )
+
+
+def install_search(apps, schema_editor):
+    from warehouse.search import install_search_index
+
+    install_search_index(schema_editor.connection)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0019_revoked_token'),
+    ]
+
+    operations = [
+        # При откате таблица маркировок пересоздаётся ещё раз — индекс поиска ставится последним шагом отката.
+        migrations.RunPython(noop, install_search),
+        migrations.RunPython(backfill_timestamps, noop),
+        migrations.AlterField(
+            model_name='income',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='outcome',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='productmarking',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AddConstraint(
+            model_name='income',
+            constraint=models.CheckConstraint(
+                check=models.Q(is_archive=False) | models.Q(archived_at__isnull=False),
+                name='income_archived_at_set',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='outcome',
+            constraint=models.CheckConstraint(
+                check=models.Q(is_archive=False) | models.Q(archived_at__isnull=False),
+                name='outcome_archived_at_set',
+            ),
+        ),
+        migrations.RunPython(install_search, noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.14 on 2026-10-17 13:25
+# Индекс по updated_at для догоняющей синхронизации фильтра маркировок (warehouse.bloom).
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0020_non_null_keyset_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='productmarking',
+            index=models.Index(fields=['updated_at'], name='marking_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Натуральный ключ товара (kpi, name, цена до копеек) — уникальный: индекс 0012 не мешал параллельным
+# запросам создать один и тот же товар дважды. Перед ограничением ещё раз сливаем дубликаты (появившиеся
+# после 0012 — тот же алгоритм, плюс остаток Product.quantity переносится на оставшийся товар) и приводим
+# ключ к нормализованному виду, в котором его теперь хранит Product.save(). Индекс (kpi, name) больше не нужен:
+# его заменяет префикс уникального индекса.
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def merge_and_normalize_products(apps, schema_editor):
+    Product = apps.get_model("warehouse", "Product")
+    ProductMarking = apps.get_model("warehouse", "ProductMarking")
+
+    main_by_key = {}
+    duplicates = {}
+    normalize = {}
+    rows = Product.objects.order_by("id").values_list("id", "kpi", "name", "price", "quantity")
+    for product_id, kpi, name, price, quantity in rows:
+        key = ((kpi or "").strip(), (name or "").strip(), round(float(price), 2))
+        main_id = main_by_key.setdefault(key, product_id)
+        if main_id != product_id:
+            duplicates.setdefault(main_id, []).append((product_id, quantity or 0))
+        elif key != (kpi, name, price):
+            normalize[product_id] = key
+
+    for main_id, duplicate_rows in duplicates.items():
+        duplicate_ids = [product_id for product_id, _ in duplicate_rows]
+        ProductMarking.objects.filter(product_id__in=duplicate_ids).update(product_id=main_id)
+        Product.objects.filter(id=main_id).update(
+            quantity=F("quantity") + sum(quantity for _, quantity in duplicate_rows)
+        )
+        Product.objects.filter(id__in=duplicate_ids).delete()
+
+    for product_id, (kpi, name, price) in normalize.items():
+        Product.objects.filter(id=product_id).update(kpi=kpi, name=name, price=price)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0021_marking_updated_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_and_normalize_products, noop),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('kpi', 'name', 'price'), name='product_natural_key'),
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_kpi_name_idx',
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.14 on 2026-10-17 13:50
+# Пульс воркера и номер захвата задачи (warehouse.jobs): зависшие задачи определяются по пульсу, а не по started_at.
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse', '0022_product_natural_key_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='attempt',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
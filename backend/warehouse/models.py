@@ -1,6 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .bloom import marking_filter
+from .digest import marking_digest
 
 
 class CustomUser(AbstractUser):
@@ -26,16 +30,52 @@ class Product(models.Model):
     kpi = models.CharField(max_length=255)
     quantity = models.IntegerField(default=0, null=True, blank=True)
 
+    class Meta:
+        # Натуральный ключ товара для резолвера (warehouse.products): уникален, поиск пачкой — по префиксу (kpi, name).
+        constraints = [models.UniqueConstraint(fields=["kpi", "name", "price"], name="product_natural_key")]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_price = instance.__dict__.get("price")
+        return instance
+
+    def save(self, *args, **kwargs):
+        from .products import product_key
+
+        # Ключ хранится нормализованным — на нём уникальное ограничение (дубликаты по float-цене невозможны).
+        self.kpi, self.name, self.price = product_key(self.name, self.kpi, self.price)
+        # quantity — счётчик остатка (warehouse.stock), его меняют только UPDATE ... quantity + delta.
+        # Обычный save() существующего товара его не перезаписывает, иначе устаревшее значение затрёт счётчик.
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name != "quantity"
+            ]
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
 
 # Складовые индексы: outcome_id (фильтр "свободные"), income_id, product_id — db_index=True.
-# Поиск по marking: при росте данных в Postgres можно добавить pg_trgm + GIN.
+# Поиск по marking: FTS5 trigram (SQLite) / pg_trgm + GIN (Postgres), см. warehouse.search.
+
+
+class ProductMarkingQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create не вызывает save() — хэш маркировки заполняем здесь.
+        objs = list(objs)
+        for obj in objs:
+            obj.marking_hash = marking_digest(obj.marking)
+        created = super().bulk_create(objs, *args, **kwargs)
+        marking_filter.add(obj.marking_hash for obj in objs)
+        return created
 
 
 class ProductMarking(models.Model):
     marking = models.CharField(max_length=255, unique=True)
+    # 64-битный хэш marking (warehouse.digest) — по нему идут точные поиски; строка сверяется после.
+    marking_hash = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True)
     counter = models.BooleanField(default=False, null=True, blank=True)
     income = models.ForeignKey(
         "Income", on_delete=models.CASCADE, related_name="income", null=True, blank=True, db_index=True
@@ -46,9 +86,55 @@ class ProductMarking(models.Model):
     product = models.ForeignKey(
         "Product", on_delete=models.CASCADE, related_name="product", null=True, blank=True, db_index=True
     )
-    created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
 
+    objects = ProductMarkingQuerySet.as_manager()
+
+    class Meta:
+        # Keyset-пагинация склада (available): ORDER BY created_at DESC, id DESC без OFFSET.
+        # updated_at — догоняющая синхронизация фильтра маркировок (warehouse.bloom) по изменённым строкам.
+        indexes = [
+            models.Index(fields=["-created_at", "-id"], name="marking_created_id_idx"),
+            models.Index(fields=["updated_at"], name="marking_updated_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_state()
+        return instance
+
+    def remember_state(self):
+        """
+        Снимок связей на момент загрузки/сохранения (warehouse.signals): (product_id, свободна ли) —
+        для Product.quantity, (income_id, outcome_id) — для месячных сводок дашборда.
+        """
+        self._stock_state = (self.product_id, self.outcome_id is None)
+        self._document_ids = (self.income_id, self.outcome_id)
+
+    def save(self, *args, **kwargs):
+        self.marking_hash = marking_digest(self.marking)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "marking" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "marking_hash"}
+        super().save(*args, **kwargs)
+        marking_filter.add([self.marking_hash])
+
+    def delete(self, *args, **kwargs):
+        # Остаток и сводки правим здесь, а не в post_delete: сигнал на модели отключил бы fast delete у queryset.delete().
+        from .rollups import INCOME, OUTCOME, touch_documents
+        from .stock import remove_stock
+
+        product_id, is_free = getattr(self, "_stock_state", (self.product_id, self.outcome_id is None))
+        income_id, outcome_id = getattr(self, "_document_ids", (self.income_id, self.outcome_id))
+        result = super().delete(*args, **kwargs)
+        if is_free:
+            remove_stock([product_id])
+        touch_documents(INCOME, [income_id])
+        touch_documents(OUTCOME, [outcome_id])
+        return result
+
     def __str__(self):
         return self.marking
 
@@ -63,7 +149,7 @@ class Income(models.Model):
     unit_of_measure = models.CharField(max_length=255)
     total = models.FloatField()
     is_archive = models.BooleanField(default=False, db_index=True)
-    created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
     archived_at = models.DateTimeField(null=True, blank=True)
     archived_by = models.ForeignKey(
@@ -71,6 +157,37 @@ class Income(models.Model):
         related_name="archived_incomes",
     )
 
+    class Meta:
+        # Keyset-пагинация списков: (-created_at, -id); списки с фильтром по архиву —
+        # (is_archive, -created_at, -id) и архив (is_archive, -archived_at, -id): фильтр и сортировка одним индексом.
+        indexes = [
+            models.Index(fields=["-created_at", "-id"], name="income_created_id_idx"),
+            models.Index(fields=["is_archive", "-created_at", "-id"], name="income_arch_created_idx"),
+            models.Index(fields=["is_archive", "-archived_at", "-id"], name="income_arch_archived_idx"),
+        ]
+        # Ключ курсора архива (-archived_at) не бывает NULL у архивных документов.
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(is_archive=False) | models.Q(archived_at__isnull=False),
+                name="income_archived_at_set",
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Месяц, в чьей сводке документ числился до save() (warehouse.rollups).
+        instance._loaded_contract_date = instance.__dict__.get("contract_date")
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.is_archive and self.archived_at is None:
+            self.archived_at = timezone.now()
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "archived_at"}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.contract_number
 
@@ -85,7 +202,7 @@ class Outcome(models.Model):
     unit_of_measure = models.CharField(max_length=255)
     total = models.FloatField()
     is_archive = models.BooleanField(default=False, db_index=True)
-    created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
     archived_at = models.DateTimeField(null=True, blank=True)
     archived_by = models.ForeignKey(
@@ -93,5 +210,116 @@ class Outcome(models.Model):
         related_name="archived_outcomes",
     )
 
+    class Meta:
+        # Keyset-пагинация списков: (-created_at, -id); списки с фильтром по архиву —
+        # (is_archive, -created_at, -id) и архив (is_archive, -archived_at, -id): фильтр и сортировка одним индексом.
+        indexes = [
+            models.Index(fields=["-created_at", "-id"], name="outcome_created_id_idx"),
+            models.Index(fields=["is_archive", "-created_at", "-id"], name="outcome_arch_created_idx"),
+            models.Index(fields=["is_archive", "-archived_at", "-id"], name="outcome_arch_archived_idx"),
+        ]
+        # Ключ курсора архива (-archived_at) не бывает NULL у архивных документов.
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(is_archive=False) | models.Q(archived_at__isnull=False),
+                name="outcome_archived_at_set",
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Месяц, в чьей сводке документ числился до save() (warehouse.rollups).
+        instance._loaded_contract_date = instance.__dict__.get("contract_date")
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.is_archive and self.archived_at is None:
+            self.archived_at = timezone.now()
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "archived_at"}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.contract_number
+
+
+class DashboardRollup(models.Model):
+    """
+    Сводка для дашборда (warehouse.rollups): по месяцу и направлению — число документов, сумма, число маркировок.
+    Строка direction=stock (year=month=0) — остаток: items — свободные маркировки, total — их стоимость.
+    """
+    DIRECTION_INCOME = "income"
+    DIRECTION_OUTCOME = "outcome"
+    DIRECTION_STOCK = "stock"
+    DIRECTION_CHOICES = (
+        (DIRECTION_INCOME, "Приход"),
+        (DIRECTION_OUTCOME, "Расход"),
+        (DIRECTION_STOCK, "Остаток"),
+    )
+
+    direction = models.CharField(max_length=16, choices=DIRECTION_CHOICES)
+    year = models.IntegerField()
+    month = models.IntegerField()
+    doc_count = models.IntegerField(default=0)
+    total = models.FloatField(default=0)
+    items = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["direction", "year", "month"], name="dashboard_rollup_bucket_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.direction} {self.year}-{self.month:02d}"
+
+
+class Job(models.Model):
+    """
+    Фоновая задача (очередь в БД, без брокера). Выполняет `manage.py run_jobs`.
+    kind — имя обработчика из warehouse.jobs; payload — входные данные; result — итог для клиента.
+    """
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "В очереди"),
+        (STATUS_RUNNING, "Выполняется"),
+        (STATUS_DONE, "Готово"),
+        (STATUS_FAILED, "Ошибка"),
+    )
+
+    kind = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    progress_done = models.IntegerField(default=0)
+    progress_total = models.IntegerField(default=0)
+    created_by = models.ForeignKey(
+        CustomUser, on_delete=models.SET_NULL, null=True, blank=True, related_name="jobs",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Пульс воркера, выполняющего задачу; задача без пульса дольше --stale-after возвращается в очередь.
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Номер захвата: итог записывает только воркер с текущим номером (вернувшийся после reclaim — нет).
+    attempt = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+
+class RevokedToken(models.Model):
+    """
+    Отозванный refresh-токен (api.tokens): только jti и срок жизни — одна вставка на ротацию/logout
+    вместо OutstandingToken + BlacklistedToken. Строки с истёкшим expires_at больше не нужны (prune_tokens).
+    """
+    jti = models.CharField(max_length=255, primary_key=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.jti
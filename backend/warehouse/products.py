@@ -0,0 +1,88 @@
+"""
+Резолвер товаров по натуральному ключу (kpi, name, цена с точностью до копеек).
+Один запрос на пачку кандидатов по индексу (kpi, name), недостающие товары — одним bulk_create.
+Используется приходом (IncomeSerializer), импортом маркировок и админкой.
+Ключ хранится нормализованным (Product.save) и уникален в базе: товар, созданный параллельным запросом
+между поиском и вставкой, ловится по IntegrityError и дочитывается.
+"""
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+
+from .models import Product
+
+PRICE_DECIMALS = 2
+
+# Ключей на один IN-запрос: kpi__in и name__in — по параметру на ключ, с запасом ниже лимита SQLite.
+KEYS_CHUNK_SIZE = 400
+
+
+def normalize_price(price):
+    """Цена для сравнения: float с округлением (1.1 и 1.1000000001 — один товар). ValueError/TypeError для мусора."""
+    return round(float(price), PRICE_DECIMALS)
+
+
+def product_key(name, kpi, price):
+    return (str(kpi or '').strip(), str(name or '').strip(), normalize_price(price))
+
+
+def normalize_product_fields(values):
+    """name/kpi без пробелов по краям, цена — до копеек: в таком виде ключ хранится в Product (только переданные поля)."""
+    normalized = dict(values)
+    for field in ('name', 'kpi'):
+        if normalized.get(field) is not None:
+            normalized[field] = str(normalized[field]).strip()
+    if normalized.get('price') is not None:
+        normalized['price'] = normalize_price(normalized['price'])
+    return normalized
+
+
+def _key_of(product):
+    return product_key(product.name, product.kpi, product.price)
+
+
+def find_products(keys):
+    """{key: Product} для уже существующих товаров. При исторических дублях берётся товар с меньшим id."""
+    keys = set(keys)
+    found = {}
+    iterator = iter(keys)
+    while True:
+        chunk = list(islice(iterator, KEYS_CHUNK_SIZE))
+        if not chunk:
+            break
+        candidates = Product.objects.filter(
+            kpi__in={k for k, _, _ in chunk},
+            name__in={n for _, n, _ in chunk},
+        ).order_by('id')
+        for product in candidates:
+            key = _key_of(product)
+            if key in keys and key not in found:
+                found[key] = product
+    return found
+
+
+def resolve_products(products_data):
+    """
+    Товары для списка словарей {name, kpi, price} (порядок сохраняется).
+    Существующие — одним запросом на пачку, недостающие создаются одним bulk_create.
+    """
+    keys = [product_key(p.get('name'), p.get('kpi'), p.get('price')) for p in products_data]
+    found = find_products(keys)
+    missing = [key for key in dict.fromkeys(keys) if key not in found]
+    if missing:
+        def new_products():
+            return [Product(kpi=kpi, name=name, price=price) for kpi, name, price in missing]
+
+        try:
+            with transaction.atomic():
+                created = Product.objects.bulk_create(new_products())
+        except IntegrityError:
+            # Часть товаров успел создать параллельный запрос: создаём остальные и дочитываем все.
+            Product.objects.bulk_create(new_products(), ignore_conflicts=True)
+            created = []
+        if created and all(p.pk is not None for p in created):
+            found.update(zip(missing, created))
+        else:
+            # Гонка или бэкенд без RETURNING при bulk insert — дочитываем созданные.
+            found.update(find_products(missing))
+    return [found[key] for key in keys]
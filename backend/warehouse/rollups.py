@@ -0,0 +1,154 @@
+"""
+Сводки для дашборда (DashboardRollup): по месяцам приходов/расходов и строка остатка.
+Месячные строки пересчитываются только для затронутых месяцев: изменения помечают месяц «грязным»,
+а пересчёт (агрегат по диапазону contract_date, по индексу) выполняется один раз после commit транзакции —
+сколько бы раз документ и его маркировки ни менялись внутри запроса.
+Строка остатка меняется дельтами вместе с Product.quantity (warehouse.stock).
+Полный пересчёт — `manage.py rebuild_rollups`.
+"""
+import threading
+from datetime import date
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+from .models import DashboardRollup, Income, Outcome, Product, ProductMarking
+
+INCOME = DashboardRollup.DIRECTION_INCOME
+OUTCOME = DashboardRollup.DIRECTION_OUTCOME
+STOCK = DashboardRollup.DIRECTION_STOCK
+
+# direction → (модель документа, фильтр маркировок документа по полю contract_date)
+DIRECTIONS = {
+    INCOME: (Income, 'income__contract_date'),
+    OUTCOME: (Outcome, 'outcome__contract_date'),
+}
+
+_pending = threading.local()
+
+
+def month_range(year, month):
+    """[первый день месяца, первый день следующего) — диапазон, который использует индекс по contract_date."""
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start, end
+
+
+def _pending_state():
+    if not hasattr(_pending, 'months'):
+        _pending.months = set()
+        _pending.documents = set()
+    return _pending
+
+
+def _schedule():
+    # Колбэк регистрируем на каждое изменение: если savepoint откатится, его колбэк пропадёт,
+    # но отметки останутся и уйдут со следующим. Лишние колбэки ничего не делают — набор уже пуст.
+    transaction.on_commit(flush_pending)
+
+
+def _as_date(value):
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def touch_months(direction, dates):
+    """Пометить месяцы (по датам контракта) для пересчёта после commit."""
+    months = {(direction, d.year, d.month) for d in map(_as_date, dates) if d}
+    if months:
+        _pending_state().months.update(months)
+        _schedule()
+
+
+def touch_documents(direction, ids):
+    """Пометить месяцы документов по id (дата читается при пересчёте — одним запросом на направление)."""
+    documents = {(direction, doc_id) for doc_id in ids if doc_id}
+    if documents:
+        _pending_state().documents.update(documents)
+        _schedule()
+
+
+def flush_pending():
+    """Пересчитать все помеченные месяцы (вызывается из on_commit)."""
+    state = _pending_state()
+    months, documents = state.months, state.documents
+    state.months, state.documents = set(), set()
+    for direction, (model, _) in DIRECTIONS.items():
+        ids = [doc_id for d, doc_id in documents if d == direction]
+        if ids:
+            dates = model.objects.filter(id__in=ids).values_list('contract_date', flat=True).distinct()
+            months.update((direction, d.year, d.month) for d in dates if d)
+    for direction, year, month in sorted(months):
+        refresh_month(direction, year, month)
+
+
+def refresh_month(direction, year, month):
+    """Пересчёт одной месячной строки: два агрегата по диапазону дат вместо TruncMonth по всему году."""
+    model, marking_date_field = DIRECTIONS[direction]
+    start, end = month_range(year, month)
+    docs = model.objects.filter(contract_date__gte=start, contract_date__lt=end).aggregate(
+        doc_count=Count('id'), total=Sum('total'),
+    )
+    items = ProductMarking.objects.filter(**{
+        f'{marking_date_field}__gte': start, f'{marking_date_field}__lt': end,
+    }).count()
+    DashboardRollup.objects.update_or_create(
+        direction=direction, year=year, month=month,
+        defaults={'doc_count': docs['doc_count'], 'total': float(docs['total'] or 0), 'items': items},
+    )
+
+
+def stock_totals():
+    """(свободных маркировок, их стоимость) по счётчикам Product.quantity."""
+    totals = Product.objects.aggregate(
+        items=Sum('quantity'),
+        value=Sum(F('quantity') * F('price')),
+    )
+    return totals['items'] or 0, float(totals['value'] or 0)
+
+
+def adjust_stock_summary(items, value):
+    """Дельта строки остатка. Если строки ещё нет — создаём её по текущим счётчикам товаров."""
+    if not items and not value:
+        return
+    updated = DashboardRollup.objects.filter(direction=STOCK, year=0, month=0).update(
+        items=F('items') + items, total=F('total') + value,
+    )
+    if not updated:
+        rebuild_stock_summary()
+
+
+def rebuild_stock_summary():
+    items, value = stock_totals()
+    DashboardRollup.objects.update_or_create(
+        direction=STOCK, year=0, month=0, defaults={'doc_count': 0, 'items': items, 'total': value},
+    )
+
+
+def rebuild_rollups():
+    """Полный пересчёт всех сводок (GROUP BY по году и месяцу). Для миграции и `manage.py rebuild_rollups`."""
+    with transaction.atomic():
+        DashboardRollup.objects.all().delete()
+        buckets = {}
+        for direction, (model, marking_date_field) in DIRECTIONS.items():
+            docs = (
+                model.objects.annotate(y=ExtractYear('contract_date'), m=ExtractMonth('contract_date'))
+                .order_by().values('y', 'm').annotate(doc_count=Count('id'), total=Sum('total'))
+            )
+            for row in docs:
+                buckets[(direction, row['y'], row['m'])] = DashboardRollup(
+                    direction=direction, year=row['y'], month=row['m'],
+                    doc_count=row['doc_count'], total=float(row['total'] or 0),
+                )
+            items = (
+                ProductMarking.objects.filter(**{f'{marking_date_field}__isnull': False})
+                .annotate(y=ExtractYear(marking_date_field), m=ExtractMonth(marking_date_field))
+                .order_by().values('y', 'm').annotate(items=Count('id'))
+            )
+            for row in items:
+                bucket = buckets.get((direction, row['y'], row['m']))
+                if bucket is not None:
+                    bucket.items = row['items']
+        DashboardRollup.objects.bulk_create(buckets.values())
+        rebuild_stock_summary()
+    return len(buckets)
@@ -0,0 +1,139 @@
+"""
+Поиск маркировок по подстроке через индекс вместо marking__icontains (полный скан длинных DataMatrix-кодов).
+SQLite: внешняя FTS5-таблица с токенайзером trigram, синхронизируется триггерами (миграция 0017).
+Postgres: GIN-индекс pg_trgm по marking и запрос `marking ILIKE` по самой колонке. icontains сюда не годится:
+он компилируется в UPPER("marking"::text) LIKE UPPER(...), а индекс построен по marking, не по UPPER(marking).
+Запрос короче трёх символов (триграмма) или база без индекса — обычный icontains.
+Восстановить индекс (например, после пересоздания таблицы миграцией SQLite) — `manage.py rebuild_marking_search`.
+"""
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import ProductMarking
+
+MIN_TRIGRAM_LENGTH = 3
+
+MARKING_TABLE = 'warehouse_productmarking'
+FTS_TABLE = f'{MARKING_TABLE}_fts'
+FTS_TRIGGERS = (f'{FTS_TABLE}_ai', f'{FTS_TABLE}_ad', f'{FTS_TABLE}_au')
+
+# alias базы → доступен ли индекс поиска (проверка каталога один раз на процесс; сбрасывается после migrate).
+_index_available = {}
+
+
+def sqlite_fts_sql():
+    """DDL FTS-таблицы и триггеров синхронизации (external content: текст хранится только в самой таблице)."""
+    table = MARKING_TABLE
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"marking, content='{table}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, marking) VALUES (new.id, new.marking); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, marking) VALUES ('delete', old.id, old.marking); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF marking ON {table} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, marking) VALUES ('delete', old.id, old.marking); "
+        f"INSERT INTO {FTS_TABLE}(rowid, marking) VALUES (new.id, new.marking); END",
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+    ]
+
+
+def sqlite_drop_fts_sql():
+    return [f'DROP TRIGGER IF EXISTS {name}' for name in FTS_TRIGGERS] + [f'DROP TABLE IF EXISTS {FTS_TABLE}']
+
+
+TRGM_INDEX = 'marking_trgm_idx'
+POSTGRES_TRGM_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    f'CREATE INDEX IF NOT EXISTS {TRGM_INDEX} ON {MARKING_TABLE} USING gin (marking gin_trgm_ops)',
+]
+POSTGRES_DROP_TRGM_SQL = [f'DROP INDEX IF EXISTS {TRGM_INDEX}']
+
+
+def install_search_index(connection):
+    """Создаёт индекс поиска для бэкенда connection. False, если бэкенд/сборка его не поддерживает."""
+    if connection.vendor == 'sqlite':
+        statements = sqlite_fts_sql()
+    elif connection.vendor == 'postgresql':
+        statements = POSTGRES_TRGM_SQL
+    else:
+        return False
+    try:
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+    except DatabaseError:
+        # SQLite без FTS5/trigram (< 3.34) или нет прав на CREATE EXTENSION — остаётся icontains.
+        return False
+    finally:
+        reset_search_cache()
+    return True
+
+
+def drop_search_index(connection):
+    statements = {'sqlite': sqlite_drop_fts_sql(), 'postgresql': POSTGRES_DROP_TRGM_SQL}.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+    reset_search_cache()
+
+
+def reset_search_cache():
+    _index_available.clear()
+
+
+def search_index_available(using='default'):
+    """
+    SQLite: есть ли FTS-таблица со всеми триггерами (пересоздание таблицы миграцией их удаляет).
+    Postgres: есть ли GIN-индекс pg_trgm.
+    """
+    if using not in _index_available:
+        connection = connections[using]
+        available = False
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM sqlite_master WHERE name IN (%s, %s, %s, %s)",
+                    [FTS_TABLE, *FTS_TRIGGERS],
+                )
+                available = cursor.fetchone()[0] == 1 + len(FTS_TRIGGERS)
+        elif connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_indexes WHERE tablename = %s AND indexname = %s",
+                    [MARKING_TABLE, TRGM_INDEX],
+                )
+                available = cursor.fetchone()[0] == 1
+        _index_available[using] = available
+    return _index_available[using]
+
+
+def _fts_phrase(value):
+    """Строка как одна фраза FTS5: для trigram это поиск подстроки (кавычки внутри удваиваются)."""
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _like_contains(value):
+    """Шаблон LIKE «содержит value»: %, _ и \\ в самом значении экранируются."""
+    return '%' + value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def marking_search_q(value, prefix='', using='default'):
+    """
+    Q для «маркировка содержит value» (без учёта регистра). prefix — путь до маркировки, например 'income__'.
+    С индексом — id IN (подзапрос по индексу): SQLite — MATCH по FTS, Postgres — marking ILIKE (GIN pg_trgm);
+    без индекса — icontains.
+    """
+    if len(value) >= MIN_TRIGRAM_LENGTH and search_index_available(using):
+        if connections[using].vendor == 'sqlite':
+            matches = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [_fts_phrase(value)])
+        else:
+            matches = RawSQL(f'SELECT id FROM {MARKING_TABLE} WHERE marking ILIKE %s', [_like_contains(value)])
+        return Q(**{f'{prefix}id__in': matches})
+    return Q(**{f'{prefix}marking__icontains': value})
+
+
+def markings_matching(value, using='default'):
+    """Queryset маркировок, содержащих value, — для полусоединения (документ IN (SELECT ...)) вместо JOIN + DISTINCT."""
+    return ProductMarking.objects.using(using).filter(marking_search_q(value, using=using))
@@ -1,7 +1,12 @@
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import Group
 
+from .models import Income, Outcome, Product, ProductMarking
+from .rollups import INCOME, OUTCOME, adjust_stock_summary, touch_documents, touch_months
+from .search import reset_search_cache
+from .stock import adjust_stock, free_counts
+
 
 ROLE_NAMES = ('admin', 'operator', 'viewer')
 
@@ -12,3 +17,81 @@ def ensure_roles_exist(sender, **kwargs):
         return
     for name in ROLE_NAMES:
         Group.objects.get_or_create(name=name)
+
+
+@receiver(post_migrate)
+def reset_marking_search(sender, **kwargs):
+    # Миграции могли создать/удалить FTS-таблицу или её триггеры — перепроверим при следующем поиске.
+    reset_search_cache()
+
+
+@receiver(post_save, sender=ProductMarking)
+def update_stock_on_marking_save(sender, instance, created, raw=False, **kwargs):
+    """Одиночный save(): новая свободная маркировка, списание/возврат, перенос на другой товар."""
+    if raw:
+        return
+    deltas = {}
+    old_product_id, was_free = (None, False) if created else getattr(instance, '_stock_state', (None, False))
+    if was_free:
+        deltas[old_product_id] = deltas.get(old_product_id, 0) - 1
+    if instance.outcome_id is None:
+        deltas[instance.product_id] = deltas.get(instance.product_id, 0) + 1
+    adjust_stock(deltas)
+
+    old_income_id, old_outcome_id = (None, None) if created else getattr(instance, '_document_ids', (None, None))
+    if created or old_income_id != instance.income_id:
+        touch_documents(INCOME, [old_income_id, instance.income_id])
+    if created or old_outcome_id != instance.outcome_id:
+        touch_documents(OUTCOME, [old_outcome_id, instance.outcome_id])
+    instance.remember_state()
+
+
+@receiver(pre_delete, sender=Income)
+def update_stock_on_income_delete(sender, instance, **kwargs):
+    """Удаление прихода каскадом удаляет его маркировки (админка, удаление компании) — снимаем их с остатка."""
+    adjust_stock({product_id: -count for product_id, count in free_counts(instance.income.all()).items()})
+
+
+DOCUMENT_DIRECTIONS = {Income: INCOME, Outcome: OUTCOME}
+
+
+@receiver(post_save, sender=Income)
+@receiver(post_save, sender=Outcome)
+def touch_rollups_on_document_save(sender, instance, raw=False, **kwargs):
+    """Месяц документа (и прежний месяц, если сменили дату контракта) пересчитается после commit."""
+    if raw:
+        return
+    direction = DOCUMENT_DIRECTIONS[sender]
+    touch_documents(direction, [instance.pk])
+    touch_months(direction, [getattr(instance, '_loaded_contract_date', None)])
+    instance._loaded_contract_date = instance.contract_date
+
+
+@receiver(post_delete, sender=Income)
+@receiver(post_delete, sender=Outcome)
+def touch_rollups_on_document_delete(sender, instance, **kwargs):
+    touch_months(DOCUMENT_DIRECTIONS[sender], [
+        instance.contract_date, getattr(instance, '_loaded_contract_date', None),
+    ])
+
+
+@receiver(post_save, sender=Product)
+def update_stock_value_on_price_change(sender, instance, created, raw=False, **kwargs):
+    """Смена цены меняет стоимость остатка: quantity × (новая − старая цена)."""
+    old_price = getattr(instance, '_loaded_price', None)
+    instance._loaded_price = instance.price
+    if raw or created or old_price is None or old_price == instance.price:
+        return
+    quantity = Product.objects.filter(pk=instance.pk).values_list('quantity', flat=True).first() or 0
+    adjust_stock_summary(0, quantity * (float(instance.price) - float(old_price)))
+
+
+@receiver(pre_delete, sender=Product)
+def update_rollups_on_product_delete(sender, instance, **kwargs):
+    """Товар удаляется вместе с маркировками: снимаем его остаток и пересчитываем месяцы затронутых документов."""
+    markings = ProductMarking.objects.filter(product=instance).order_by()
+    touch_documents(INCOME, set(markings.values_list('income_id', flat=True)))
+    touch_documents(OUTCOME, set(markings.values_list('outcome_id', flat=True)))
+    row = Product.objects.filter(pk=instance.pk).values_list('quantity', 'price').first()
+    if row and row[0]:
+        adjust_stock_summary(-row[0], -row[0] * float(row[1]))
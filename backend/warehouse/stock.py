@@ -0,0 +1,109 @@
+"""
+Денормализованный остаток товара: Product.quantity = число его маркировок с outcome IS NULL.
+Меняется на каждом пути создания/удаления/списания/возврата маркировок:
+одиночные save()/delete() — через сигналы и ProductMarking.delete(), массовые bulk_create/update()/delete() —
+явным вызовом adjust_stock() в той же транзакции. Сверка и пересчёт — `manage.py rebuild_stock`.
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Value
+from django.db.models.functions import Coalesce
+
+from .models import Product, ProductMarking
+from .rollups import INCOME, OUTCOME, adjust_stock_summary, rebuild_stock_summary, touch_documents
+
+# id товаров на один UPDATE ... WHERE id IN (...).
+STOCK_CHUNK_SIZE = 500
+
+
+def adjust_stock(deltas):
+    """
+    Применяет изменения остатка {product_id: delta}. Товары с одинаковой delta — одним UPDATE
+    (quantity = quantity + delta) на чанк: на типичном документе это 1–2 запроса, без гонок read-modify-write.
+    """
+    deltas = {product_id: delta for product_id, delta in deltas.items() if product_id is not None and delta}
+    by_delta = defaultdict(list)
+    for product_id, delta in deltas.items():
+        by_delta[delta].append(product_id)
+    for delta, product_ids in by_delta.items():
+        for start in range(0, len(product_ids), STOCK_CHUNK_SIZE):
+            Product.objects.filter(id__in=product_ids[start:start + STOCK_CHUNK_SIZE]).update(
+                quantity=Coalesce(F('quantity'), Value(0)) + delta
+            )
+    if deltas:
+        # Строка остатка дашборда: число и стоимость свободных маркировок.
+        product_ids = list(deltas)
+        prices = {}
+        for start in range(0, len(product_ids), STOCK_CHUNK_SIZE):
+            prices.update(
+                Product.objects.filter(id__in=product_ids[start:start + STOCK_CHUNK_SIZE]).values_list('id', 'price')
+            )
+        adjust_stock_summary(
+            sum(deltas[product_id] for product_id in prices),
+            sum(deltas[product_id] * price for product_id, price in prices.items()),
+        )
+
+
+def add_stock(product_ids):
+    """+1 к остатку за каждое вхождение product_id (новые свободные маркировки или возврат со списания)."""
+    adjust_stock(Counter(product_ids))
+
+
+def remove_stock(product_ids):
+    """-1 к остатку за каждое вхождение product_id (списание или удаление свободных маркировок)."""
+    adjust_stock({product_id: -count for product_id, count in Counter(product_ids).items()})
+
+
+def free_counts(markings):
+    """{product_id: число свободных маркировок} для queryset маркировок — один GROUP BY."""
+    return dict(
+        markings.filter(outcome__isnull=True)
+        .order_by()
+        .values_list('product_id')
+        .annotate(count=Count('id'))
+    )
+
+
+def delete_markings(markings):
+    """
+    queryset.delete() маркировок с поправкой остатка и сводок — то же, что ProductMarking.delete() для одной
+    (массовое удаление её не вызывает). Для «удалить выбранные» в админке.
+    """
+    markings = markings.order_by()
+    with transaction.atomic():
+        adjust_stock({product_id: -count for product_id, count in free_counts(markings).items()})
+        income_ids = set(markings.values_list('income_id', flat=True).distinct())
+        outcome_ids = set(markings.values_list('outcome_id', flat=True).distinct())
+        result = markings.delete()
+    touch_documents(INCOME, income_ids)
+    touch_documents(OUTCOME, outcome_ids)
+    return result
+
+
+def actual_stock():
+    """Остатки, посчитанные по маркировкам: {product_id: count} (товары без свободных маркировок отсутствуют)."""
+    return free_counts(ProductMarking.objects.exclude(product__isnull=True))
+
+
+def find_stock_mismatches():
+    """[(product_id, хранимый quantity, фактический остаток)] для расходящихся товаров."""
+    actual = actual_stock()
+    return [
+        (product_id, quantity, actual.get(product_id, 0))
+        for product_id, quantity in Product.objects.order_by('id').values_list('id', 'quantity').iterator()
+        if (quantity or 0) != actual.get(product_id, 0) or quantity is None
+    ]
+
+
+def rebuild_stock():
+    """Пересчитывает quantity у расходящихся товаров. Возвращает список исправленных расхождений."""
+    mismatches = find_stock_mismatches()
+    by_value = defaultdict(list)
+    for product_id, _, actual in mismatches:
+        by_value[actual].append(product_id)
+    for actual, product_ids in by_value.items():
+        for start in range(0, len(product_ids), STOCK_CHUNK_SIZE):
+            Product.objects.filter(id__in=product_ids[start:start + STOCK_CHUNK_SIZE]).update(quantity=actual)
+    rebuild_stock_summary()
+    return mismatches
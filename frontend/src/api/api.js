@@ -315,6 +315,23 @@ export const invalidateIncomeByIdCache = (id) => {
 
 export const createIncome = (data) => axiosInstance.post('/incomes/', data);
 
+/** Фоновая задача (POST ...?async=1 → 202 { id }). Опрос: status pending|running|done|failed, progress_done/total. */
+export const getJob = (id, signal) =>
+    axiosInstance.get(`/jobs/${id}/`, signal ? { signal } : {});
+
+/**
+ * Импорт выгрузки сканера в приход. file — File/Blob (CSV или NDJSON), отправляется как есть, без JSON.
+ * Response: { received, created, exists, duplicates, invalid, exists_count, duplicates_count, invalid_count,
+ *             truncated, chunks: [{ chunk, received, created, exists, duplicates, invalid }] }
+ * exists / duplicates (маркировки) и invalid (номера строк) — первые 100 на весь импорт, *_count — полные количества,
+ * truncated — списки обрезаны. В chunks только счётчики (числа), без списков.
+ */
+export const importIncomeMarkings = (incomeId, file, { type = 'csv', product } = {}) =>
+    axiosInstance.post(`/incomes/${incomeId}/markings/import/`, file, {
+        params: { type, ...(product ? { product } : {}) },
+        headers: { 'Content-Type': type === 'csv' ? 'text/csv' : 'application/x-ndjson' },
+    });
+
 export const updateMarking = async (incomeId, productId, markingId, newMarking, newMarkingCounter) => {
     try {
         const response = await axiosInstance.put(